@@ -0,0 +1,1865 @@
+"""
+Benchmarks and load tests for the chat server.
+
+Every benchmark starts its own server in a subprocess on a free local port,
+so nothing needs to be running beforehand.
+
+Usage:
+    python benchmark.py load [--engine threaded selector] [--clients 100 500]
+    python benchmark.py broadcast [--engine selector] [--sizes 10 100 500]
+    python benchmark.py recv [--encrypted]
+    python benchmark.py oversize [--claim 200000000] [--sockets 20]
+    python benchmark.py media [--engine selector] [--calls 4]
+    python benchmark.py calls [--participants 2 4 8 16] [--seconds 5]
+    python benchmark.py priority [--rate 2000000] [--seconds 5]
+    python benchmark.py video [--rates 16000 64000 512000] [--seconds 15]
+    python benchmark.py codec [--recording clip.mp4] [--frames 150]
+    python benchmark.py audio [--jitter 0.005 0.02 0.06] [--loss 0.02]
+    python benchmark.py render [--sizes 320x240 640x480] [--fps 30]
+    python benchmark.py cipher [--sizes 64 2048 6000 65536]
+    python benchmark.py bots [--users 100] [--rooms 5] [--calls 4] [--files 2]
+    python benchmark.py metrics
+    python benchmark.py presence [--clients 100 500] [--churn 20]
+    python benchmark.py files [--members 20] [--shares 5] [--size 1048576]
+"""
+
+import argparse
+import cv2
+import hashlib
+import io
+import msgpack
+import numpy as np
+import os
+import random
+import resource
+import selectors
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import statistics
+import threading
+import time
+
+import bot_client
+import calls
+import history
+import media_utils
+import metrics
+import protocol
+from bot_client import percentile
+from PIL import Image
+
+
+def free_port():
+    """Returns a TCP port that is currently free on localhost."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def raise_fd_limit():
+    """Raises the open file limit so thousands of sockets can be opened."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def start_server(engine="threaded", extra_args=()):
+    """
+    Starts server.py in a subprocess and waits until it accepts connections.
+
+    The history log and file store go to a temporary directory, removed by
+    stop_server, unless extra_args name directories of their own.
+
+    Returns:
+        A tuple of (process, port).
+    """
+    port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    scratch = tempfile.mkdtemp(prefix="bench-")
+    scratch_args = [
+        "--history-dir",
+        os.path.join(scratch, "history"),
+        "--files-dir",
+        os.path.join(scratch, "files"),
+    ]
+    process = subprocess.Popen(
+        [sys.executable, "server.py", "--engine", engine, "--port", str(port)]
+        + scratch_args
+        + list(extra_args),
+        cwd=here,
+        stdout=subprocess.DEVNULL,
+    )
+    process.scratch = scratch
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    stop_server(process)
+    raise RuntimeError("server did not start")
+
+
+def stop_server(process):
+    """Terminates a server started with start_server and removes its files."""
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    scratch = getattr(process, "scratch", None)
+    if scratch:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def stop_servers(processes):
+    """
+    Stops every process with stop_server, even if stopping one of them fails.
+
+    Raises:
+        The first error hit, after all processes were handled.
+    """
+    error = None
+    for process in processes:
+        try:
+            stop_server(process)
+        except Exception as e:
+            error = error or e
+    if error:
+        raise error
+
+
+def cpu_seconds(pid):
+    """Returns the user + system CPU time a process has used so far."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def process_tree(pid):
+    """Returns a process id followed by the ids of all its descendants."""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def process_stats(pid):
+    """
+    Reads resident memory, peak resident memory (KiB) and thread count of a
+    process from /proc.
+    """
+    stats = {"rss_kb": 0, "peak_rss_kb": 0, "threads": 0}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    stats["rss_kb"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    stats["peak_rss_kb"] = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    stats["threads"] = int(line.split()[1])
+    except OSError:
+        pass
+    return stats
+
+
+class FrameCounter:
+    """
+    Drains many client sockets on one thread and counts received frames.
+
+    Only the length headers are parsed so the load generator spends as
+    little CPU as possible next to the server.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        self.frames = 0
+        self.bytes = 0
+        self.last_frame_time = 0.0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, sock):
+        self.buffers[sock] = bytearray()
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def run(self):
+        while self.running:
+            if not self.buffers:
+                time.sleep(0.01)
+                continue
+
+            for key, mask in self.selector.select(timeout=0.05):
+                sock = key.fileobj
+                try:
+                    data = sock.recv(262144)
+                except OSError:
+                    data = b""
+                if not data:
+                    self.selector.unregister(sock)
+                    continue
+
+                buf = self.buffers[sock]
+                buf += data
+                while len(buf) >= protocol.HEADER_LENGTH:
+                    end = protocol.HEADER_LENGTH + struct.unpack_from(">I", buf)[0]
+                    if len(buf) < end:
+                        break
+                    del buf[:end]
+                    self.frames += 1
+                    self.bytes += end
+                    self.last_frame_time = time.perf_counter()
+
+    def wait_idle(self, quiet=0.5, timeout=120):
+        """Blocks until no new frames arrive for `quiet` seconds."""
+        deadline = time.time() + timeout
+        last = -1
+        while time.time() < deadline:
+            if self.frames == last:
+                return
+            last = self.frames
+            time.sleep(quiet)
+
+    def wait_for(self, count, timeout=120):
+        """Blocks until at least `count` frames were received."""
+        deadline = time.time() + timeout
+        while self.frames < count and time.time() < deadline:
+            time.sleep(0.0005)
+        return self.frames >= count
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+def run_load(engine, n_clients, n_senders=10, n_messages=50):
+    """
+    Connects n_clients users to one room and measures broadcast throughput.
+
+    Returns:
+        A dictionary of measurements.
+    """
+    process, port = start_server(engine)
+    counter = FrameCounter()
+    sockets = []
+    result = {"engine": engine, "clients": n_clients}
+
+    try:
+        # Login storm
+        start = time.perf_counter()
+        for i in range(n_clients):
+            sock = socket.create_connection(("127.0.0.1", port))
+            protocol.send_packet(sock, protocol.CMD_LOGIN, {"username": f"bot{i}"})
+            counter.add(sock)
+            sockets.append(sock)
+        counter.wait_idle()
+        result["login_s"] = counter.last_frame_time - start
+        result.update(process_stats(process.pid))
+
+        # Room broadcast: every message is delivered to every client
+        senders = sockets[:n_senders]
+        base = counter.frames
+        expected = base + len(senders) * n_messages * n_clients
+        start = time.perf_counter()
+        for i in range(n_messages):
+            for sock in senders:
+                protocol.send_packet(sock, protocol.CMD_MSG, {"text": f"m{i}"})
+        complete = counter.wait_for(expected)
+        elapsed = time.perf_counter() - start
+
+        sent = len(senders) * n_messages
+        result["msg_per_s"] = sent / elapsed
+        result["deliveries_per_s"] = (counter.frames - base) / elapsed
+        result["complete"] = complete
+    finally:
+        counter.stop()
+        for sock in sockets:
+            sock.close()
+        stop_server(process)
+
+    return result
+
+
+def bench_load(args):
+    raise_fd_limit()
+    print(
+        f"{'engine':<10}{'clients':>8}{'login s':>10}{'rss MiB':>10}"
+        f"{'threads':>9}{'msg/s':>10}{'deliv/s':>11}"
+    )
+    for n_clients in args.clients:
+        for engine in args.engine:
+            r = run_load(engine, n_clients, args.senders, args.messages)
+            print(
+                f"{r['engine']:<10}{r['clients']:>8}{r['login_s']:>10.2f}"
+                f"{r['rss_kb'] / 1024:>10.1f}{r['threads']:>9}"
+                f"{r['msg_per_s']:>10.0f}{r['deliveries_per_s']:>11.0f}"
+                + ("" if r["complete"] else "  (timed out)")
+            )
+
+
+def run_broadcast(engine, room_size, rounds=20):
+    """
+    Measures the time from sending one room message until every member has it.
+
+    Returns:
+        The median broadcast latency in seconds.
+    """
+    process, port = start_server(engine)
+    counter = FrameCounter()
+    sockets = []
+
+    try:
+        for i in range(room_size):
+            sock = socket.create_connection(("127.0.0.1", port))
+            protocol.send_packet(sock, protocol.CMD_LOGIN, {"username": f"bot{i}"})
+            counter.add(sock)
+            sockets.append(sock)
+        counter.wait_idle()
+
+        samples = []
+        for i in range(rounds):
+            expected = counter.frames + room_size
+            start = time.perf_counter()
+            protocol.send_packet(sockets[0], protocol.CMD_MSG, {"text": f"m{i}"})
+            counter.wait_for(expected)
+            samples.append(time.perf_counter() - start)
+    finally:
+        counter.stop()
+        for sock in sockets:
+            sock.close()
+        stop_server(process)
+
+    return statistics.median(samples)
+
+
+def encode_cost(room_size, repeat=20):
+    """
+    Compares per-recipient encoding with encode-once for one room message.
+
+    Returns:
+        A tuple of (per-recipient seconds, encode-once seconds).
+    """
+    data = {"from": "bot0", "text": "x" * 64, "room": "General"}
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _ in range(room_size):
+            protocol.encode_packet(protocol.CMD_MSG, data)
+    per_recipient = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        protocol.encode_packet(protocol.CMD_MSG, data)
+    once = (time.perf_counter() - start) / repeat
+
+    return per_recipient, once
+
+
+def bench_broadcast(args):
+    raise_fd_limit()
+    print(
+        f"{'engine':<10}{'room':>6}{'latency ms':>12}"
+        f"{'encode xN ms':>14}{'encode x1 ms':>14}"
+    )
+    for size in args.sizes:
+        per_recipient, once = encode_cost(size)
+        for engine in args.engine:
+            latency = run_broadcast(engine, size, args.rounds)
+            print(
+                f"{engine:<10}{size:>6}{latency * 1000:>12.2f}"
+                f"{per_recipient * 1000:>14.2f}{once * 1000:>14.3f}"
+            )
+
+
+def legacy_receive_packet(sock, is_encrypted=True):
+    """The original receive loop (payload += chunk in BUFFER_SIZE steps)."""
+    header = b""
+    while len(header) < protocol.HEADER_LENGTH:
+        chunk = sock.recv(protocol.HEADER_LENGTH - len(header))
+        if not chunk:
+            return None
+        header += chunk
+
+    payload_length = struct.unpack(">I", header)[0]
+    payload = b""
+    while len(payload) < payload_length:
+        read_size = min(payload_length - len(payload), protocol.BUFFER_SIZE)
+        chunk = sock.recv(read_size)
+        if not chunk:
+            return None
+        payload += chunk
+
+    if is_encrypted:
+        payload = protocol.cipher.decrypt(payload)
+    return msgpack.unpackb(payload, raw=False)
+
+
+def time_receive(receive, frame, count, is_encrypted):
+    """Times `count` receives of the same frame over a local socket pair."""
+    a, b = socket.socketpair()
+    sender = threading.Thread(target=lambda: [a.sendall(frame) for _ in range(count)])
+
+    start = time.perf_counter()
+    sender.start()
+    for _ in range(count):
+        receive(b, is_encrypted)
+    elapsed = time.perf_counter() - start
+
+    sender.join()
+    a.close()
+    b.close()
+    return elapsed / count
+
+
+def bench_recv(args):
+    print(f"{'payload':>10}{'legacy ms':>12}{'recv_into ms':>14}{'speedup':>9}")
+    for size in args.sizes:
+        frame = protocol.encode_packet(
+            protocol.CMD_FILE, {"content": os.urandom(size)}, args.encrypted
+        )
+        count = max(1, min(2000, 20_000_000 // size))
+
+        legacy = time_receive(legacy_receive_packet, frame, count, args.encrypted)
+        buffer = protocol.ReceiveBuffer(max_size=len(frame))
+        current = time_receive(
+            lambda s, enc: protocol.receive_packet(s, enc, buffer=buffer),
+            frame,
+            count,
+            args.encrypted,
+        )
+        print(
+            f"{size:>10}{legacy * 1000:>12.3f}{current * 1000:>14.3f}"
+            f"{legacy / current:>8.1f}x"
+        )
+
+
+def run_oversize(engine, claim, n_sockets):
+    """
+    Opens `n_sockets` connections that each send a length header claiming
+    `claim` bytes and a few bytes of payload, without logging in.
+
+    Returns:
+        A dictionary with the connections the server dropped, the growth of
+        its resident memory (KiB) and whether a regular login still works.
+    """
+    process, port = start_server(engine)
+    socks = []
+    try:
+        time.sleep(0.3)
+        rss_before = process_stats(process.pid)["rss_kb"]
+        for _ in range(n_sockets):
+            sock = socket.create_connection(("127.0.0.1", port))
+            sock.sendall(struct.pack(">I", claim) + b"0123456789")
+            socks.append(sock)
+        time.sleep(1)
+        rss_growth = process_stats(process.pid)["rss_kb"] - rss_before
+
+        dropped = 0
+        for sock in socks:
+            sock.settimeout(2)
+            try:
+                dropped += sock.recv(1) == b""
+            except ConnectionResetError:
+                dropped += 1
+            except socket.timeout:
+                pass  # Still open, waiting for the rest of the frame
+        client = socket.create_connection(("127.0.0.1", port))
+        client.settimeout(5)
+        protocol.send_packet(client, protocol.CMD_LOGIN, {"username": "probe"})
+        reply = protocol.receive_packet(client)
+        client.close()
+    finally:
+        for sock in socks:
+            sock.close()
+        stop_server(process)
+
+    return {
+        "dropped": dropped,
+        "rss_growth_kb": rss_growth,
+        "login": bool(reply and reply["type"] == protocol.CMD_LOGIN_ACK),
+    }
+
+
+def bench_oversize(args):
+    print(f"limit: {protocol.MAX_FRAME_SIZE} bytes per frame")
+    print(
+        f"{'engine':<10}{'claimed MB':>11}{'sockets':>9}{'dropped':>9}"
+        f"{'RSS +MiB':>10}{'login':>7}"
+    )
+    for engine in args.engine:
+        r = run_oversize(engine, args.claim, args.sockets)
+        print(
+            f"{engine:<10}{args.claim / 1e6:>11.0f}{args.sockets:>9}"
+            f"{r['dropped']:>9}{r['rss_growth_kb'] / 1024:>10.1f}"
+            f"{'ok' if r['login'] else 'FAIL':>7}"
+        )
+
+
+# Media rates of one call direction, as sent by ClientApp
+VIDEO_FPS = 10
+AUDIO_CHUNKS_PER_S = 16000 / 1024
+
+
+def run_media(engine, mode, n_calls, frames_per_call, frame_size=6000):
+    """
+    Pushes video and audio frames through n_calls 1:1 calls and measures
+    the server CPU time spent per forwarded frame.
+
+    Args:
+        mode: "legacy" for fully encrypted packets, "relay" for relay frames.
+
+    Returns:
+        Server CPU seconds per forwarded frame.
+    """
+    # Frames are sent faster than real time, so lift the media drop limit
+    # to measure the cost of relaying every one of them
+    process, port = start_server(engine, ["--max-media-queue", "1000000"])
+    counter = FrameCounter()
+    pairs = []
+
+    try:
+        for i in range(n_calls):
+            pair = []
+            for side in "ab":
+                sock = socket.create_connection(("127.0.0.1", port))
+                protocol.send_packet(
+                    sock, protocol.CMD_LOGIN, {"username": f"{side}{i}", "relay": True}
+                )
+                counter.add(sock)
+                pair.append(sock)
+            pairs.append(pair)
+        counter.wait_idle()
+
+        # Encode each direction's frames once; the generator is not measured
+        video = {"frame": os.urandom(frame_size)}
+        audio = {"chunk": os.urandom(2048)}
+        bursts = []
+        for i, (a, b) in enumerate(pairs):
+            for sock, target in ((a, f"b{i}"), (b, f"a{i}")):
+                if mode == "relay":
+                    frames = [
+                        protocol.encode_relay_packet(protocol.CMD_VIDEO, target, video),
+                        protocol.encode_relay_packet(protocol.CMD_AUDIO, target, audio),
+                    ]
+                else:
+                    frames = [
+                        protocol.encode_packet(
+                            protocol.CMD_VIDEO, dict(video, target=target)
+                        ),
+                        protocol.encode_packet(
+                            protocol.CMD_AUDIO, dict(audio, target=target)
+                        ),
+                    ]
+                bursts.append((sock, b"".join(frames)))
+
+        rounds = frames_per_call // 2
+        expected = counter.frames + rounds * len(bursts) * 2
+        cpu_start = cpu_seconds(process.pid)
+        for _ in range(rounds):
+            for sock, burst in bursts:
+                sock.sendall(burst)
+        counter.wait_for(expected)
+        cpu = cpu_seconds(process.pid) - cpu_start
+    finally:
+        counter.stop()
+        for pair in pairs:
+            for sock in pair:
+                sock.close()
+        stop_server(process)
+
+    return cpu / (rounds * len(bursts) * 2)
+
+
+def bench_media(args):
+    # One call = two directions of video plus audio
+    frames_per_call_s = 2 * (VIDEO_FPS + AUDIO_CHUNKS_PER_S)
+    print(f"{'engine':<10}{'mode':<8}{'us/frame':>10}{'calls/core':>12}")
+    for engine in args.engine:
+        for mode in ["legacy", "relay"]:
+            per_frame = run_media(engine, mode, args.calls, args.frames)
+            calls = 1 / (per_frame * frames_per_call_s)
+            print(f"{engine:<10}{mode:<8}{per_frame * 1e6:>10.1f}{calls:>12.0f}")
+
+
+CALL_TURN = 2.0  # Seconds each participant of a benchmark call talks in turn
+CALL_TALKING = -20  # dBov of the participant whose turn it is
+CALL_QUIET = -65  # dBov of the others (room noise, below calls.SPEAKING_LEVEL)
+CALL_CHUNK_BYTES = 320  # An ADPCM chunk (media_utils.CHUNK samples)
+
+
+def call_frame_bytes(layer, count=60):
+    """Returns the mean VIDEO_FRAME size of a call layer, tile-coded."""
+    width, height, quality, _ = media_utils.CALL_LAYERS[layer]
+    encoder = media_utils.TileEncoder()
+    encoder.enabled = True
+    sizes = [
+        len(
+            encoder.encode(media_utils.synthetic_frame(i, width, height), quality)[
+                "frame"
+            ]
+        )
+        for i in range(count)
+    ]
+    return int(statistics.mean(sizes))
+
+
+class CallMember:
+    """
+    One headless participant of a benchmark call: counts what it receives
+    and keeps the latest CMD_CALL_STATE.
+    """
+
+    def __init__(self, port, username):
+        self.username = username
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        login = {"username": username, "relay": True}
+        protocol.send_packet(self.sock, protocol.CMD_LOGIN, login)
+        protocol.send_packet(self.sock, protocol.CMD_ROOM_JOIN, {"room": "Call"})
+        self.state = {}
+        self.media_bytes = 0
+        self.media_frames = 0
+        self.sent_bytes = 0
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        for payload in protocol.FrameReader(self.sock).payloads():
+            if protocol.is_relay_payload(payload):
+                self.media_bytes += protocol.HEADER_LENGTH + len(payload)
+                self.media_frames += 1
+                continue
+            packet = protocol.decode_payload(payload)
+            if packet["type"] == protocol.CMD_CALL_STATE:
+                self.state = packet["data"]
+
+    def send(self, frame):
+        self.sock.sendall(frame)
+        self.sent_bytes += len(frame)
+
+
+def run_call(engine, mode, participants, seconds, frame_bytes):
+    """
+    Runs one call of `participants` users talking in turn for `seconds`.
+
+    In "sfu" mode they join the room's group call and send one audio stream
+    and the video layer the call state asks for; in "mesh" mode every one
+    sends its full-size video and audio to each of the others, as 1:1
+    calls between all of them would.
+
+    Returns:
+        A dictionary with the server's CPU share, the bytes per second sent
+        to and received from it, and the video frames received per second
+        by each participant.
+    """
+    process, port = start_server(engine)
+    members = [CallMember(port, f"m{i}") for i in range(participants)]
+    try:
+        time.sleep(0.5)
+        if mode == "sfu":
+            for member in members:
+                protocol.send_packet(
+                    member.sock, protocol.CMD_CALL_JOIN, {"codecs": ["adpcm"]}
+                )
+            time.sleep(0.5)
+
+        # Encode every frame once; the generator is not what is measured
+        audio = {"chunk": os.urandom(CALL_CHUNK_BYTES), "codec": "adpcm"}
+        video = [{"frame": os.urandom(size), "codec": "tiles"} for size in frame_bytes]
+        frames = {}
+
+        def frame(member, cmd, key, route):
+            if (member, cmd, key) not in frames:
+                data = audio if cmd == protocol.CMD_AUDIO else video[route["layer"]]
+                if "call" in route:
+                    encoded = protocol.encode_routed_packet(cmd, route, data)
+                else:
+                    encoded = protocol.encode_relay_packet(cmd, route["target"], data)
+                frames[(member, cmd, key)] = encoded
+            return frames[(member, cmd, key)]
+
+        fps = media_utils.CALL_LAYERS[protocol.LAYER_HIGH][3]
+        low_fps = media_utils.CALL_LAYERS[protocol.LAYER_LOW][3]
+        chunk_seconds = media_utils.CHUNK / media_utils.RATE
+        start_cpu = cpu_seconds(process.pid)
+        start = next_tick = time.monotonic()
+        received = [member.media_frames for member in members]
+        tick = 0
+        while time.monotonic() - start < seconds:
+            elapsed = time.monotonic() - start
+            talker = int(elapsed / CALL_TURN) % participants
+            for i, member in enumerate(members):
+                level = CALL_TALKING if i == talker else CALL_QUIET
+                if mode == "sfu":
+                    route = {"call": "Call", "level": level}
+                    member.send(frame(i, protocol.CMD_AUDIO, level, route))
+                    state = member.state
+                    if member.username in state.get("speakers", ()):
+                        layer, rate = protocol.LAYER_HIGH, fps
+                    elif member.username in state.get("videos", ()):
+                        layer, rate = protocol.LAYER_LOW, low_fps
+                    else:
+                        continue
+                    if int(tick * chunk_seconds * rate) != int(
+                        (tick + 1) * chunk_seconds * rate
+                    ):
+                        route = {"call": "Call", "layer": layer}
+                        member.send(frame(i, protocol.CMD_VIDEO, layer, route))
+                else:
+                    send_video = int(tick * chunk_seconds * fps) != int(
+                        (tick + 1) * chunk_seconds * fps
+                    )
+                    for other in members:
+                        if other is member:
+                            continue
+                        route = {"target": other.username}
+                        member.send(frame(i, protocol.CMD_AUDIO, other.username, route))
+                        if send_video:
+                            route["layer"] = protocol.LAYER_HIGH
+                            key = ("video", other.username)
+                            member.send(frame(i, protocol.CMD_VIDEO, key, route))
+            tick += 1
+            next_tick += chunk_seconds
+            time.sleep(max(0, next_tick - time.monotonic()))
+
+        elapsed = time.monotonic() - start
+        cpu = cpu_seconds(process.pid) - start_cpu
+        time.sleep(0.5)  # Let in-flight frames land
+    finally:
+        for member in members:
+            member.sock.close()
+        stop_server(process)
+
+    sent = sum(member.sent_bytes for member in members)
+    delivered = sum(member.media_bytes for member in members)
+    frames_in = sum(m.media_frames - r for m, r in zip(members, received))
+    return {
+        "cpu": cpu / elapsed,
+        "in": sent / elapsed,
+        "out": delivered / elapsed,
+        "frames": frames_in / elapsed / participants,
+    }
+
+
+def bench_calls(args):
+    frame_bytes = [call_frame_bytes(layer) for layer in (0, 1)]
+    print(
+        f"video frames: {frame_bytes[0]} B small, {frame_bytes[1]} B full size; "
+        f"SFU forwards {calls.SPEAKERS} full-size, {calls.MAX_VIDEOS} videos and "
+        f"{calls.AUDIBLE} audio streams at most"
+    )
+    print(
+        f"{'mode':<6}{'users':>6}{'server CPU':>12}{'in KB/s':>10}"
+        f"{'out KB/s':>10}{'KB/s each':>11}{'frames/s each':>15}"
+    )
+    for participants in args.participants:
+        for mode in ["mesh", "sfu"]:
+            result = run_call(
+                args.engine, mode, participants, args.seconds, frame_bytes
+            )
+            print(
+                f"{mode:<6}{participants:>6}{result['cpu'] * 100:>11.0f}%"
+                f"{result['in'] / 1024:>10.0f}{result['out'] / 1024:>10.0f}"
+                f"{result['out'] / 1024 / participants:>11.1f}"
+                f"{result['frames']:>15.1f}"
+            )
+
+
+def run_priority(prioritized, rate, seconds, frame_size=30000, fps=15):
+    """
+    Measures chat latency to a receiver whose link is saturated by a file
+    transfer and a video stream from the same sender.
+
+    The receiver reads at `rate` bytes per second to emulate a slow link.
+    Both the server and the sending client use prioritized or FIFO queues.
+
+    Returns:
+        A dictionary of measurements.
+    """
+    extra = [] if prioritized else ["--fifo-queues"]
+    process, port = start_server("threaded", extra)
+    running = True
+    latencies = []
+    received = {"file": 0, "video": 0}
+
+    alice = socket.create_connection(("127.0.0.1", port))
+    bob = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    bob.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+    bob.connect(("127.0.0.1", port))
+    protocol.limit_unsent(alice)
+
+    sender = protocol.PacketSender(alice, protocol.SendQueue(prioritized=prioritized))
+    window = protocol.AckWindow()
+
+    def alice_reader():
+        for packet in protocol.FrameReader(alice).packets():
+            if packet["type"] == protocol.CMD_FILE_ACK:
+                window.ack(packet["data"]["offset"])
+
+    def bob_reader():
+        reader = protocol.FrameReader(bob)
+        while running:
+            count = reader.fill()
+            if not count:
+                break
+            for payload in reader.frames():
+                packet = protocol.decode_payload(payload)
+                cmd = packet["type"]
+                if cmd == protocol.CMD_MSG and packet["data"]["from"] == "alice":
+                    sent_at = float(packet["data"]["text"])
+                    latencies.append(time.perf_counter() - sent_at)
+                elif cmd == protocol.CMD_FILE_CHUNK:
+                    received["file"] += len(packet["data"]["data"])
+                elif cmd == protocol.CMD_VIDEO:
+                    received["video"] += 1
+            time.sleep(count / rate)
+
+    def file_sender():
+        chunk = os.urandom(protocol.FILE_CHUNK_SIZE)
+        offer = {"transfer_id": "bench", "filename": "f", "size": 0, "to": "bob"}
+        sender.send_packet(protocol.CMD_FILE_OFFER, offer, protocol.KIND_FILE)
+        offset = 0
+        while running and window.wait(offset, timeout=1):
+            data = {"transfer_id": "bench", "offset": offset, "data": chunk}
+            sender.send_packet(protocol.CMD_FILE_CHUNK, data, protocol.KIND_FILE)
+            offset += len(chunk)
+
+    def video_sender():
+        frame = protocol.encode_relay_packet(
+            protocol.CMD_VIDEO, "bob", {"frame": os.urandom(frame_size)}
+        )
+        while running:
+            sender.send_frame(frame, protocol.KIND_VIDEO)
+            time.sleep(1 / fps)
+
+    try:
+        sender.send_packet(protocol.CMD_LOGIN, {"username": "alice", "relay": True})
+        protocol.send_packet(
+            bob, protocol.CMD_LOGIN, {"username": "bob", "relay": True}
+        )
+        for target in (alice_reader, bob_reader):
+            threading.Thread(target=target, daemon=True).start()
+        time.sleep(0.3)
+        for target in (file_sender, video_sender):
+            threading.Thread(target=target, daemon=True).start()
+
+        # Chat every 100 ms while the link is saturated
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            text = repr(time.perf_counter())
+            sender.send_packet(protocol.CMD_MSG, {"text": text, "to": "bob"})
+            time.sleep(0.1)
+    finally:
+        running = False
+        window.cancel()
+        sender.close()
+        alice.close()
+        bob.close()
+        stop_server(process)
+
+    return {
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "messages": len(latencies),
+        "file_kbps": received["file"] / seconds / 1024,
+        "video_fps": received["video"] / seconds,
+    }
+
+
+def run_video(mode, rate, seconds):
+    """
+    Streams synthetic camera video to a receiver whose link is limited to
+    `rate` bytes per second, like a call in the client.
+
+    Args:
+        mode: "fixed" for the former 240x180 at 10 fps, "high" for the best
+            level of VIDEO_LEVELS, "adaptive" for the rate controller.
+
+    Returns:
+        A dictionary of measurements.
+    """
+    process, port = start_server("threaded")
+    running = True
+    latencies = []
+    received = {"frames": 0, "bytes": 0, "pixels": 0}
+
+    alice = socket.create_connection(("127.0.0.1", port))
+    bob = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    bob.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+    bob.connect(("127.0.0.1", port))
+    protocol.limit_unsent(alice)
+    sender = protocol.PacketSender(alice)
+
+    levels = media_utils.VIDEO_LEVELS
+    start = len(levels) - 1 if mode == "high" else 1
+    controller = media_utils.VideoController(levels, start)
+    feedback = media_utils.VideoFeedback()
+
+    def alice_reader():
+        for packet in protocol.FrameReader(alice).packets():
+            if packet["type"] == protocol.CMD_VIDEO_FEEDBACK and mode == "adaptive":
+                controller.on_feedback(packet["data"])
+
+    def bob_reader():
+        reader = protocol.FrameReader(bob)
+        while running:
+            count = reader.fill()
+            if not count:
+                break
+            for payload in reader.frames():
+                packet = protocol.decode_payload(payload)
+                if packet["type"] != protocol.CMD_VIDEO:
+                    continue
+                data = packet["data"]
+                latencies.append(time.monotonic() - data["ts"])
+                received["frames"] += 1
+                received["bytes"] += len(data["frame"])
+                received["pixels"] += data["width"] * data["height"]
+                report = feedback.on_frame(data)
+                if report:
+                    protocol.send_relay_packet(
+                        bob, protocol.CMD_VIDEO_FEEDBACK, "alice", report
+                    )
+            time.sleep(count / rate)
+
+    try:
+        sender.send_packet(protocol.CMD_LOGIN, {"username": "alice", "relay": True})
+        protocol.send_packet(
+            bob, protocol.CMD_LOGIN, {"username": "bob", "relay": True}
+        )
+        for target in (alice_reader, bob_reader):
+            threading.Thread(target=target, daemon=True).start()
+        time.sleep(0.3)
+
+        seq = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            queued = sender.queue.depth(protocol.KIND_VIDEO)
+            if mode == "adaptive":
+                width, height, quality, fps = controller.update(queued)
+            else:
+                width, height, quality, fps = controller.settings()
+            image = cv2.resize(media_utils.synthetic_frame(seq), (width, height))
+            _, jpeg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            data = {
+                "frame": jpeg.tobytes(),
+                "seq": seq,
+                "ts": time.monotonic(),
+                "width": width,
+                "height": height,
+            }
+            frame = protocol.encode_relay_packet(protocol.CMD_VIDEO, "bob", data)
+            sender.send_frame(frame, protocol.KIND_VIDEO)
+            seq += 1
+            time.sleep(max(0, 1 / fps - (time.monotonic() - started)))
+    finally:
+        running = False
+        sender.close()
+        alice.close()
+        bob.close()
+        stop_server(process)
+
+    frames = received["frames"] or 1
+    return {
+        "fps": received["frames"] / seconds,
+        "kbps": received["bytes"] / seconds / 1024,
+        "pixels": received["pixels"] / frames,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "sent": seq,
+        "level": controller.level,
+    }
+
+
+def bench_video(args):
+    print(
+        f"{'link KB/s':>9}  {'mode':<10}{'fps':>6}{'KB/s':>8}{'pixels':>9}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'level':>7}"
+    )
+    for rate in args.rates:
+        for mode in args.modes:
+            r = run_video(mode, rate, args.seconds)
+            print(
+                f"{rate / 1024:>9.0f}  {mode:<10}{r['fps']:>6.1f}{r['kbps']:>8.1f}"
+                f"{r['pixels']:>9.0f}{r['p50'] * 1000:>9.0f}{r['p95'] * 1000:>9.0f}"
+                f"{r['level']:>7}"
+            )
+
+
+def codec_frames(sequence, count, width, height):
+    """
+    Yields the frames of a test sequence: "moving" (the synthetic ball),
+    "still" (one synthetic frame with camera sensor noise) or the path of
+    a recording readable by OpenCV, looped if it is short.
+    """
+    rng = np.random.default_rng(1)
+    still = cv2.resize(media_utils.synthetic_frame(0), (width, height))
+    capture = None
+    if sequence not in ("moving", "still"):
+        capture = cv2.VideoCapture(sequence)
+        if not capture.isOpened():
+            raise SystemExit(f"cannot read {sequence}")
+    for index in range(count):
+        if sequence == "moving":
+            frame = media_utils.synthetic_frame(index)
+        elif sequence == "still":
+            noise = rng.normal(0, 2, still.shape)
+            frame = np.clip(still + noise, 0, 255).astype(np.uint8)
+        else:
+            ok, frame = capture.read()
+            if not ok:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = capture.read()
+                if not ok:
+                    break
+        yield cv2.resize(frame, (width, height))
+    if capture:
+        capture.release()
+
+
+def run_codec(codec, frames, quality, fps):
+    """
+    Encodes and decodes a frame sequence like a call would.
+
+    Args:
+        codec: "jpeg" for a JPEG per frame, "tiles" for TileEncoder.
+        frames: List of BGR frames.
+        fps: Frame rate the keyframe interval is counted in.
+
+    Returns:
+        A dictionary of measurements.
+    """
+    encoder = media_utils.TileEncoder()
+    encoder.enabled = codec == "tiles"
+    decoder = media_utils.TileDecoder()
+    keyframe_every = int(media_utils.KEYFRAME_INTERVAL * fps)
+    sizes, encode_times, decode_times, errors = [], [], [], []
+    for index, frame in enumerate(frames):
+        # Stream time, not wall time, decides when a keyframe is due
+        encoder.last_keyframe = time.monotonic()
+        encoder.keyframe_requested = index % keyframe_every == 0
+
+        started = time.perf_counter()
+        data = encoder.encode(frame, quality)
+        encode_times.append(time.perf_counter() - started)
+        sizes.append(len(data["frame"]) + len(data.get("tiles", ())) * 2)
+
+        # Through msgpack like the wire, so the decoder sees what a client would
+        data = msgpack.unpackb(msgpack.packb(data), raw=False)
+        started = time.perf_counter()
+        image = decoder.decode(data)
+        decode_times.append(time.perf_counter() - started)
+        errors.append(cv2.PSNR(frame, image))
+
+    return {
+        "bytes": statistics.mean(sizes),
+        "kbps": statistics.mean(sizes) * fps / 1024,
+        "encode": statistics.mean(encode_times),
+        "decode": statistics.mean(decode_times),
+        "psnr": statistics.mean(errors),
+    }
+
+
+def bench_codec(args):
+    sequences = ["moving", "still"] + ([args.recording] if args.recording else [])
+    print(
+        f"{'sequence':<12}{'codec':<7}{'bytes/frame':>12}{'KB/s':>8}"
+        f"{'enc ms':>8}{'dec ms':>8}{'PSNR dB':>9}"
+    )
+    for sequence in sequences:
+        frames = list(codec_frames(sequence, args.frames, args.width, args.height))
+        for codec in ("jpeg", "tiles"):
+            r = run_codec(codec, frames, args.quality, args.fps)
+            print(
+                f"{os.path.basename(sequence)[:11]:<12}{codec:<7}{r['bytes']:>12.0f}"
+                f"{r['kbps']:>8.1f}{r['encode'] * 1000:>8.2f}"
+                f"{r['decode'] * 1000:>8.2f}{r['psnr']:>9.1f}"
+            )
+
+
+def encoded_stream(codec, count, width, height, quality=50):
+    """Returns the VIDEO_FRAME data of `count` synthetic frames."""
+    encoder = media_utils.TileEncoder()
+    encoder.enabled = codec == "tiles"
+    stream = []
+    for index in range(count):
+        frame = cv2.resize(media_utils.synthetic_frame(index), (width, height))
+        data = encoder.encode(frame, quality)
+        stream.append(msgpack.unpackb(msgpack.packb(data), raw=False))
+    return stream
+
+
+def run_render(path, stream, fps, render_fps):
+    """
+    Runs received frames through a client's display path as fast as the
+    CPU allows, with the display taking a frame every 1/render_fps seconds
+    of stream time (frames arrive every 1/fps).
+
+    Args:
+        path: "pil" for the former Image.open() of every frame on the Tk
+            thread, "numpy" for TileDecoder, LatestFrame and a PIL view of
+            the newest frame per render tick.
+
+    Returns:
+        A dictionary of measurements. Creating or updating the Tk
+        PhotoImage is not included, as it needs a display.
+    """
+    decoder = media_utils.TileDecoder()
+    frames = media_utils.LatestFrame()
+    shown = 0
+    next_render = 0.0
+    cpu, wall = time.process_time(), time.perf_counter()
+    for index, data in enumerate(stream):
+        if path == "pil":
+            Image.open(io.BytesIO(data["frame"])).convert("RGB")
+            shown += 1
+            continue
+        image = decoder.decode(data)
+        if image is not None:
+            frames.publish(image)
+        if index / fps >= next_render:
+            next_render += 1 / render_fps
+            frame = frames.take()
+            if frame is not None:
+                Image.fromarray(frame)
+                shown += 1
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    return {"fps": len(stream) / wall, "cpu": cpu / len(stream), "shown": shown}
+
+
+def bench_render(args):
+    print(
+        f"{'size':<9}{'codec':<7}{'path':<7}{'fps':>8}{'CPU ms/frame':>14}"
+        f"{'shown':>7}"
+    )
+    for size in args.sizes:
+        width, height = (int(n) for n in size.split("x"))
+        for codec in ("jpeg", "tiles"):
+            stream = encoded_stream(codec, args.frames, width, height)
+            for path in ("pil", "numpy"):
+                if path == "pil" and codec == "tiles":
+                    continue  # The former client only had plain JPEG frames
+                r = run_render(path, stream, args.fps, args.render_fps)
+                print(
+                    f"{size:<9}{codec:<7}{path:<7}{r['fps']:>8.0f}"
+                    f"{r['cpu'] * 1000:>14.2f}{r['shown']:>7}"
+                )
+
+
+def synthetic_speech(seconds, seed=1):
+    """
+    Returns 16-bit samples resembling voiced speech: harmonics of a
+    wandering pitch, shaped into syllables, over a little background noise.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * media_utils.RATE)) / media_utils.RATE
+    pitch = 150 + 50 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / media_utils.RATE
+    voice = sum(np.sin(k * phase) / k for k in range(1, 9))
+    syllables = np.maximum(0, np.sin(2 * np.pi * 4 * t)) ** 2
+    signal = 6000 * voice * syllables + rng.normal(0, 100, t.size)
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def snr(reference, signal):
+    """Returns the signal-to-noise ratio of a reconstruction in dB."""
+    reference = reference.astype(np.float64)
+    noise = np.sum((reference - signal) ** 2)
+    return 10 * np.log10(np.sum(reference**2) / noise) if noise else float("inf")
+
+
+def run_audio_codec(codec, chunks):
+    """Encodes and decodes every chunk with one codec; returns measurements."""
+    encoder = media_utils.AudioEncoder()
+    encoder.on_partner([codec])
+    decoder = media_utils.AudioDecoder()
+    encode_time = decode_time = 0.0
+    size = 0
+    decoded = []
+    for chunk in chunks:
+        started = time.perf_counter()
+        data = encoder.encode(chunk.tobytes())
+        encode_time += time.perf_counter() - started
+        size += len(data["chunk"]) + len(msgpack.packb(data.get("state")))
+        data = msgpack.unpackb(msgpack.packb(data), raw=False)
+        started = time.perf_counter()
+        decoded.append(decoder.decode(data))
+        decode_time += time.perf_counter() - started
+
+    seconds = len(chunks) * media_utils.CHUNK / media_utils.RATE
+    return {
+        "kbps": size / seconds / 1024,
+        "encode": encode_time / len(chunks),
+        "decode": decode_time / len(chunks),
+        "snr": snr(np.concatenate(chunks), np.concatenate(decoded)),
+    }
+
+
+def run_playout(chunks, jitter, loss, base_delay=0.02, seed=1):
+    """
+    Simulates a call over a link adding `base_delay` plus exponentially
+    distributed jitter (mean `jitter` seconds) and losing a `loss` fraction
+    of chunks, and plays the arrivals both on arrival, like the former
+    client, and through a JitterBuffer.
+
+    Returns:
+        A dictionary of {"direct", "buffer"} measurements: one-way latency
+        percentiles and audible glitches (gaps or concealed chunks).
+    """
+    rng = np.random.default_rng(seed)
+    period = media_utils.CHUNK / media_utils.RATE
+    encoder = media_utils.AudioEncoder()
+    encoder.on_partner(media_utils.AUDIO_CODECS)
+    arrivals = []
+    for seq, chunk in enumerate(chunks):
+        data = dict(encoder.encode(chunk.tobytes()), seq=seq, ts=seq * period)
+        if rng.random() >= loss:
+            arrivals.append((data["ts"] + base_delay + rng.exponential(jitter), data))
+    arrivals.sort(key=lambda arrival: arrival[0])
+
+    # Former client: each chunk is written to the sound card as it arrives
+    latencies, glitches, play_end = [], 0, None
+    for arrived, data in arrivals:
+        if play_end is not None and arrived > play_end:
+            glitches += 1
+        start = arrived if play_end is None else max(arrived, play_end)
+        latencies.append(start - data["ts"])
+        play_end = start + period
+    direct = {"latencies": latencies, "glitches": glitches}
+
+    buffer = media_utils.JitterBuffer(period)
+    latencies, pending = [], list(reversed(arrivals))
+    tick, end = arrivals[0][0], arrivals[-1][0]
+    while tick <= end:
+        while pending and pending[-1][0] <= tick:
+            arrived, data = pending.pop()
+            buffer.push(data, now=arrived)
+        position = buffer.position
+        buffer.pop(now=tick)
+        if buffer.position != position:
+            latencies.append(tick - buffer.position)
+        tick += period
+    played = buffer.stats
+    glitches = played["concealed"] + played["skipped"]
+    return {
+        "direct": direct,
+        "buffer": {"latencies": latencies, "glitches": glitches, "stats": played},
+    }
+
+
+def bench_audio(args):
+    samples = synthetic_speech(args.seconds)
+    chunks = np.split(samples, np.arange(0, samples.size, media_utils.CHUNK)[1:])
+    chunks = [chunk for chunk in chunks if chunk.size == media_utils.CHUNK]
+
+    print(f"{'codec':<7}{'KB/s':>8}{'enc us':>9}{'dec us':>9}{'SNR dB':>9}")
+    for codec in reversed(media_utils.AUDIO_CODECS):
+        r = run_audio_codec(codec, chunks)
+        print(
+            f"{codec:<7}{r['kbps']:>8.1f}{r['encode'] * 1e6:>9.0f}"
+            f"{r['decode'] * 1e6:>9.0f}{r['snr']:>9.1f}"
+        )
+
+    minutes = args.seconds / 60
+    print(
+        f"\n{'jitter ms':>9}  {'playout':<9}{'p50 ms':>8}{'p95 ms':>8}"
+        f"{'glitches/min':>14}"
+    )
+    for jitter in args.jitter:
+        r = run_playout(chunks, jitter, args.loss)
+        for playout in ("direct", "buffer"):
+            m = r[playout]
+            print(
+                f"{jitter * 1000:>9.0f}  {playout:<9}"
+                f"{percentile(m['latencies'], 0.5) * 1000:>8.0f}"
+                f"{percentile(m['latencies'], 0.95) * 1000:>8.0f}"
+                f"{m['glitches'] / minutes:>14.1f}"
+            )
+
+
+def bench_priority(args):
+    print(
+        f"{'queues':<10}{'chat p50 ms':>12}{'chat p99 ms':>12}{'msgs':>6}"
+        f"{'file KiB/s':>12}{'video fps':>10}"
+    )
+    for prioritized in (False, True):
+        r = run_priority(prioritized, args.rate, args.seconds)
+        print(
+            f"{'priority' if prioritized else 'fifo':<10}"
+            f"{r['p50'] * 1000:>12.1f}{r['p99'] * 1000:>12.1f}{r['messages']:>6}"
+            f"{r['file_kbps']:>12.0f}{r['video_fps']:>10.1f}"
+        )
+
+
+def cipher_cost(cipher, size, min_seconds=0.5):
+    """
+    Measures one cipher on packets carrying `size` bytes of media data.
+
+    Returns:
+        A tuple of (wire bytes per packet, encode CPU seconds, decode CPU
+        seconds).
+    """
+    data = {"chunk": os.urandom(size)}
+    frame = protocol.encode_packet(protocol.CMD_AUDIO, data, cipher=cipher)
+    payload = memoryview(frame)[protocol.HEADER_LENGTH :]
+    count = max(10, min(20_000, 50_000_000 // size))
+
+    def cpu_per_call(func):
+        rounds = 0
+        start = time.process_time()
+        while True:
+            for _ in range(count):
+                func()
+            rounds += count
+            elapsed = time.process_time() - start
+            if elapsed >= min_seconds:
+                return elapsed / rounds
+
+    encode = cpu_per_call(
+        lambda: protocol.encode_packet(protocol.CMD_AUDIO, data, cipher=cipher)
+    )
+    decode = cpu_per_call(lambda: protocol.decode_payload(payload))
+    return len(frame), encode, decode
+
+
+def bench_cipher(args):
+    print(
+        f"{'payload':>9}  {'cipher':<10}{'wire bytes':>11}{'overhead':>10}"
+        f"{'encode us':>11}{'decode us':>11}{'MB/s':>8}"
+    )
+    for size in args.sizes:
+        plain = len(
+            protocol.encode_packet(protocol.CMD_AUDIO, {"chunk": b"\0" * size}, False)
+        )
+        for name in args.ciphers:
+            wire, encode, decode = cipher_cost(protocol.CIPHERS[name], size)
+            print(
+                f"{size:>9}  {name:<10}{wire:>11}"
+                f"{(wire - plain) / plain * 100:>9.1f}%"
+                f"{encode * 1e6:>11.1f}{decode * 1e6:>11.1f}"
+                f"{size / (encode + decode) / 1e6:>8.0f}"
+            )
+
+
+def bench_bots(args):
+    raise_fd_limit()
+    for engine in args.engine:
+        process, port = start_server(engine)
+        try:
+            cpu_before = cpu_seconds(process.pid)
+            result = bot_client.run_bots(
+                "127.0.0.1", port, **bot_client.bot_options(args)
+            )
+            cpu = cpu_seconds(process.pid) - cpu_before
+            stats = process_stats(process.pid)
+        finally:
+            stop_server(process)
+
+        print(
+            f"\n[{engine}] {args.users} users, {args.rooms} rooms, "
+            f"{args.calls} calls, {args.files} files: server CPU "
+            f"{cpu / result['seconds'] * 100:.0f}%, "
+            f"peak RSS {stats['peak_rss_kb'] / 1024:.1f} MiB"
+        )
+        bot_client.print_report(result)
+
+
+def bench_workers(args):
+    raise_fd_limit()
+    print(
+        f"{'engine':<10}{'workers':>8}{'chat/s':>10}{'p50 ms':>9}"
+        f"{'p99 ms':>9}{'CPU %':>8}{'RSS MiB':>9}"
+    )
+    for engine in args.engine:
+        for workers in args.workers:
+            process, port = start_server(engine, ["--workers", str(workers)])
+            try:
+                time.sleep(1)  # Let every worker bind and join the bus
+                pids = process_tree(process.pid)
+                cpu_before = sum(cpu_seconds(pid) for pid in pids)
+                result = bot_client.run_bots(
+                    "127.0.0.1", port, **bot_client.bot_options(args)
+                )
+                cpu = sum(cpu_seconds(pid) for pid in pids) - cpu_before
+                rss = sum(process_stats(pid)["rss_kb"] for pid in pids)
+            finally:
+                stop_server(process)
+
+            samples = result["latencies"]["chat"]
+            print(
+                f"{engine:<10}{workers:>8}"
+                f"{result['received']['chat'] / result['seconds']:>10.0f}"
+                f"{percentile(samples, 0.5) * 1000:>9.1f}"
+                f"{percentile(samples, 0.99) * 1000:>9.1f}"
+                f"{cpu / result['seconds'] * 100:>8.0f}{rss / 1024:>9.1f}"
+            )
+
+
+def start_cluster(engine, nodes):
+    """
+    Starts a bus.py hub and `nodes` servers joined to it, on free ports.
+
+    Returns:
+        A tuple of (processes, node ports).
+    """
+    hub_port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    hub = subprocess.Popen(
+        [sys.executable, "bus.py", "--listen", f"127.0.0.1:{hub_port}"],
+        cwd=here,
+        stdout=subprocess.DEVNULL,
+    )
+    processes, ports = [hub], []
+    try:
+        time.sleep(0.5)
+        for node_id in range(1, nodes + 1):
+            extra = ["--backplane", f"127.0.0.1:{hub_port}"]
+            process, port = start_server(engine, extra + ["--node-id", str(node_id)])
+            processes.append(process)
+            ports.append(port)
+    except Exception:
+        stop_servers(processes)
+        raise
+    return processes, ports
+
+
+def bench_cluster(args):
+    raise_fd_limit()
+    print(
+        f"{'engine':<10}{'nodes':>6}{'chat/s':>10}{'p50 ms':>9}"
+        f"{'p99 ms':>9}{'CPU %':>8}{'hub %':>7}"
+    )
+    for engine in args.engine:
+        for nodes in args.nodes:
+            processes, ports = start_cluster(engine, nodes)
+            try:
+                time.sleep(0.5)  # Let every node exchange state
+                pids = [process.pid for process in processes]
+                cpu_before = [cpu_seconds(pid) for pid in pids]
+                result = bot_client.run_bots(
+                    "127.0.0.1", ports, **bot_client.bot_options(args)
+                )
+                cpu = [cpu_seconds(pid) - c for pid, c in zip(pids, cpu_before)]
+            finally:
+                stop_servers(processes)
+
+            seconds = result["seconds"]
+            samples = result["latencies"]["chat"]
+            print(
+                f"{engine:<10}{nodes:>6}"
+                f"{result['received']['chat'] / seconds:>10.0f}"
+                f"{percentile(samples, 0.5) * 1000:>9.1f}"
+                f"{percentile(samples, 0.99) * 1000:>9.1f}"
+                f"{sum(cpu) / seconds * 100:>8.0f}{cpu[0] / seconds * 100:>7.0f}"
+            )
+
+
+def log_writes(records, rooms, **options):
+    """
+    Appends chat-sized records to a fresh MessageLog.
+
+    Returns:
+        A tuple of (seconds per append call, records written per second).
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        log = history.MessageLog(directory, **options)
+        data = {"from": "bot0", "text": "x" * 64, "room": "General"}
+        start = time.perf_counter()
+        for i in range(records):
+            log.append([history.room_key(f"Room{i % rooms}")], protocol.CMD_MSG, data)
+        queued = time.perf_counter()
+        log.close()
+        done = time.perf_counter()
+    finally:
+        shutil.rmtree(directory)
+    return (queued - start) / records, records / (done - start)
+
+
+def log_reads(records, rooms, page, count=2000):
+    """
+    Times history pages read from a log of `records` messages.
+
+    Returns:
+        A tuple of (seconds per newest page, seconds per random older page).
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        log = history.MessageLog(directory, fsync=False)
+        data = {"from": "bot0", "text": "x" * 64, "room": "General"}
+        for i in range(records):
+            log.append([history.room_key(f"Room{i % rooms}")], protocol.CMD_MSG, data)
+        log.close()
+
+        log = history.MessageLog(directory)
+        per_room = records // rooms
+        keys = [history.room_key(f"Room{i % rooms}") for i in range(count)]
+        start = time.perf_counter()
+        for key in keys:
+            log.read(key, page)
+        newest = (time.perf_counter() - start) / count
+
+        befores = [random.randrange(page, per_room) for _ in range(count)]
+        start = time.perf_counter()
+        for key, before in zip(keys, befores):
+            log.read(key, page, before)
+        older = (time.perf_counter() - start) / count
+        log.close()
+    finally:
+        shutil.rmtree(directory)
+    return newest, older
+
+
+def bench_history(args):
+    print(f"{'fsync':<16}{'append us':>10}{'records/s':>11}")
+    modes = [
+        ("per record", {"max_batch": 1}),
+        ("batched", {}),
+        ("off", {"fsync": False}),
+    ]
+    for name, options in modes:
+        call, rate = log_writes(args.records, args.rooms, **options)
+        print(f"{name:<16}{call * 1e6:>10.1f}{rate:>11.0f}")
+
+    newest, older = log_reads(args.records, args.rooms, args.page)
+    print(
+        f"\nread {args.page} of {args.records // args.rooms} messages: "
+        f"newest page {newest * 1e6:.0f} us, older page {older * 1e6:.0f} us"
+    )
+
+
+def run_files(engine, store, members, shares, size, downloads):
+    """
+    Shares one file `shares` times in a room of `members` clients, inline
+    or through the file store, then lets `downloads` members fetch it.
+
+    Returns:
+        A dictionary of measurements.
+    """
+    directory = tempfile.mkdtemp()
+    extra = ["--files-dir", directory] if store else ["--no-file-store"]
+    process, port = start_server(engine, extra + ["--no-history"])
+    counter = FrameCounter()
+    sockets = []
+    content = os.urandom(size)
+    digest = hashlib.sha256(content).hexdigest()
+    result = {"engine": engine, "mode": "store" if store else "inline"}
+
+    try:
+        sender = socket.create_connection(("127.0.0.1", port))
+        protocol.send_packet(sender, protocol.CMD_LOGIN, {"username": "sender"})
+        counter.add(sender)
+        for i in range(members):
+            sock = socket.create_connection(("127.0.0.1", port))
+            login = {"username": f"bot{i}", "file_refs": store}
+            protocol.send_packet(sock, protocol.CMD_LOGIN, login)
+            counter.add(sock)
+            sockets.append(sock)
+        counter.wait_idle()
+
+        base = counter.bytes
+        start = time.perf_counter()
+        for i in range(shares):
+            file = {"filename": f"share{i}.bin", "content": content}
+            protocol.send_packet(sender, protocol.CMD_FILE, file)
+        counter.wait_idle()
+        result["share_s"] = counter.last_frame_time - start
+        result["shared_bytes"] = counter.bytes - base
+
+        # Reference holders fetch the file once, not once per share
+        base = counter.bytes
+        if store:
+            for sock in sockets[:downloads]:
+                for offset in range(0, size, protocol.FILE_RANGE):
+                    get = {"hash": digest, "offset": offset}
+                    protocol.send_packet(sock, protocol.CMD_FILE_GET, get)
+            counter.wait_idle()
+        result["download_bytes"] = counter.bytes - base
+        result["peak_rss_kb"] = process_stats(process.pid)["peak_rss_kb"]
+        result["stored_bytes"] = sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(directory)
+            for name in names
+        )
+    finally:
+        counter.stop()
+        for sock in sockets + [sender]:
+            sock.close()
+        stop_server(process)
+        shutil.rmtree(directory)
+
+    return result
+
+
+def bench_files(args):
+    print(
+        f"{'engine':<10}{'mode':<8}{'share s':>9}{'room MiB':>10}"
+        f"{'fetch MiB':>11}{'disk MiB':>10}{'peak MiB':>10}"
+    )
+    mib = 1024 * 1024
+    for engine in args.engine:
+        for store in (False, True):
+            r = run_files(
+                engine, store, args.members, args.shares, args.size, args.downloads
+            )
+            print(
+                f"{engine:<10}{r['mode']:<8}{r['share_s']:>9.2f}"
+                f"{r['shared_bytes'] / mib:>10.1f}{r['download_bytes'] / mib:>11.1f}"
+                f"{r['stored_bytes'] / mib:>10.1f}{r['peak_rss_kb'] / 1024:>10.1f}"
+            )
+
+
+def run_presence(engine, n_clients, deltas, churn):
+    """
+    Logs in n_clients and, once they are all online, lets `churn` more users
+    join and leave one at a time, counting the presence traffic the online
+    clients receive for that churn.
+
+    Each join and leave is paced past the coalescing window so it goes out
+    as its own update: a snapshot repeats the whole roster to every client,
+    so snapshot traffic grows with the square of the users online, while a
+    delta only names the user who changed.
+
+    Args:
+        deltas: Whether the clients ask for CMD_PRESENCE deltas; otherwise
+            they get a full CMD_LIST_UPDATE on every change, as older clients do.
+        churn: Number of extra users that join and leave again.
+
+    Returns:
+        A dictionary of measurements.
+    """
+    process, port = start_server(engine)
+    counter = FrameCounter()
+    sockets = []
+    try:
+        for i in range(n_clients):
+            sock = socket.create_connection(("127.0.0.1", port))
+            login = {"username": f"bot{i}", "presence": deltas}
+            protocol.send_packet(sock, protocol.CMD_LOGIN, login)
+            counter.add(sock)
+            sockets.append(sock)
+        counter.wait_idle()
+        frames, sent = counter.frames, counter.bytes
+
+        pause = protocol.PRESENCE_COALESCE * 2
+        for i in range(churn):
+            sock = socket.create_connection(("127.0.0.1", port))
+            login = {"username": f"churn{i}", "presence": deltas}
+            protocol.send_packet(sock, protocol.CMD_LOGIN, login)
+            time.sleep(pause)
+            sock.close()
+            time.sleep(pause)
+        counter.wait_idle()
+    finally:
+        counter.stop()
+        for sock in sockets:
+            sock.close()
+        stop_server(process)
+
+    return {"frames": counter.frames - frames, "bytes": counter.bytes - sent}
+
+
+def bench_presence(args):
+    raise_fd_limit()
+    print(
+        f"{'engine':<10}{'online':>8}  {'updates':<10}"
+        f"{'frames':>9}{'KiB':>10}{'B/change':>10}"
+    )
+    for n_clients in args.clients:
+        for engine in args.engine:
+            for deltas in (False, True):
+                r = run_presence(engine, n_clients, deltas, args.churn)
+                print(
+                    f"{engine:<10}{n_clients:>8}  "
+                    f"{'deltas' if deltas else 'snapshots':<10}"
+                    f"{r['frames']:>9}{r['bytes'] / 1024:>10.0f}"
+                    f"{r['bytes'] / (2 * args.churn):>10.0f}"
+                )
+
+
+def instrumentation_cost(count=50_000):
+    """
+    Times a chat packet's encode + decode round trip, which passes through
+    four instrumented laps.
+
+    Returns:
+        Seconds per round trip with the active registry.
+    """
+    data = {"from": "bot0", "text": "x" * 64, "room": "General"}
+    cipher = protocol.CIPHERS[protocol.CIPHER_AESGCM]
+    start = time.process_time()
+    for _ in range(count):
+        frame = protocol.encode_packet(protocol.CMD_MSG, data, cipher=cipher)
+        protocol.decode_payload(memoryview(frame)[protocol.HEADER_LENGTH :])
+    return (time.process_time() - start) / count
+
+
+def bench_metrics(args):
+    off = instrumentation_cost()
+    metrics.enable()
+    on = instrumentation_cost()
+
+    print(f"{'metrics':<10}{'us/packet':>10}")
+    print(f"{'off':<10}{off * 1e6:>10.2f}")
+    print(f"{'on':<10}{on * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PyChat benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("load", help="connection count and message rate per engine")
+    p.add_argument("--engine", nargs="+", default=["threaded", "selector"])
+    p.add_argument("--clients", nargs="+", type=int, default=[50, 200, 500])
+    p.add_argument("--senders", type=int, default=10)
+    p.add_argument("--messages", type=int, default=50)
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("broadcast", help="room size against broadcast latency")
+    p.add_argument("--engine", nargs="+", default=["threaded", "selector"])
+    p.add_argument("--sizes", nargs="+", type=int, default=[10, 50, 100, 500])
+    p.add_argument("--rounds", type=int, default=20)
+    p.set_defaults(func=bench_broadcast)
+
+    p = sub.add_parser("recv", help="receive path over payload sizes")
+    p.add_argument("--encrypted", action="store_true")
+    p.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[100, 10_000, 1_000_000, 10_000_000, 50_000_000],
+        help="payload sizes in bytes (the legacy loop takes minutes at 50 MB)",
+    )
+    p.set_defaults(func=bench_recv)
+
+    p = sub.add_parser("oversize", help="frames announcing more than MAX_FRAME_SIZE")
+    p.add_argument("--engine", nargs="+", default=["threaded", "selector"])
+    p.add_argument("--claim", type=int, default=200_000_000, help="bytes claimed")
+    p.add_argument("--sockets", type=int, default=20)
+    p.set_defaults(func=bench_oversize)
+
+    p = sub.add_parser("media", help="concurrent 1:1 calls per server core")
+    p.add_argument("--engine", nargs="+", default=["threaded", "selector"])
+    p.add_argument("--calls", type=int, default=4)
+    p.add_argument("--frames", type=int, default=2000, help="frames per call")
+    p.set_defaults(func=bench_media)
+
+    p = sub.add_parser("calls", help="group call server cost, SFU against full mesh")
+    p.add_argument("--engine", default="selector")
+    p.add_argument("--participants", nargs="+", type=int, default=[2, 4, 8, 16])
+    p.add_argument("--seconds", type=float, default=5)
+    p.set_defaults(func=bench_calls)
+
+    p = sub.add_parser("priority", help="chat latency during a file and video call")
+    p.add_argument("--rate", type=int, default=2_000_000, help="receiver bytes/s")
+    p.add_argument("--seconds", type=float, default=5)
+    p.set_defaults(func=bench_priority)
+
+    p = sub.add_parser("video", help="video over a throttled link, fixed and adaptive")
+    p.add_argument(
+        "--rates",
+        nargs="+",
+        type=int,
+        default=[16_000, 64_000, 512_000],
+        help="receiver bytes/s",
+    )
+    p.add_argument("--modes", nargs="+", default=["fixed", "high", "adaptive"])
+    p.add_argument("--seconds", type=float, default=15)
+    p.set_defaults(func=bench_video)
+
+    p = sub.add_parser("codec", help="video bytes and CPU, per-frame JPEG and tiles")
+    p.add_argument("--recording", help="video file to use as a third sequence")
+    p.add_argument("--frames", type=int, default=150)
+    p.add_argument("--width", type=int, default=320)
+    p.add_argument("--height", type=int, default=240)
+    p.add_argument("--quality", type=int, default=50)
+    p.add_argument("--fps", type=int, default=15)
+    p.set_defaults(func=bench_codec)
+
+    p = sub.add_parser("audio", help="audio codecs and jitter buffer playout")
+    p.add_argument("--seconds", type=float, default=60)
+    p.add_argument(
+        "--jitter",
+        nargs="+",
+        type=float,
+        default=[0.005, 0.02, 0.06],
+        help="mean extra delay per chunk in seconds",
+    )
+    p.add_argument("--loss", type=float, default=0.02, help="fraction of chunks lost")
+    p.set_defaults(func=bench_audio)
+
+    p = sub.add_parser("render", help="received video decode and display cost")
+    p.add_argument("--sizes", nargs="+", default=["320x240", "640x480"])
+    p.add_argument("--frames", type=int, default=300)
+    p.add_argument("--fps", type=int, default=30, help="frames received per second")
+    p.add_argument("--render-fps", type=int, default=30, help="redraws per second")
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("cipher", help="wire size and CPU cost of each cipher")
+    p.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[64, 2048, 6000, 65536, 1_000_000],
+        help="media bytes per packet (chat, audio, video, file chunk, 1 MB)",
+    )
+    p.add_argument("--ciphers", nargs="+", default=list(protocol.CIPHERS))
+    p.set_defaults(func=bench_cipher)
+
+    p = sub.add_parser("bots", help="mixed traffic from headless bot clients")
+    p.add_argument("--engine", nargs="+", default=["threaded", "selector"])
+    bot_client.add_bot_arguments(p)
+    p.set_defaults(func=bench_bots)
+
+    p = sub.add_parser("workers", help="bot traffic against worker process count")
+    p.add_argument("--engine", nargs="+", default=["threaded", "selector"])
+    p.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    bot_client.add_bot_arguments(p)
+    p.set_defaults(func=bench_workers, users=100, rooms=4, seconds=5, chat_rate=2.0)
+
+    p = sub.add_parser("cluster", help="bot traffic spread over cluster nodes")
+    p.add_argument("--engine", nargs="+", default=["threaded", "selector"])
+    p.add_argument("--nodes", nargs="+", type=int, default=[1, 2, 3])
+    bot_client.add_bot_arguments(p)
+    p.set_defaults(func=bench_cluster, users=100, rooms=4, seconds=5, chat_rate=2.0)
+
+    p = sub.add_parser("history", help="message log write and read cost")
+    p.add_argument("--records", type=int, default=20_000)
+    p.add_argument("--rooms", type=int, default=10)
+    p.add_argument("--page", type=int, default=protocol.HISTORY_LIMIT)
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser("files", help="room file shares inline and by reference")
+    p.add_argument("--engine", nargs="+", default=["threaded", "selector"])
+    p.add_argument("--members", type=int, default=20)
+    p.add_argument("--shares", type=int, default=5, help="times the file is shared")
+    p.add_argument("--size", type=int, default=1024 * 1024)
+    p.add_argument("--downloads", type=int, default=5, help="members fetching it")
+    p.set_defaults(func=bench_files)
+
+    p = sub.add_parser("presence", help="presence traffic of join/leave churn")
+    p.add_argument("--engine", nargs="+", default=["threaded", "selector"])
+    p.add_argument("--clients", nargs="+", type=int, default=[100, 500])
+    p.add_argument("--churn", type=int, default=20, help="users joining and leaving")
+    p.set_defaults(func=bench_presence)
+
+    p = sub.add_parser("metrics", help="per-packet cost of instrumentation")
+    p.set_defaults(func=bench_metrics)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,361 @@
+"""
+Headless synthetic chat clients for load generation.
+
+A BotClient speaks the same protocol as ClientApp (login, rooms, chat,
+chunked files, relay-framed video and audio) without a display, camera or
+microphone. Every generated packet carries its send time so receivers can
+record delivery latency.
+
+Usage (against an already running server):
+    python bot_client.py --host 127.0.0.1 --users 50 --rooms 5 --seconds 10
+"""
+
+import argparse
+import os
+import socket
+import threading
+import time
+import uuid
+
+import protocol
+
+BOT_TAG = "bot-ts:"  # Chat text prefix followed by the send time
+
+
+class BotClient:
+    """
+    One synthetic user with its own connection, writer and reader threads.
+
+    Latencies (seconds) are recorded per traffic kind in `latencies`, and
+    received packet and byte counts in `received` and `received_bytes`.
+    """
+
+    def __init__(self, host, port, username, ciphers=protocol.CIPHER_PREFERENCE):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.ciphers = ciphers
+        self.sock = None
+        self.sender = None
+        self.room = "General"
+        self.connected = False
+
+        self.logged_in = threading.Event()
+        self.joined = threading.Event()
+        self.outgoing_files = {}  # Map transfer_id -> AckWindow
+
+        self.lock = threading.Lock()
+        self.latencies = {"chat": [], "file": [], "video": [], "audio": []}
+        self.received = {"chat": 0, "file": 0, "video": 0, "audio": 0}
+        self.received_bytes = {"chat": 0, "file": 0, "video": 0, "audio": 0}
+
+    def connect(self):
+        """Connects, logs in and starts the reader thread."""
+        self.sock = socket.create_connection((self.host, self.port))
+        protocol.limit_unsent(self.sock)
+        self.sender = protocol.PacketSender(self.sock)
+        self.connected = True
+
+        data = {"username": self.username, "presence": True, "relay": True}
+        if self.ciphers:
+            data["ciphers"] = self.ciphers
+        self.sender.send_packet(protocol.CMD_LOGIN, data)
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def join_room(self, room, password=None):
+        """Joins (or creates) a room; `joined` is set once the server confirms."""
+        self.joined.clear()
+        self.room = room
+        self.sender.send_packet(
+            protocol.CMD_ROOM_JOIN, {"room": room, "password": password}
+        )
+
+    def send_chat(self, to="All"):
+        """Sends a timestamped chat message to the room or to one user."""
+        text = f"{BOT_TAG}{time.time()}"
+        return self.sender.send_packet(protocol.CMD_MSG, {"text": text, "to": to})
+
+    def send_file(self, size, target=None):
+        """
+        Streams `size` bytes of synthetic data as a chunked file transfer,
+        waiting on the ack window like ClientApp.stream_file.
+
+        Returns:
+            True if every chunk and the completion were queued.
+        """
+        transfer_id = uuid.uuid4().hex
+        window = protocol.AckWindow()
+        self.outgoing_files[transfer_id] = window
+        chunk = os.urandom(min(size, protocol.FILE_CHUNK_SIZE))
+
+        offer = {
+            "transfer_id": transfer_id,
+            "filename": f"{transfer_id}.bin",
+            "size": size,
+            "to": target,
+        }
+        try:
+            self.sender.send_packet(protocol.CMD_FILE_OFFER, offer, protocol.KIND_FILE)
+
+            offset = 0
+            while offset < size:
+                if not window.wait(offset):
+                    return False
+                part = chunk[: size - offset]
+                data = {
+                    "transfer_id": transfer_id,
+                    "offset": offset,
+                    "data": part,
+                    "ts": time.time(),
+                }
+                if not self.sender.send_packet(
+                    protocol.CMD_FILE_CHUNK, data, protocol.KIND_FILE
+                ):
+                    return False
+                offset += len(part)
+
+            return self.sender.send_packet(
+                protocol.CMD_FILE_COMPLETE,
+                {"transfer_id": transfer_id},
+                protocol.KIND_FILE,
+            )
+        finally:
+            del self.outgoing_files[transfer_id]
+
+    def send_media(self, cmd_type, target, payload):
+        """Sends one relay-framed VIDEO_FRAME or AUDIO_CHUNK to a call partner."""
+        if cmd_type == protocol.CMD_VIDEO:
+            data, kind = {"frame": payload}, protocol.KIND_VIDEO
+        else:
+            data, kind = {"chunk": payload}, protocol.KIND_AUDIO
+        data["ts"] = time.time()
+        frame = protocol.encode_relay_packet(
+            cmd_type, target, data, cipher=self.sender.cipher
+        )
+        return self.sender.send_frame(frame, kind)
+
+    def stream_call(self, target, seconds, video_fps=10, frame_size=6000):
+        """
+        Sends synthetic video at `video_fps` and 16 kHz audio in 1024-sample
+        chunks to `target` for `seconds`, paced like ClientApp's call threads.
+        """
+        frame = os.urandom(frame_size)
+        chunk = os.urandom(2048)
+        audio_interval = 1024 / 16000
+        next_video = next_audio = start = time.monotonic()
+
+        while self.connected and time.monotonic() - start < seconds:
+            now = time.monotonic()
+            if now >= next_video:
+                self.send_media(protocol.CMD_VIDEO, target, frame)
+                next_video += 1 / video_fps
+            if now >= next_audio:
+                self.send_media(protocol.CMD_AUDIO, target, chunk)
+                next_audio += audio_interval
+            time.sleep(max(0, min(next_video, next_audio) - time.monotonic()))
+
+    def record(self, kind, sent_at, size):
+        with self.lock:
+            self.received[kind] += 1
+            self.received_bytes[kind] += size
+            if sent_at is not None:
+                self.latencies[kind].append(time.time() - sent_at)
+
+    def listen(self):
+        """Reads packets until the connection closes, recording arrivals."""
+        try:
+            for packet in protocol.FrameReader(self.sock).packets():
+                self.handle_packet(packet["type"], packet["data"])
+        except (OSError, ValueError) as e:
+            if self.connected:
+                print(f"[BOT ERROR] {self.username}: {e}")
+
+        self.connected = False
+        for window in list(self.outgoing_files.values()):
+            window.cancel()
+        self.sender.close()
+
+    def handle_packet(self, cmd, data):
+        if cmd == protocol.CMD_LOGIN_ACK:
+            self.sender.cipher = protocol.get_cipher(data["cipher"])
+            self.logged_in.set()
+
+        elif cmd == protocol.CMD_ROOM_JOIN:
+            if data["room"] == self.room:
+                self.joined.set()
+
+        elif cmd == protocol.CMD_MSG:
+            text = data["text"]
+            if data["from"] != self.username and text.startswith(BOT_TAG):
+                self.record("chat", float(text[len(BOT_TAG) :]), len(text))
+
+        elif cmd == protocol.CMD_FILE_CHUNK:
+            self.record("file", data.get("ts"), len(data["data"]))
+
+        elif cmd == protocol.CMD_FILE_ACK:
+            window = self.outgoing_files.get(data["transfer_id"])
+            if window:
+                window.ack(data["offset"])
+
+        elif cmd == protocol.CMD_VIDEO:
+            self.record("video", data.get("ts"), len(data["frame"]))
+
+        elif cmd == protocol.CMD_AUDIO:
+            self.record("audio", data.get("ts"), len(data["chunk"]))
+
+    def close(self):
+        self.connected = False
+        if self.sender:
+            self.sender.close()
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+
+def percentile(samples, fraction):
+    """Returns the value below which `fraction` of the samples fall."""
+    ordered = sorted(samples)
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_bots(
+    host,
+    port,
+    users,
+    rooms=1,
+    seconds=10,
+    chat_rate=1.0,
+    calls=0,
+    files=0,
+    file_size=1024 * 1024,
+    video_fps=10,
+    frame_size=6000,
+):
+    """
+    Logs in `users` bots spread over `rooms` rooms and drives mixed traffic.
+
+    Every bot sends `chat_rate` room messages per second; the first `calls`
+    pairs of bots stream video and audio to each other, and the first `files`
+    bots each send one file of `file_size` bytes to their room. `port` may
+    be a list of ports (the nodes of a cluster) to spread the bots over.
+
+    Returns:
+        A dictionary with per-kind latencies, delivery counts and bytes, and
+        the duration of the traffic phase in seconds.
+    """
+    ports = port if isinstance(port, list) else [port]
+    bots = [BotClient(host, ports[i % len(ports)], f"bot{i}") for i in range(users)]
+    try:
+        for bot in bots:
+            bot.connect()
+        for bot in bots:
+            bot.logged_in.wait(30)
+
+        if rooms > 1:
+            for i, bot in enumerate(bots):
+                bot.join_room(f"Room{i % rooms}")
+            for bot in bots:
+                bot.joined.wait(30)
+
+        workers = []
+        for i in range(min(calls, users // 2)):
+            a, b = bots[2 * i], bots[2 * i + 1]
+            for bot, partner in [(a, b), (b, a)]:
+                workers.append(
+                    threading.Thread(
+                        target=bot.stream_call,
+                        args=(partner.username, seconds, video_fps, frame_size),
+                    )
+                )
+        for bot in bots[:files]:
+            workers.append(threading.Thread(target=bot.send_file, args=(file_size,)))
+
+        start = time.monotonic()
+        for worker in workers:
+            worker.start()
+
+        # One pacing thread for all chat so the bot count does not add threads
+        interval = 1 / chat_rate if chat_rate > 0 else None
+        next_send = start
+        while time.monotonic() - start < seconds:
+            if interval:
+                for bot in bots:
+                    if bot.connected:
+                        bot.send_chat()
+                next_send += interval
+            time.sleep(max(0, next_send - time.monotonic()) if interval else 0.1)
+
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - start
+        time.sleep(1)  # Let in-flight deliveries land
+    finally:
+        for bot in bots:
+            bot.close()
+
+    result = {"seconds": elapsed, "latencies": {}, "received": {}, "bytes": {}}
+    for kind in bots[0].latencies:
+        result["latencies"][kind] = [x for bot in bots for x in bot.latencies[kind]]
+        result["received"][kind] = sum(bot.received[kind] for bot in bots)
+        result["bytes"][kind] = sum(bot.received_bytes[kind] for bot in bots)
+    return result
+
+
+def print_report(result):
+    """Prints delivery latency percentiles and throughput per traffic kind."""
+    print(
+        f"{'kind':<7}{'delivered':>10}{'per s':>10}{'MiB/s':>8}"
+        f"{'p50 ms':>9}{'p99 ms':>9}"
+    )
+    seconds = result["seconds"]
+    for kind, samples in result["latencies"].items():
+        count = result["received"][kind]
+        if not count:
+            continue
+        print(
+            f"{kind:<7}{count:>10}{count / seconds:>10.0f}"
+            f"{result['bytes'][kind] / seconds / 2**20:>8.2f}"
+            f"{percentile(samples, 0.5) * 1000:>9.1f}"
+            f"{percentile(samples, 0.99) * 1000:>9.1f}"
+        )
+
+
+def add_bot_arguments(parser):
+    """Adds the traffic options shared by this script and benchmark.py."""
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rooms", type=int, default=1)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument(
+        "--chat-rate", type=float, default=1.0, help="messages/s per user"
+    )
+    parser.add_argument("--calls", type=int, default=0, help="1:1 video calls")
+    parser.add_argument("--files", type=int, default=0, help="concurrent file sends")
+    parser.add_argument("--file-size", type=int, default=1024 * 1024)
+
+
+def bot_options(args):
+    """Returns the run_bots keyword arguments from parsed options."""
+    return {
+        "users": args.users,
+        "rooms": args.rooms,
+        "seconds": args.seconds,
+        "chat_rate": args.chat_rate,
+        "calls": args.calls,
+        "files": args.files,
+        "file_size": args.file_size,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PyChat synthetic clients")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=protocol.PORT)
+    add_bot_arguments(parser)
+    args = parser.parse_args()
+
+    print_report(run_bots(args.host, args.port, **bot_options(args)))
@@ -0,0 +1,337 @@
+"""
+Message backplane connecting server processes and cluster nodes.
+
+Every server (a worker process or a node on another machine) joins the
+backplane under a numeric id and exchanges msgpack messages with the
+others: one id, or BUS_ALL for every other member. Backplane is the
+interface the server uses; two implementations are provided:
+
+- BusClient connects to a BusHub, a small broker listening on a Unix
+  socket (worker processes of one server) or a TCP address (cluster nodes).
+  The hub forwards each frame on the send queue lane it was sent on,
+  without unpacking the message.
+- LocalHub / LocalBackplane pass messages between servers running in one
+  process, for tests and benchmarks that need no sockets or hub process.
+
+Usage (hub for a cluster, then one server per node):
+    python bus.py --listen 127.0.0.1:7100
+    python server.py --port 5555 --backplane 127.0.0.1:7100 --node-id 1
+"""
+
+import abc
+import argparse
+import os
+import queue
+import socket
+import struct
+import threading
+
+import msgpack
+
+import protocol
+from selector_engine import SelectorEngine
+
+BUS_HEADER = struct.Struct(">HB")  # Destination id, lane index
+BUS_ALL = 0xFFFF  # Destination meaning every member except the sender
+MAX_BUS_FRAME = protocol.MAX_FRAME_SIZE + 64 * 1024  # A client frame and its message
+
+
+def encode_bus_frame(destination, message, kind=protocol.KIND_CONTROL):
+    """
+    Serializes a bus message.
+
+    Args:
+        destination: Member id to deliver to, or BUS_ALL.
+        message: Dictionary to send; msgpack-serializable.
+        kind: Send queue lane used by the hub and both members.
+
+    Returns:
+        The length header followed by the bus header and message.
+    """
+    body = msgpack.packb(message)
+    header = BUS_HEADER.pack(destination, protocol.LANES.index(kind))
+    return struct.pack(">I", len(header) + len(body)) + header + body
+
+
+def parse_address(address):
+    """
+    Turns "host:port" into a TCP address tuple; anything else is taken as
+    a Unix socket path. Tuples are returned unchanged.
+    """
+    if isinstance(address, tuple):
+        return address
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def create_socket(address):
+    """Returns an unconnected stream socket of the right family for address."""
+    if isinstance(address, tuple):
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+
+class Backplane(abc.ABC):
+    """
+    Interface between a server and the other members of its cluster.
+
+    Implementations deliver messages from other members to the `handler`
+    given at construction, on a thread of their own. Incoming messages carry
+    the sender's id in "worker". Two messages are generated by the
+    backplane itself: {"op": "gone", "worker": id} when a member leaves,
+    and {"op": "disconnected"} when this member lost the backplane.
+    """
+
+    @abc.abstractmethod
+    def send(self, destination, message, kind=protocol.KIND_CONTROL):
+        """
+        Queues a message for one member or, with BUS_ALL, every other one.
+
+        Returns:
+            False if the message could not be queued.
+        """
+
+    def publish(self, message, kind=protocol.KIND_CONTROL):
+        """Queues a message for every other member."""
+        return self.send(BUS_ALL, message, kind)
+
+    @abc.abstractmethod
+    def close(self):
+        """Leaves the backplane."""
+
+
+class HubPeer:
+    """
+    One member connected to the hub (the session object SelectorEngine
+    expects).
+    """
+
+    def __init__(self, sock, queue):
+        self.sock = sock
+        self.queue = queue
+        self.username = ""  # Member id once it said hello
+        self.worker_id = None
+
+
+class BusHub:
+    """
+    Broker forwarding frames between backplane members.
+
+    Runs a SelectorEngine with itself in place of ChatServer, so peers get
+    the same non-blocking reads and prioritized, bounded send queues as
+    chat clients: media is dropped first if a member falls behind.
+    """
+
+    def __init__(self, address):
+        self.address = parse_address(address)
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.server_socket = create_socket(self.address)
+        if isinstance(self.address, tuple):
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(self.address)
+        self.server_socket.listen()
+
+        self.peers = {}  # Map member id -> HubPeer
+        self.engine = SelectorEngine(self, MAX_BUS_FRAME)
+
+    def serve_forever(self):
+        self.engine.serve_forever()
+
+    def open_session(self, sock):
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return HubPeer(sock, protocol.SendQueue(backlog_timeout=None))
+
+    def handle_payload(self, peer, payload):
+        """Registers a peer on its first frame, then forwards its frames."""
+        destination, lane = BUS_HEADER.unpack_from(payload)
+        if peer.worker_id is None:
+            message = msgpack.unpackb(payload[BUS_HEADER.size :], raw=False)
+            peer.worker_id = message["worker"]
+            peer.username = f"member{peer.worker_id}"
+            self.peers[peer.worker_id] = peer
+            print(f"[BUS] {peer.username} joined")
+
+        frame = struct.pack(">I", len(payload)) + bytes(payload)
+        self.forward(peer, destination, frame, protocol.LANES[lane])
+
+    def forward(self, peer, destination, frame, kind):
+        """Queues a frame for one member or every member but `peer`."""
+        if destination == BUS_ALL:
+            targets = [p for p in self.peers.values() if p is not peer]
+        else:
+            targets = [self.peers[destination]] if destination in self.peers else []
+        for target in targets:
+            if target.queue.put(frame, kind):
+                self.engine.flush(target.sock)
+
+    def disconnect(self, peer):
+        if self.peers.get(peer.worker_id) is peer:
+            del self.peers[peer.worker_id]
+            # Let the others forget this member's users
+            gone = encode_bus_frame(BUS_ALL, {"op": "gone", "worker": peer.worker_id})
+            self.forward(peer, BUS_ALL, gone, protocol.KIND_CONTROL)
+        peer.queue.close()
+        peer.sock.close()
+        print(f"[BUS] {peer.username or 'peer'} disconnected")
+
+
+class BusClient(Backplane):
+    """
+    A member's connection to a BusHub.
+
+    Announces itself (and asks the other members for their state) with a
+    hello broadcast, then passes every message to `handler` on the reader
+    thread.
+    """
+
+    def __init__(self, address, worker_id, handler):
+        self.worker_id = worker_id
+        self.handler = handler
+        address = parse_address(address)
+        self.sock = create_socket(address)
+        self.sock.connect(address)
+        if isinstance(address, tuple):
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sender = protocol.PacketSender(
+            self.sock, protocol.SendQueue(backlog_timeout=None)
+        )
+        self.send(BUS_ALL, {"op": "hello"})
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, destination, message, kind=protocol.KIND_CONTROL):
+        message["worker"] = self.worker_id
+        frame = encode_bus_frame(destination, message, kind)
+        return self.sender.send_frame(frame, kind)
+
+    def run(self):
+        reader = protocol.FrameReader(
+            self.sock, is_encrypted=False, max_size=MAX_BUS_FRAME
+        )
+        try:
+            for payload in reader.payloads():
+                message = msgpack.unpackb(payload[BUS_HEADER.size :], raw=False)
+                self.dispatch(message)
+        except OSError as e:
+            print(f"[BUS ERROR] {e}")
+        print("[BUS] Connection to hub closed")
+        self.sender.close()
+        self.dispatch({"op": "disconnected"})
+
+    def dispatch(self, message):
+        try:
+            self.handler(message)
+        except Exception as e:
+            print(f"[BUS ERROR] {message.get('op')}: {e}")
+
+    def close(self):
+        self.sender.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class LocalHub:
+    """
+    In-process stand-in for BusHub: members are LocalBackplane objects
+    of servers running in the same process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = {}  # Map member id -> LocalBackplane
+
+    def connect(self, worker_id, handler):
+        """Returns a new member's LocalBackplane."""
+        return LocalBackplane(self, worker_id, handler)
+
+    def deliver(self, sender, destination, message):
+        # Serialize like the wire would, so members never share objects
+        data = msgpack.packb(message)
+        with self.lock:
+            if destination == BUS_ALL:
+                targets = [m for m in self.members.values() if m is not sender]
+            else:
+                targets = [self.members.get(destination)]
+        for target in targets:
+            if target:
+                target.inbox.put(data)
+        return True
+
+
+class LocalBackplane(Backplane):
+    """
+    A member of a LocalHub. Messages are handed to `handler` on a delivery
+    thread in the order they were sent; lanes are not needed in-process
+    and `kind` is ignored.
+    """
+
+    def __init__(self, hub, worker_id, handler):
+        self.hub = hub
+        self.worker_id = worker_id
+        self.handler = handler
+        self.inbox = queue.Queue()
+        with hub.lock:
+            hub.members[worker_id] = self
+        self.send(BUS_ALL, {"op": "hello"})
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, destination, message, kind=protocol.KIND_CONTROL):
+        message["worker"] = self.worker_id
+        return self.hub.deliver(self, destination, message)
+
+    def run(self):
+        while True:
+            data = self.inbox.get()
+            if data is None:
+                break
+            message = msgpack.unpackb(data, raw=False)
+            try:
+                self.handler(message)
+            except Exception as e:
+                print(f"[BUS ERROR] {message.get('op')}: {e}")
+
+    def close(self):
+        with self.hub.lock:
+            if self.hub.members.get(self.worker_id) is not self:
+                return
+            del self.hub.members[self.worker_id]
+        self.hub.deliver(self, BUS_ALL, {"op": "gone", "worker": self.worker_id})
+        self.inbox.put(None)
+
+
+def connect_backplane(address, worker_id, handler):
+    """
+    Joins a backplane.
+
+    Args:
+        address: A LocalHub, or the address of a BusHub ("host:port",
+            a (host, port) tuple or a Unix socket path).
+        worker_id: This member's id, unique across the backplane.
+        handler: Called with every message from the other members.
+
+    Returns:
+        A Backplane.
+    """
+    if isinstance(address, LocalHub):
+        return address.connect(worker_id, handler)
+    return BusClient(address, worker_id, handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PyChat backplane hub")
+    parser.add_argument(
+        "--listen",
+        default=f"127.0.0.1:{protocol.PORT + 1}",
+        help="host:port or Unix socket path to accept cluster members on",
+    )
+    args = parser.parse_args()
+
+    hub = BusHub(args.listen)
+    print(f"[BUS] Hub listening on {args.listen}")
+    hub.serve_forever()
@@ -0,0 +1,250 @@
+"""
+Group calls: the server as a selective forwarding unit.
+
+Each room has at most one call. Participants send their media once, as
+relay frames routed to the call, and the server decides what to pass on
+from the plaintext routing header alone (the bodies stay encrypted):
+
+- Audio chunks carry the sender's level. The server keeps a smoothed level
+  per participant, picks the SPEAKERS loudest as the active speakers and
+  forwards audio only from them and the next loudest, AUDIBLE streams at
+  most, leaving out anyone below SPEAKING_LEVEL.
+- Video comes in two layers, full size (LAYER_HIGH) and small (LAYER_LOW).
+  Everyone gets the full-size layer of the speakers and the small layer of
+  the most recent other speakers, up to MAX_VIDEOS streams in all.
+
+So a participant receives at most AUDIBLE audio and MAX_VIDEOS video
+streams however large the call grows. The call state tells each sender
+which of its layers anyone receives, so it sends nothing else.
+"""
+
+import threading
+import time
+
+import protocol
+
+SPEAKERS = 2  # Participants whose full-size video everyone gets
+AUDIBLE = 3  # Loudest participants whose audio is forwarded
+MAX_VIDEOS = 6  # Video streams forwarded to a participant at most
+LEVEL_ATTACK = 0.5  # Weight of a louder chunk's level in the average
+LEVEL_DECAY = 0.1  # Weight of a quieter one, so pauses between words are bridged
+SPEAKING_LEVEL = -50  # dBov a participant must pass to become a speaker
+SWITCH_MARGIN = 6  # dB by which a newcomer must beat the speaker it replaces
+SPEAKER_HOLD = 1.0  # Seconds a speaker keeps its place at least
+SILENT_AFTER = 0.5  # Seconds without audio after which a level counts as silence
+
+
+class Participant:
+    """One session in a call, with its codecs and smoothed audio level."""
+
+    def __init__(self, session, codecs):
+        self.session = session
+        self.codecs = codecs
+        self.level = protocol.SILENCE_LEVEL  # Smoothed dBov
+        self.heard = 0.0  # Time of the last audio chunk
+        self.promoted = 0.0  # Time it last became a speaker
+
+
+class GroupCall:
+    """
+    The call of one room.
+
+    Membership and the forwarding sets are guarded by the call's own lock;
+    forward targets are returned as lists safe to use unlocked.
+    """
+
+    def __init__(self, room):
+        self.room = room
+        self.lock = threading.Lock()
+        self.notify_lock = threading.Lock()  # Keeps CMD_CALL_STATE in order
+        self.participants = {}  # Map username -> Participant, in joining order
+        self.recent = []  # Usernames, most recent speaker first
+        self.speakers = []  # Usernames whose full-size video is forwarded
+        self.videos = []  # Other usernames whose small video is forwarded
+        self.audible = set()  # Usernames whose audio is forwarded
+
+    def join(self, session, codecs):
+        with self.lock:
+            if session.username not in self.participants:
+                self.recent.append(session.username)
+            self.participants[session.username] = Participant(session, codecs)
+            self.select(time.monotonic())
+
+    def leave(self, session):
+        """
+        Removes a session.
+
+        Returns:
+            True if it was taking part in the call.
+        """
+        with self.lock:
+            participant = self.participants.get(session.username)
+            if participant is None or participant.session is not session:
+                return False
+            del self.participants[session.username]
+            self.recent.remove(session.username)
+            self.select(time.monotonic(), force=True)
+            return True
+
+    def __len__(self):
+        return len(self.participants)
+
+    def on_audio(self, username, level, now=None):
+        """
+        Takes the level of one audio chunk and picks the speakers again.
+
+        Returns:
+            True if the speakers (or the streams forwarded) changed.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            participant = self.participants.get(username)
+            if participant is None:
+                return False
+            level = max(protocol.SILENCE_LEVEL, min(0, level))
+            weight = LEVEL_ATTACK if level > participant.level else LEVEL_DECAY
+            participant.level += weight * (level - participant.level)
+            participant.heard = now
+            return self.select(now)
+
+    def current_level(self, participant, now):
+        if now - participant.heard > SILENT_AFTER:
+            return protocol.SILENCE_LEVEL  # Muted, or no microphone
+        return participant.level
+
+    def select(self, now, force=False):
+        """
+        Recomputes the speakers and forwarded streams. Call with the lock
+        held.
+
+        A participant above SPEAKING_LEVEL takes a free speaker place, or
+        replaces the quietest speaker that has held its place for
+        SPEAKER_HOLD and is SWITCH_MARGIN quieter.
+
+        Returns:
+            True if anything changed.
+        """
+        levels = {
+            name: self.current_level(participant, now)
+            for name, participant in self.participants.items()
+        }
+        speakers = [name for name in self.speakers if name in levels]
+        loudest = sorted(levels, key=levels.get, reverse=True)
+        for name in loudest:
+            if name in speakers or levels[name] < SPEAKING_LEVEL:
+                continue
+            if len(speakers) < min(SPEAKERS, len(levels)):
+                speakers.append(name)
+                continue
+            quietest = min(speakers, key=levels.get)
+            held = now - self.participants[quietest].promoted
+            if held >= SPEAKER_HOLD and levels[name] >= (
+                levels[quietest] + SWITCH_MARGIN
+            ):
+                speakers[speakers.index(quietest)] = name
+        # Fill free places (a call just started) in joining order
+        for name in self.participants:
+            if len(speakers) >= min(SPEAKERS, len(levels)):
+                break
+            if name not in speakers:
+                speakers.append(name)
+
+        for name in speakers:
+            if name not in self.speakers:
+                self.participants[name].promoted = now
+                self.recent.remove(name)
+                self.recent.insert(0, name)
+        videos = [name for name in self.recent if name not in speakers]
+        videos = videos[: max(0, MAX_VIDEOS - len(speakers))]
+        # Speakers stay audible while quiet, so their pauses are not cut
+        audible = speakers[:AUDIBLE]
+        for name in loudest:
+            if len(audible) >= AUDIBLE or levels[name] < SPEAKING_LEVEL:
+                break
+            if name not in audible:
+                audible.append(name)
+
+        changed = speakers != self.speakers or videos != self.videos
+        self.speakers, self.videos, self.audible = speakers, videos, set(audible)
+        return changed or force
+
+    def audio_targets(self, sender):
+        """Returns the sessions an audio chunk from `sender` goes to."""
+        with self.lock:
+            if sender not in self.audible:
+                return []
+            return self.others(sender)
+
+    def video_targets(self, sender, layer):
+        """Returns the sessions a video frame of `sender`'s layer goes to."""
+        with self.lock:
+            if layer == protocol.LAYER_HIGH:
+                forwarded = sender in self.speakers
+            else:
+                forwarded = sender in self.videos
+            return self.others(sender) if forwarded else []
+
+    def others(self, sender):
+        return [
+            participant.session
+            for name, participant in self.participants.items()
+            if name != sender
+        ]
+
+    def state(self):
+        """Returns the CMD_CALL_STATE data and the sessions it goes to."""
+        with self.lock:
+            participants = list(self.participants.values())
+            # Codecs everyone decodes, in the first participant's order
+            codecs = participants[0].codecs if participants else []
+            for participant in participants[1:]:
+                codecs = [c for c in codecs if c in participant.codecs]
+            data = {
+                "room": self.room,
+                "participants": list(self.participants),
+                "speakers": list(self.speakers),
+                "videos": list(self.videos),
+                "codecs": codecs or ["pcm"],
+            }
+        return data, [participant.session for participant in participants]
+
+
+class CallRegistry:
+    """
+    Calls by room name. The registry lock is only held to look up, create
+    or drop a call.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # Map room name -> GroupCall
+
+    def get(self, room):
+        with self.lock:
+            return self.calls.get(room)
+
+    def join(self, session, codecs):
+        """Adds a session to the call of its current room and returns the call."""
+        with self.lock:
+            call = self.calls.get(session.current_room)
+            if call is None:
+                call = self.calls[session.current_room] = GroupCall(
+                    session.current_room
+                )
+            call.join(session, codecs)
+        return call
+
+    def leave(self, session, room):
+        """
+        Removes a session from a room's call, dropping the call once empty.
+
+        Returns:
+            The call if the session was in it, else None.
+        """
+        with self.lock:
+            call = self.calls.get(room)
+            if call is None or not call.leave(session):
+                return None
+            if not len(call):
+                del self.calls[room]
+        return call
@@ -1,14 +1,90 @@
 import tkinter as tk
 from tkinter import scrolledtext, simpledialog, filedialog, messagebox
 from PIL import Image, ImageTk
+import hashlib
+import math
+import queue
 import socket
 import threading
 import os
 import time
-import io
+import uuid
 
 import protocol
-from media_utils import VideoCamera, AudioRecorder, AudioPlayer
+from media_utils import (
+    VideoCamera,
+    AUDIO_CODECS,
+    AudioEncoder,
+    AudioRecorder,
+    AudioPlayer,
+    CALL_LAYERS,
+    CHUNK,
+    CallReceiver,
+    JitterBuffer,
+    LatestFrame,
+    TileDecoder,
+    TileEncoder,
+    VideoController,
+    VideoFeedback,
+    audio_level,
+)
+
+RECONNECT_ATTEMPTS = 6  # Tries, 1 s apart and doubling, before giving up
+VIDEO_QUEUE = 8  # Received frames waiting to be decoded before the oldest is dropped
+FILE_QUEUE = 64  # File packets waiting to be written before the reader waits
+RENDER_INTERVAL = 33  # Milliseconds between redraws of the call video
+
+
+class Stage:
+    """
+    A worker thread fed through a bounded queue, so the thread reading the
+    socket never waits on the work itself (decoding video, disk writes).
+
+    Args:
+        name: Used in log lines.
+        handler: Called on the worker thread with every queued item.
+        maxsize: Items held at most.
+        drop_oldest: When full, drop the oldest item instead of making
+            put() wait; for media, where newer items replace older ones.
+    """
+
+    def __init__(self, name, handler, maxsize, drop_oldest=False):
+        self.name = name
+        self.handler = handler
+        self.queue = queue.Queue(maxsize)
+        self.drop_oldest = drop_oldest
+        self.dropped = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def put(self, item):
+        if not self.drop_oldest:
+            self.queue.put(item)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def join(self):
+        """Waits until every queued item has been handled."""
+        self.queue.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.handler(*item)
+            except Exception as e:
+                print(f"[{self.name.upper()} ERROR] {e}")
+            finally:
+                self.queue.task_done()
 
 
 class ClientApp:
@@ -24,10 +100,20 @@ class ClientApp:
 
         # Network and user state
         self.client_socket = None
+        self.host = ""
         self.username = ""
         self.is_connected = False
         self.target_user = "All"  # Default to broadcast
-        self.send_lock = threading.Lock()
+        self.sender = None  # Prioritized outbound queue and writer thread
+        self.presence_version = None  # Version of the user/room lists shown
+
+        # Chunked file transfers in progress
+        self.outgoing_files = {}  # Map transfer_id -> (offer, AckWindow)
+        self.incoming_files = {}  # Map transfer_id -> open download
+
+        # Files in the server's store
+        self.file_refs = {}  # Map hash -> FILE_REF, for files shown in the chat
+        self.downloads = {}  # Map hash -> ranged download in progress
 
         # Call state
         self.in_call = False
@@ -36,6 +122,29 @@ class ClientApp:
         self.last_call_partner = None
         self.last_call_end_time = 0
         self.sending_video = False
+        self.video_controller = None  # Rate control of the video being sent
+        self.video_encoder = None  # Codec of the video being sent
+        self.video_feedback = VideoFeedback()  # Reports on the video received
+        self.video_decoder = TileDecoder()
+        self.audio_encoder = None  # Codec of the audio being sent
+        self.audio_buffer = None  # JitterBuffer of the audio received
+        self.video_frames = LatestFrame()  # Newest decoded frame, for display
+        self.video_photo = None  # PhotoImage of the call window, reused
+
+        # Group call state (the call of the current room)
+        self.call_receiver = None  # CallReceiver while in a group call
+        self.call_state = {}  # Latest CMD_CALL_STATE
+        self.call_encoders = None  # TileEncoder per video layer being sent
+        self.call_labels = {}  # Map participant -> video Label
+        self.call_photos = {}  # Map participant -> PhotoImage, reused
+
+        # The listening thread hands slow work to these; audio goes to the
+        # jitter buffer, which a playback thread drains
+        self.video_stage = Stage("video", self.decode_video, VIDEO_QUEUE, True)
+        self.file_stage = Stage("file", self.handle_file_packet, FILE_QUEUE)
+        self.call_video_stage = Stage(
+            "call video", self.decode_call_video, VIDEO_QUEUE, True
+        )
 
         self.setup_ui()
 
@@ -75,6 +184,13 @@ class ClientApp:
             side=tk.LEFT
         )
 
+        tk.Button(
+            tool_frame,
+            text="Group Call",
+            command=self.start_group_call,
+            bg="#009688",
+            fg="white",
+        ).pack(side=tk.RIGHT, padx=2)
         tk.Button(
             tool_frame,
             text="Video Call",
@@ -106,35 +222,86 @@ class ClientApp:
 
     def connect_to_server(self):
         """Prompts for server IP and username, then establishes connection."""
-        host = simpledialog.askstring(
+        self.host = simpledialog.askstring(
             "Server", "Enter Server IP:", initialvalue="127.0.0.1"
         )
-        if not host:
-            host = "127.0.0.1"
+        if not self.host:
+            self.host = "127.0.0.1"
 
         self.username = simpledialog.askstring("Login", "Choose Username:")
         if not self.username:
             self.root.quit()
 
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((host, protocol.PORT))
-
-            with self.send_lock:
-                protocol.send_packet(
-                    self.client_socket, protocol.CMD_LOGIN, {"username": self.username}
-                )
-
-            self.is_connected = True
-
-            # Start listening thread
-            threading.Thread(target=self.listen_server, daemon=True).start()
+            self.open_connection()
             self.root.title(f"PyChat Pro - Logged in as {self.username}")
 
         except Exception as e:
             messagebox.showerror("Error", f"Could not connect: {e}")
             self.root.quit()
 
+    def open_connection(self):
+        """Connects and logs in, then starts the listening thread."""
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.client_socket.connect((self.host, protocol.PORT))
+        protocol.limit_unsent(self.client_socket)
+
+        self.sender = protocol.PacketSender(self.client_socket)
+        # Fernet until the server acks one of the offered ciphers
+        self.sender.send_packet(
+            protocol.CMD_LOGIN,
+            {
+                "username": self.username,
+                "ciphers": protocol.CIPHER_PREFERENCE,
+                "presence": True,
+                "file_refs": True,
+                "relay": True,
+            },
+        )
+
+        self.is_connected = True
+
+        # Start listening thread
+        threading.Thread(target=self.listen_server, daemon=True).start()
+
+    def reconnect(self):
+        """
+        Connects again after the connection dropped and resumes unfinished
+        transfers: uploads continue from the offset the server acknowledges
+        and downloads from the bytes already on disk.
+
+        Returns:
+            True once connected, False if every attempt failed.
+        """
+        self.file_stage.join()  # The listening thread queues no more
+
+        # Relayed downloads cannot be resumed; the sender has to send again
+        for transfer_id in list(self.incoming_files):
+            incoming = self.finish_incoming_file(transfer_id, aborted=True)
+            self.append_message(
+                "text", "System", f"Transfer of {incoming['filename']} interrupted"
+            )
+
+        for attempt in range(RECONNECT_ATTEMPTS):
+            time.sleep(2**attempt)
+            try:
+                self.open_connection()
+                break
+            except OSError as e:
+                print(f"[RECONNECT] Attempt {attempt + 1} failed: {e}")
+        else:
+            return False
+
+        print("[RECONNECT] Connected again")
+        for offer, _ in list(self.outgoing_files.values()):
+            self.sender.send_packet(
+                protocol.CMD_FILE_OFFER, dict(offer, resume=True), protocol.KIND_FILE
+            )
+        for digest, download in list(self.downloads.items()):
+            download["requested"] = download["received"]
+            self.request_file_ranges(digest)
+        return True
+
     def select_user(self, event):
         """Handles user selection from the listbox for private messaging."""
         selection = self.user_listbox.curselection()
@@ -147,6 +314,7 @@ class ClientApp:
             self.msg_entry.config(bg="#ffffcc")  # Yellow tint for private mode
             self.root.title(f"PyChat Pro - {self.username} → Private Chat with {user}")
             print(f"Private target set to: {user}")
+            self.sender.send_packet(protocol.CMD_HISTORY, {"with": user})
         else:
             self.target_user = "All"
             self.msg_entry.config(bg="white")
@@ -158,17 +326,12 @@ class ClientApp:
         if not text:
             return
 
-        with self.send_lock:
-            if self.target_user == "All":
-                protocol.send_packet(
-                    self.client_socket, protocol.CMD_MSG, {"text": text, "to": "All"}
-                )
-            else:
-                protocol.send_packet(
-                    self.client_socket,
-                    protocol.CMD_MSG,
-                    {"text": text, "to": self.target_user},
-                )
+        if self.target_user == "All":
+            self.sender.send_packet(protocol.CMD_MSG, {"text": text, "to": "All"})
+        else:
+            self.sender.send_packet(
+                protocol.CMD_MSG, {"text": text, "to": self.target_user}
+            )
 
         self.msg_entry.delete(0, tk.END)
 
@@ -179,12 +342,9 @@ class ClientApp:
             password = simpledialog.askstring(
                 "Password", "Set Room Password (optional):", show="*"
             )
-            with self.send_lock:
-                protocol.send_packet(
-                    self.client_socket,
-                    protocol.CMD_ROOM_JOIN,
-                    {"room": room_name, "password": password},
-                )
+            self.sender.send_packet(
+                protocol.CMD_ROOM_JOIN, {"room": room_name, "password": password}
+            )
 
     def join_room(self, event):
         """Handles joining an existing room from the listbox."""
@@ -194,17 +354,72 @@ class ClientApp:
             password = simpledialog.askstring(
                 "Password", f"Enter Password for {room} (if any):", show="*"
             )
-            with self.send_lock:
-                protocol.send_packet(
-                    self.client_socket,
-                    protocol.CMD_ROOM_JOIN,
-                    {"room": room, "password": password},
-                )
+            self.sender.send_packet(
+                protocol.CMD_ROOM_JOIN, {"room": room, "password": password}
+            )
+
+    def apply_presence(self, delta):
+        """
+        Applies a presence batch to the user and room lists.
 
-    def append_message(self, msg_type, sender, content):
-        """Appends a message to the chat area with appropriate formatting."""
+        A batch that does not start at the lists' version discards that
+        version and asks the server for a fresh snapshot.
+        """
+        if self.presence_version is None:
+            return  # Waiting for a snapshot
+        if delta["since"] != self.presence_version:
+            self.presence_version = None
+            self.sender.send_packet(protocol.CMD_LIST_UPDATE, {})
+            return
+        self.presence_version = delta["version"]
+
+        users = self.user_listbox.get(1, tk.END)
+        for name in delta[protocol.PRESENCE_USER_LEFT]:
+            if name in users:
+                self.user_listbox.delete(users.index(name) + 1)
+                users = self.user_listbox.get(1, tk.END)
+        for name in delta[protocol.PRESENCE_USER_JOINED]:
+            if name not in users:
+                self.user_listbox.insert(tk.END, name)
+
+        rooms = self.room_listbox.get(0, tk.END)
+        for name in delta[protocol.PRESENCE_ROOM_ADDED]:
+            if name not in rooms:
+                self.room_listbox.insert(tk.END, name)
+
+    def show_history(self, data):
+        """Shows a page of room or private conversation history."""
+        messages = data["messages"]
+        if not messages:
+            return
+        title = data.get("room") or f"your chat with {data.get('with')}"
+        self.chat_area.config(state="normal")
+        self.chat_area.insert(tk.END, f"--- Earlier in {title} ---\n", "history")
+        self.chat_area.tag_config("history", foreground="gray")
+
+        for message in messages:
+            fields = message["data"]
+            sender = "Me" if fields["from"] == self.username else fields["from"]
+            if message["type"] == protocol.CMD_FILE_REF:
+                self.show_file_ref(fields, message["ts"])
+                continue
+            if message["type"] == protocol.CMD_FILE:
+                msg_type, content = "file", fields["filename"]
+            else:
+                msg_type = "private" if fields.get("is_private") else "text"
+                content = fields["text"]
+            self.append_message(msg_type, sender, content, message["ts"])
+
+    def append_message(self, msg_type, sender, content, sent_at=None, link=None):
+        """
+        Appends a message to the chat area with appropriate formatting.
+
+        Args:
+            sent_at: Send time for the timestamp; defaults to now.
+            link: Extra text tag for a file message, for click bindings.
+        """
         self.chat_area.config(state="normal")
-        timestamp = time.strftime("%H:%M")
+        timestamp = time.strftime("%H:%M", time.localtime(sent_at))
 
         if msg_type == "text":
             self.chat_area.insert(tk.END, f"[{timestamp}] {sender}: {content}\n")
@@ -214,48 +429,269 @@ class ClientApp:
             )
             self.chat_area.tag_config("private", foreground="red")
         elif msg_type == "file":
+            tags = ("file", link) if link else "file"
             self.chat_area.insert(
-                tk.END, f"[{timestamp}] {sender} sent a file: {content}\n", "file"
+                tk.END, f"[{timestamp}] {sender} sent a file: {content}\n", tags
             )
             self.chat_area.tag_config("file", foreground="blue")
 
         self.chat_area.see(tk.END)
         self.chat_area.config(state="disabled")
 
+    def post_message(self, msg_type, sender, content):
+        """Appends a message from a background thread, on the Tk main loop."""
+        self.root.after(0, lambda: self.append_message(msg_type, sender, content))
+
+    def show_file_ref(self, ref, sent_at=None):
+        """Shows a stored file as a link that downloads it when clicked."""
+        digest = ref["hash"]
+        self.file_refs[digest] = ref
+        link = f"ref-{digest}"
+        sender = "Me" if ref["from"] == self.username else ref["from"]
+        size_kb = max(1, ref["size"] // 1024)
+        self.append_message(
+            "file",
+            sender,
+            f"{ref['filename']} ({size_kb} KB, click to download)",
+            sent_at,
+            link,
+        )
+        self.chat_area.tag_bind(
+            link, "<Button-1>", lambda event: self.download_file(digest)
+        )
+
+    def download_file(self, digest):
+        """
+        Downloads a stored file with ranged FILE_GET requests, continuing a
+        partial download of the same hash left in downloads/ by an earlier
+        attempt.
+        """
+        ref = self.file_refs.get(digest)
+        if not ref or digest in self.downloads:
+            return
+        os.makedirs("downloads", exist_ok=True)
+        name = os.path.basename(ref["filename"])
+        path = os.path.join("downloads", f"received_{name}")
+        # Named after the content, so only the same file is ever resumed
+        partial = os.path.join("downloads", f"{digest}.part")
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        offset = min(offset, ref["size"])
+
+        self.downloads[digest] = {
+            "ref": ref,
+            "path": path,
+            "partial": partial,
+            "file": open(partial, "r+b" if offset else "wb"),
+            "received": offset,
+            "requested": offset,
+        }
+        if offset:
+            print(f"[FILE] Resuming {ref['filename']} at {offset} bytes")
+        self.request_file_ranges(digest)
+
+    def request_file_ranges(self, digest):
+        """Keeps up to two FILE_RANGE requests of a download outstanding."""
+        download = self.downloads[digest]
+        size = download["ref"]["size"]
+        if download["received"] >= size:
+            self.finish_download(digest)
+            return
+        while (
+            download["requested"] < size
+            and download["requested"] - download["received"] < 2 * protocol.FILE_RANGE
+        ):
+            request = {
+                "hash": digest,
+                "offset": download["requested"],
+                "length": protocol.FILE_RANGE,
+            }
+            if "node" in download["ref"]:
+                request["node"] = download["ref"]["node"]  # Server holding it
+            self.sender.send_packet(protocol.CMD_FILE_GET, request)
+            download["requested"] += protocol.FILE_RANGE
+
+    def save_file_data(self, data):
+        """Writes one FILE_DATA chunk of a download and asks for more."""
+        digest = data["hash"]
+        download = self.downloads.get(digest)
+        if not download:
+            return
+        if data.get("missing"):
+            download["file"].close()
+            del self.downloads[digest]
+            name = download["ref"]["filename"]
+            self.post_message("text", "System", f"{name} is no longer on the server")
+            return
+
+        if data["offset"] != download["received"]:
+            return  # Answer to a request made before a re-request
+        if not protocol.chunk_intact(data):
+            download["requested"] = download["received"]  # Ask for it again
+            self.request_file_ranges(digest)
+            return
+
+        download["file"].seek(data["offset"])
+        download["file"].write(data["data"])
+        end = data["offset"] + len(data["data"])
+        download["received"] = max(download["received"], end)
+        self.request_file_ranges(digest)
+
+    def finish_download(self, digest):
+        """Checks a finished download against its hash and moves it in place."""
+        download = self.downloads.pop(digest)
+        download["file"].close()
+        partial = download["partial"]
+        name = download["ref"]["filename"]
+
+        hasher = hashlib.sha256()
+        with open(partial, "rb") as f:
+            for chunk in iter(lambda: f.read(protocol.FILE_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        if hasher.hexdigest() != digest:
+            os.remove(partial)
+            self.post_message("text", "System", f"Download of {name} was corrupted")
+            return
+        os.replace(partial, download["path"])
+        self.post_message("text", "System", f"{name} saved in downloads/")
+
     def send_file(self):
-        """Opens file dialog and sends selected file."""
+        """Opens file dialog and streams the selected file in the background."""
         filepath = filedialog.askopenfilename()
         if not filepath:
             return
 
+        target = self.target_user if self.target_user != "All" else None
+        threading.Thread(
+            target=self.stream_file, args=(filepath, target), daemon=True
+        ).start()
+
+    def stream_file(self, filepath, target):
+        """
+        Sends a file as an offer, window-limited chunks read from disk, and a
+        completion marker on the file lane, so only a few chunks are ever held
+        in memory and chat, audio and video are always written first.
+        """
         filename = os.path.basename(filepath)
         file_size = os.path.getsize(filepath)
+        transfer_id = uuid.uuid4().hex
+        window = protocol.AckWindow()
 
+        # The hash lets the server store the file, or skip it if stored already
+        hasher = hashlib.sha256()
         with open(filepath, "rb") as f:
-            file_bytes = f.read()
+            for chunk in iter(lambda: f.read(protocol.FILE_CHUNK_SIZE), b""):
+                hasher.update(chunk)
 
-        data = {
+        offer = {
+            "transfer_id": transfer_id,
             "filename": filename,
             "size": file_size,
-            "content": file_bytes,
-            "to": self.target_user if self.target_user != "All" else None,
+            "to": target,
+            "hash": hasher.hexdigest(),
         }
+        self.outgoing_files[transfer_id] = (offer, window)
 
-        with self.send_lock:
-            protocol.send_packet(self.client_socket, protocol.CMD_FILE, data)
-        self.append_message("text", "Me", f"Sent file: {filename}")
+        try:
+            self.sender.send_packet(protocol.CMD_FILE_OFFER, offer, protocol.KIND_FILE)
+
+            offset = 0
+            completed = False  # Sent FILE_COMPLETE, waiting for the last ack
+            with open(filepath, "rb") as f:
+                while True:
+                    if not window.wait(offset, drain=completed):
+                        if not window.cancelled and not self.is_connected:
+                            continue  # Resumed once reconnected
+                        print(f"[FILE] Transfer of {filename} stalled or cancelled")
+                        return
+                    restart = window.take_restart()
+                    if restart is not None:
+                        # Reconnected, or the server dropped a bad chunk
+                        offset, completed = restart, False
+                        f.seek(offset)
+                    if window.finished or completed:
+                        break  # In the server's store, or fully acknowledged
+
+                    chunk = f.read(protocol.FILE_CHUNK_SIZE)
+                    if not chunk:
+                        self.sender.send_packet(
+                            protocol.CMD_FILE_COMPLETE,
+                            {"transfer_id": transfer_id},
+                            protocol.KIND_FILE,
+                        )
+                        completed = True
+                        continue
+
+                    data = {
+                        "transfer_id": transfer_id,
+                        "offset": offset,
+                        "data": chunk,
+                        "crc": protocol.chunk_checksum(chunk),
+                    }
+                    # A chunk lost with the connection is sent again on resume
+                    self.sender.send_packet(
+                        protocol.CMD_FILE_CHUNK, data, protocol.KIND_FILE
+                    )
+                    offset += len(chunk)
+
+            self.root.after(
+                0, lambda: self.append_message("text", "Me", f"Sent file: {filename}")
+            )
+        except OSError as e:
+            print(f"[FILE ERROR] {e}")
+        finally:
+            del self.outgoing_files[transfer_id]
 
-    def save_incoming_file(self, filename, content):
-        """Saves received file content to the downloads directory."""
+    def open_incoming_file(self, transfer_id, filename, sender):
+        """
+        Creates the partial download file for an offered transfer; it gets
+        its real name only once the transfer is complete.
+        """
         if not os.path.exists("downloads"):
             os.makedirs("downloads")
-        save_path = os.path.join("downloads", f"received_{filename}")
-        with open(save_path, "wb") as f:
-            f.write(content)
-        return save_path
+        save_path = os.path.join("downloads", f"received_{os.path.basename(filename)}")
+        # Named after the transfer so it never clobbers another partial
+        partial = os.path.join("downloads", f"{os.path.basename(transfer_id)}.part")
+        self.incoming_files[transfer_id] = {
+            "file": open(partial, "wb"),
+            "path": save_path,
+            "partial": partial,
+            "filename": filename,
+            "from": sender,
+            "corrupt": False,
+        }
+
+    def save_incoming_file(self, transfer_id, chunk):
+        """Writes one received chunk at its offset in the partial file."""
+        incoming = self.incoming_files.get(transfer_id)
+        if incoming:
+            if not protocol.chunk_intact(chunk):
+                incoming["corrupt"] = True
+            incoming["file"].seek(chunk["offset"])
+            incoming["file"].write(chunk["data"])
+
+    def finish_incoming_file(self, transfer_id, aborted=False):
+        """
+        Closes a download and renames it into place, or deletes it if it was
+        aborted or a chunk failed its checksum.
+
+        Returns:
+            The incoming transfer's state, or None if it was unknown.
+        """
+        incoming = self.incoming_files.pop(transfer_id, None)
+        if incoming:
+            incoming["file"].close()
+            partial = incoming["partial"]
+            if aborted or incoming["corrupt"]:
+                os.remove(partial)
+            else:
+                os.replace(partial, incoming["path"])
+        return incoming
 
     def start_call(self, mode="video"):
         """Initiates a video or voice call with the selected user."""
+        if self.call_receiver:
+            messagebox.showwarning("Call", "Leave the group call first.")
+            return
         if self.target_user == "All":
             messagebox.showwarning("Call", "Select a user from the list to call.")
             return
@@ -293,6 +729,9 @@ class ClientApp:
                 self.call_window, text="Waiting for video...", bg="black", fg="white"
             )
             self.video_label.pack(fill=tk.BOTH, expand=True)
+            self.video_photo = None
+            self.video_frames.take()  # Drop a frame left from the last call
+            self.render_video(self.call_window)
         else:
             self.video_label = tk.Label(
                 self.call_window,
@@ -318,12 +757,9 @@ class ClientApp:
         if self.call_partner:
             if self.client_socket:
                 try:
-                    with self.send_lock:
-                        protocol.send_packet(
-                            self.client_socket,
-                            protocol.CMD_END_CALL,
-                            {"target": self.call_partner},
-                        )
+                    self.sender.send_packet(
+                        protocol.CMD_END_CALL, {"target": self.call_partner}
+                    )
                 except:
                     pass
 
@@ -332,6 +768,7 @@ class ClientApp:
 
         self.in_call = False
         self.sending_video = False
+        self.audio_buffer = None
         if self.call_window:
             try:
                 self.call_window.destroy()
@@ -341,62 +778,89 @@ class ClientApp:
         self.call_partner = None
 
     def send_video_stream(self, target):
-        """Captures and sends video frames to the call partner."""
+        """
+        Captures and sends video frames to the call partner, at the size,
+        quality and frame rate the rate controller picks from the partner's
+        feedback and the local send queue. Frames are keyframes or changed
+        tiles once the partner reports that it decodes them.
+        """
         try:
             camera = VideoCamera()
         except Exception as e:
             print(f"[ERROR] Failed to initialize camera: {e}")
             return
 
+        controller = self.video_controller = VideoController()
+        encoder = self.video_encoder = TileEncoder()
+        seq = 0
         while self.in_call and self.is_connected:
             try:
-                frame_bytes = camera.get_frame_bytes()
-                if frame_bytes and self.client_socket:
-                    data = {"target": target, "frame": frame_bytes}
-                    with self.send_lock:
-                        if not protocol.send_packet(
-                            self.client_socket,
-                            protocol.CMD_VIDEO,
-                            data,
-                            is_encrypted=True,
-                        ):
-                            print("[VIDEO] Failed to send frame")
-                            break
-                time.sleep(0.1)
+                started = time.monotonic()
+                queued = self.sender.queue.depth(protocol.KIND_VIDEO)
+                width, height, quality, fps = controller.update(queued)
+                fields = encoder.encode(camera.get_frame(width, height), quality)
+                if fields and self.client_socket:
+                    data = dict(fields, seq=seq, ts=time.monotonic())
+                    seq += 1
+                    frame = protocol.encode_relay_packet(
+                        protocol.CMD_VIDEO,
+                        target,
+                        data,
+                        is_encrypted=True,
+                        cipher=self.sender.cipher,
+                    )
+                    if not self.sender.send_frame(frame, protocol.KIND_VIDEO):
+                        print("[VIDEO] Failed to send frame")
+                        break
+                time.sleep(max(0, 1 / fps - (time.monotonic() - started)))
             except Exception as e:
                 print(f"[VIDEO ERROR] {e}")
                 break
         camera.cleanup()
 
-    def send_audio_stream(self, target):
-        """Captures and sends audio chunks to the call partner."""
+    def open_microphone(self):
+        """Returns a started AudioRecorder, or None without a microphone."""
         try:
             mic = AudioRecorder()
             if mic.audio is None:
                 print("[WARNING] Audio device not available")
-                return
+                return None
             mic.start()
             if mic.stream is None:
                 print("[WARNING] Failed to start audio stream")
-                return
+                return None
         except Exception as e:
             print(f"[ERROR] Failed to initialize microphone: {e}")
+            return None
+        return mic
+
+    def send_audio_stream(self, target):
+        """
+        Captures and sends numbered, timestamped audio chunks to the call
+        partner, compressed once the partner lists the codecs it decodes.
+        """
+        mic = self.open_microphone()
+        if mic is None:
             return
 
+        encoder = self.audio_encoder = AudioEncoder()
+        seq = 0
         while self.in_call and self.is_connected:
             try:
                 chunk = mic.get_chunk()
                 if chunk and self.client_socket:
-                    data = {"target": target, "chunk": chunk}
-                    with self.send_lock:
-                        if not protocol.send_packet(
-                            self.client_socket,
-                            protocol.CMD_AUDIO,
-                            data,
-                            is_encrypted=True,
-                        ):
-                            print("[AUDIO] Failed to send chunk")
-                            break
+                    data = dict(encoder.encode(chunk), seq=seq, ts=time.monotonic())
+                    seq += 1
+                    frame = protocol.encode_relay_packet(
+                        protocol.CMD_AUDIO,
+                        target,
+                        data,
+                        is_encrypted=True,
+                        cipher=self.sender.cipher,
+                    )
+                    if not self.sender.send_frame(frame, protocol.KIND_AUDIO):
+                        print("[AUDIO] Failed to send chunk")
+                        break
                 else:
                     time.sleep(0.01)
             except Exception as e:
@@ -404,18 +868,361 @@ class ClientApp:
                 break
         mic.stop()
 
-    def update_call_video(self, frame_bytes):
-        """Updates the video label with the received frame."""
+    def play_audio_stream(self, player, buffer):
+        """
+        Plays the call partner's audio from the jitter buffer; the blocking
+        writes to the sound card pace the loop at one chunk per chunk time.
+        """
+        silence = bytes(2 * CHUNK)
+        while self.in_call and self.audio_buffer is buffer:
+            samples = buffer.pop()
+            player.play(silence if samples is None else samples.tobytes())
+
+    def decode_video(self, sender, data):
+        """
+        Decodes one received frame and answers with feedback when due; runs
+        on the video stage's thread. Only the newest decoded frame is kept
+        for display, so frames decoded faster than the window redraws are
+        never converted for Tk.
+        """
+        image = self.video_decoder.decode(data)
+        report = self.video_feedback.on_frame(data, undecodable=image is None)
+        if report:
+            feedback = protocol.encode_relay_packet(
+                protocol.CMD_VIDEO_FEEDBACK,
+                sender,
+                report,
+                cipher=self.sender.cipher,
+            )
+            self.sender.send_frame(feedback)
+
+        if image is not None:
+            self.video_frames.publish(image)
+
+    def render_video(self, window):
+        """
+        Shows the newest decoded frame, if there is one, every
+        RENDER_INTERVAL for as long as `window` is the call window.
+        """
+        if window is not self.call_window:
+            return
+        frame = self.video_frames.take()
+        if frame is not None:
+            self.update_call_video(frame)
+        self.root.after(RENDER_INTERVAL, lambda: self.render_video(window))
+
+    def update_call_video(self, frame):
+        """
+        Updates the video label with a received RGB frame, drawing into the
+        same PhotoImage until the frame size changes.
+        """
         if not self.in_call or not self.call_window:
             return
         try:
-            image = Image.open(io.BytesIO(frame_bytes))
-            photo = ImageTk.PhotoImage(image)
-            self.video_label.configure(image=photo, text="")
-            self.video_label.image = photo
+            height, width = frame.shape[:2]
+            photo = self.video_photo
+            if photo is None or (photo.width(), photo.height()) != (width, height):
+                photo = self.video_photo = ImageTk.PhotoImage("RGB", (width, height))
+                self.video_label.configure(image=photo, text="")
+            photo.paste(Image.fromarray(frame))
         except Exception as e:
             print(f"[GUI ERROR] Update video failed: {e}")
 
+    def start_group_call(self):
+        """Joins the call of the current room, starting it if there is none."""
+        if self.in_call:
+            messagebox.showwarning("Call", "End the current call first.")
+            return
+        self.in_call = True
+        self.call_receiver = CallReceiver()
+        self.call_state = {}
+        self.sender.send_packet(protocol.CMD_CALL_JOIN, {"codecs": AUDIO_CODECS})
+
+    def on_call_state(self, data, player):
+        """
+        Takes a CMD_CALL_STATE: the first one starts the call window and
+        streams, later ones follow who is in the call and speaking.
+        """
+        receiver = self.call_receiver
+        if receiver is None:
+            return  # Left the call already
+        first = not self.call_state
+        self.call_state = data
+        receiver.keep(data["participants"])
+        if self.audio_encoder:
+            self.audio_encoder.on_partner(data["codecs"])
+
+        if first:
+            room = data["room"]
+            self.root.after(0, lambda: self.setup_group_window(room))
+            for stream in (self.send_call_video, self.send_call_audio):
+                threading.Thread(
+                    target=stream, args=(room, receiver), daemon=True
+                ).start()
+            if player and player.stream:
+                threading.Thread(
+                    target=self.play_call_audio, args=(player, receiver), daemon=True
+                ).start()
+        self.root.after(0, self.update_group_window)
+
+    def end_group_call(self):
+        """Leaves the group call and closes its window."""
+        if self.call_receiver is None:
+            return
+        self.call_receiver = None
+        self.call_state = {}
+        self.call_encoders = None
+        self.in_call = False
+        if self.is_connected:
+            self.sender.send_packet(protocol.CMD_CALL_LEAVE, {})
+        if self.call_window:
+            try:
+                self.call_window.destroy()
+            except:
+                pass
+            self.call_window = None
+
+    def send_call_video(self, room, receiver):
+        """
+        Sends video to the group call in the one layer the server forwards:
+        full size while this user is a speaker, small while its video is
+        shown to the others, none otherwise. Switching layers starts with
+        a keyframe.
+        """
+        try:
+            camera = VideoCamera()
+        except Exception as e:
+            print(f"[ERROR] Failed to initialize camera: {e}")
+            return
+
+        encoders = self.call_encoders = [TileEncoder(), TileEncoder()]
+        for encoder in encoders:
+            encoder.enabled = True  # Every client in a group call decodes tiles
+        seqs = [0, 0]
+        layer = None
+        while self.call_receiver is receiver and self.is_connected:
+            try:
+                started = time.monotonic()
+                state = self.call_state
+                if len(state.get("participants", ())) < 2:
+                    wanted = None  # Nobody to send to yet
+                elif self.username in state.get("speakers", ()):
+                    wanted = protocol.LAYER_HIGH
+                elif self.username in state.get("videos", ()):
+                    wanted = protocol.LAYER_LOW
+                else:
+                    wanted = None
+                if wanted is None:
+                    layer = None
+                    time.sleep(0.1)
+                    continue
+                if wanted != layer:
+                    layer = wanted
+                    encoders[layer].keyframe_requested = True
+
+                width, height, quality, fps = CALL_LAYERS[layer]
+                fields = encoders[layer].encode(
+                    camera.get_frame(width, height), quality
+                )
+                if fields:
+                    data = dict(fields, seq=seqs[layer], ts=time.monotonic())
+                    seqs[layer] += 1
+                    frame = protocol.encode_routed_packet(
+                        protocol.CMD_VIDEO,
+                        {"call": room, "layer": layer},
+                        data,
+                        cipher=self.sender.cipher,
+                    )
+                    if not self.sender.send_frame(frame, protocol.KIND_VIDEO):
+                        print("[VIDEO] Failed to send frame")
+                        break
+                time.sleep(max(0, 1 / fps - (time.monotonic() - started)))
+            except Exception as e:
+                print(f"[VIDEO ERROR] {e}")
+                break
+        camera.cleanup()
+
+    def send_call_audio(self, room, receiver):
+        """
+        Sends audio to the group call, each chunk with its level so the
+        server can pick the speakers, in a codec every participant decodes.
+        """
+        mic = self.open_microphone()
+        if mic is None:
+            return
+
+        encoder = self.audio_encoder = AudioEncoder()
+        encoder.on_partner(self.call_state.get("codecs", ["pcm"]))
+        seq = 0
+        while self.call_receiver is receiver and self.is_connected:
+            try:
+                chunk = mic.get_chunk()
+                if chunk:
+                    data = dict(encoder.encode(chunk), seq=seq, ts=time.monotonic())
+                    seq += 1
+                    frame = protocol.encode_routed_packet(
+                        protocol.CMD_AUDIO,
+                        {"call": room, "level": audio_level(chunk)},
+                        data,
+                        cipher=self.sender.cipher,
+                    )
+                    if not self.sender.send_frame(frame, protocol.KIND_AUDIO):
+                        print("[AUDIO] Failed to send chunk")
+                        break
+                else:
+                    time.sleep(0.01)
+            except Exception as e:
+                print(f"[AUDIO ERROR] {e}")
+                break
+        mic.stop()
+
+    def play_call_audio(self, player, receiver):
+        """Plays the mixed audio of the group call, paced by the sound card."""
+        silence = bytes(2 * CHUNK)
+        while self.call_receiver is receiver:
+            samples = receiver.mix()
+            player.play(silence if samples is None else samples.tobytes())
+
+    def decode_call_video(self, data):
+        """
+        Decodes one frame of the group call and answers its sender with
+        feedback when due; runs on the call video stage's thread.
+        """
+        receiver = self.call_receiver
+        if receiver is None:
+            return
+        report = receiver.decode_video(data)
+        if report:
+            feedback = protocol.encode_relay_packet(
+                protocol.CMD_VIDEO_FEEDBACK,
+                data["sender"],
+                report,
+                cipher=self.sender.cipher,
+            )
+            self.sender.send_frame(feedback)
+
+    def setup_group_window(self, room):
+        """Creates the group call window: one video tile per participant."""
+        if self.call_window or self.call_receiver is None:
+            return
+        self.call_window = tk.Toplevel(self.root)
+        self.call_window.title(f"Call in {room}")
+        self.call_window.protocol("WM_DELETE_WINDOW", self.end_group_call)
+        self.call_window.geometry("700x500")
+
+        tk.Button(
+            self.call_window,
+            text="Leave Call",
+            command=self.end_group_call,
+            bg="#f44336",
+            fg="white",
+            font=("Arial", 12, "bold"),
+        ).pack(side=tk.BOTTOM, fill=tk.X, pady=5, padx=5)
+        self.call_grid = tk.Frame(self.call_window, bg="black")
+        self.call_grid.pack(fill=tk.BOTH, expand=True)
+        self.call_labels = {}
+        self.call_photos = {}
+        self.update_group_window()
+        self.render_call_video(self.call_window)
+
+    def update_group_window(self):
+        """Lays out a tile per other participant and marks the speakers."""
+        if not self.call_window or self.call_receiver is None:
+            return
+        others = [
+            name
+            for name in self.call_state.get("participants", ())
+            if name != self.username
+        ]
+        if list(self.call_labels) != others:
+            for label in self.call_labels.values():
+                label.destroy()
+            self.call_labels = {}
+            self.call_photos = {}
+            columns = max(1, math.ceil(math.sqrt(len(others))))
+            for index, name in enumerate(others):
+                label = tk.Label(
+                    self.call_grid, text=name, bg="#333", fg="white", compound=tk.TOP
+                )
+                label.grid(row=index // columns, column=index % columns, padx=2, pady=2)
+                self.call_labels[name] = label
+
+        speakers = self.call_state.get("speakers", ())
+        for name, label in self.call_labels.items():
+            label.configure(bg="#4CAF50" if name in speakers else "#333")
+
+    def render_call_video(self, window):
+        """
+        Shows each participant's newest decoded frame every RENDER_INTERVAL
+        for as long as `window` is the call window.
+        """
+        if window is not self.call_window or self.call_receiver is None:
+            return
+        for name, frames in list(self.call_receiver.frames.items()):
+            frame = frames.take()
+            label = self.call_labels.get(name)
+            if frame is None or label is None:
+                continue
+            try:
+                height, width = frame.shape[:2]
+                photo = self.call_photos.get(name)
+                if photo is None or (photo.width(), photo.height()) != (width, height):
+                    photo = self.call_photos[name] = ImageTk.PhotoImage(
+                        "RGB", (width, height)
+                    )
+                    label.configure(image=photo)
+                photo.paste(Image.fromarray(frame))
+            except Exception as e:
+                print(f"[GUI ERROR] Update video failed: {e}")
+        self.root.after(RENDER_INTERVAL, lambda: self.render_call_video(window))
+
+    def handle_file_packet(self, cmd, data):
+        """
+        Writes received file data to disk; runs on the file stage's thread,
+        in the order the packets arrived, and posts chat updates to the Tk
+        main loop.
+        """
+        if cmd == protocol.CMD_FILE:
+            # Whole-file packet from an older client
+            sender = data["from"]
+            filename = data["filename"]
+            transfer_id = uuid.uuid4().hex
+            self.open_incoming_file(transfer_id, filename, sender)
+            chunk = {"offset": 0, "data": data["content"]}
+            self.save_incoming_file(transfer_id, chunk)
+            self.finish_incoming_file(transfer_id)
+            self.post_message("file", sender, f"{filename} (Saved in downloads/)")
+
+        elif cmd == protocol.CMD_FILE_OFFER:
+            self.open_incoming_file(data["transfer_id"], data["filename"], data["from"])
+
+        elif cmd == protocol.CMD_FILE_CHUNK:
+            self.save_incoming_file(data["transfer_id"], data)
+
+        elif cmd == protocol.CMD_FILE_DATA:
+            self.save_file_data(data)
+
+        elif cmd == protocol.CMD_FILE_COMPLETE:
+            incoming = self.finish_incoming_file(
+                data["transfer_id"], data.get("aborted", False)
+            )
+            if incoming and data.get("aborted"):
+                self.post_message(
+                    "text", "System", f"Transfer of {incoming['filename']} aborted"
+                )
+            elif incoming and incoming["corrupt"]:
+                self.post_message(
+                    "text",
+                    "System",
+                    f"Transfer of {incoming['filename']} was corrupted",
+                )
+            elif incoming:
+                self.post_message(
+                    "file",
+                    incoming["from"],
+                    f"{incoming['filename']} (Saved in downloads/)",
+                )
+
     def listen_server(self):
         """
         Listens for incoming packets from the server and handles them.
@@ -427,9 +1234,11 @@ class ClientApp:
             print(f"[WARNING] Audio player initialization failed: {e}")
             player = None
 
+        packets = protocol.FrameReader(self.client_socket).packets()
+
         while self.is_connected:
             try:
-                packet = protocol.receive_packet(self.client_socket)
+                packet = next(packets, None)
                 if not packet:
                     print("Disconnected from server")
                     self.is_connected = False
@@ -449,7 +1258,12 @@ class ClientApp:
             cmd = packet["type"]
             data = packet["data"]
 
-            if cmd == protocol.CMD_LIST_UPDATE:
+            if cmd == protocol.CMD_LOGIN_ACK:
+                self.sender.cipher = protocol.get_cipher(data["cipher"])
+                print(f"[CIPHER] Using {self.sender.cipher.name}")
+                self.sender.send_packet(protocol.CMD_HISTORY, {"room": "General"})
+
+            elif cmd == protocol.CMD_LIST_UPDATE:
                 users = data["users"]
                 rooms = data["rooms"]
 
@@ -461,6 +1275,10 @@ class ClientApp:
                 self.room_listbox.delete(0, tk.END)
                 for r in rooms:
                     self.room_listbox.insert(tk.END, r)
+                self.presence_version = data.get("version")
+
+            elif cmd == protocol.CMD_PRESENCE:
+                self.apply_presence(data)
 
             elif cmd == protocol.CMD_MSG:
                 sender = data["from"]
@@ -473,11 +1291,60 @@ class ClientApp:
 
                 self.append_message(msg_type, sender, text)
 
-            elif cmd == protocol.CMD_FILE:
-                sender = data["from"]
-                filename = data["filename"]
-                path = self.save_incoming_file(filename, data["content"])
-                self.append_message("file", sender, f"{filename} (Saved in downloads/)")
+            elif cmd == protocol.CMD_ROOM_JOIN:
+                # The server confirms the room this client is now in
+                room = data["room"]
+                self.sender.send_packet(protocol.CMD_HISTORY, {"room": room})
+                if self.call_receiver and self.call_state.get("room") != room:
+                    # The server took this client out of the old room's call
+                    self.root.after(0, self.end_group_call)
+
+            elif cmd == protocol.CMD_HISTORY:
+                self.show_history(data)
+
+            elif cmd in (
+                protocol.CMD_FILE,
+                protocol.CMD_FILE_OFFER,
+                protocol.CMD_FILE_CHUNK,
+                protocol.CMD_FILE_DATA,
+                protocol.CMD_FILE_COMPLETE,
+            ):
+                self.file_stage.put((cmd, data))
+
+            elif cmd == protocol.CMD_FILE_ACK:
+                outgoing = self.outgoing_files.get(data["transfer_id"])
+                if outgoing:
+                    window = outgoing[1]
+                    if data.get("aborted"):
+                        window.cancel()
+                        name = outgoing[0]["filename"]
+                        self.append_message(
+                            "text", "System", f"{name} could not be delivered"
+                        )
+                    elif data.get("resume"):
+                        window.resume(data["offset"])
+                    else:
+                        window.ack(data["offset"])
+                    if data.get("stored"):
+                        window.finish()
+
+            elif cmd == protocol.CMD_FILE_REF:
+                self.show_file_ref(data)
+
+            elif cmd == protocol.CMD_CALL_STATE:
+                self.on_call_state(data, player)
+
+            elif cmd in (protocol.CMD_VIDEO, protocol.CMD_AUDIO) and (
+                "call" in data or self.call_receiver
+            ):
+                # Group call media; 1:1 calls wait until the group call ends
+                receiver = self.call_receiver
+                if receiver is None or "call" not in data:
+                    continue
+                if cmd == protocol.CMD_VIDEO:
+                    self.call_video_stage.put((data,))
+                else:
+                    receiver.push_audio(data)
 
             elif cmd == protocol.CMD_VIDEO:
                 sender = data.get("sender")
@@ -506,8 +1373,18 @@ class ClientApp:
                         target=self.send_video_stream, args=(sender,), daemon=True
                     ).start()
 
-                frame = data["frame"]
-                self.root.after(0, lambda: self.update_call_video(frame))
+                self.video_stage.put((sender, data))
+
+            elif cmd == protocol.CMD_VIDEO_FEEDBACK:
+                encoders = self.call_encoders
+                if "layer" in data:
+                    if encoders:
+                        encoders[data["layer"]].on_feedback(data)
+                    continue
+                if self.video_controller:
+                    self.video_controller.on_feedback(data)
+                if self.video_encoder:
+                    self.video_encoder.on_feedback(data)
 
             elif cmd == protocol.CMD_AUDIO:
                 if not self.in_call:
@@ -531,9 +1408,19 @@ class ClientApp:
                         target=self.send_audio_stream, args=(sender,), daemon=True
                     ).start()
 
-                if player and player.stream:
-                    chunk = data["chunk"]
-                    player.play(chunk)
+                if "codecs" in data and self.audio_encoder:
+                    self.audio_encoder.on_partner(data["codecs"])
+
+                if not (player and player.stream):
+                    continue
+                if self.audio_buffer is None:
+                    self.audio_buffer = JitterBuffer()
+                    threading.Thread(
+                        target=self.play_audio_stream,
+                        args=(player, self.audio_buffer),
+                        daemon=True,
+                    ).start()
+                self.audio_buffer.push(data)
 
             elif cmd == protocol.CMD_END_CALL:
                 self.root.after(0, self.end_call)
@@ -544,13 +1431,21 @@ class ClientApp:
                     ),
                 )
 
+        if self.call_receiver:
+            self.root.after(0, self.end_group_call)
         if player:
             player.cleanup()
+        if self.sender:
+            self.sender.close()
         try:
             if self.client_socket:
                 self.client_socket.close()
         except:
             pass
+        if self.reconnect():
+            return  # The new connection has its own listening thread
+        for _, window in list(self.outgoing_files.values()):
+            window.cancel()
         try:
             self.root.quit()
         except:
@@ -0,0 +1,176 @@
+"""
+Content-addressed file store.
+
+Files are kept under their SHA-256 digest (<directory>/<ab>/<abcdef...>),
+so uploading the same bytes twice stores them once. Uploads are written to
+a temporary file while they are hashed and only enter the store when they
+are complete. Reads are ranged, which lets clients download on demand and
+resume. The store holds at most `capacity` bytes; the least recently used
+files are evicted first.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import metrics
+
+DEFAULT_CAPACITY = 1024 * 1024 * 1024  # Bytes kept before evicting old files
+
+
+class Upload:
+    """
+    A file being received: written to a temporary file and hashed as the
+    chunks arrive, in order.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        descriptor, self.path = tempfile.mkstemp(dir=store.tmp_directory)
+        self.file = os.fdopen(descriptor, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, offset, data):
+        """
+        Appends one chunk.
+
+        Returns:
+            False if the chunk does not continue the file or would make it
+            larger than the store.
+        """
+        if offset != self.size or self.size + len(data) > self.store.capacity:
+            return False
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+        return True
+
+    def finish(self):
+        """Adds the upload to the store and returns its digest."""
+        self.file.close()
+        return self.store.commit(self.path, self.hash.hexdigest(), self.size)
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.path)
+
+
+class FileStore:
+    """
+    Deduplicating file store with an LRU size cap.
+
+    Args:
+        directory: Where files (and the tmp/ upload area) are kept.
+        capacity: Most bytes stored before the least recently used files
+            are evicted.
+    """
+
+    def __init__(self, directory, capacity=DEFAULT_CAPACITY):
+        self.directory = directory
+        self.tmp_directory = os.path.join(directory, "tmp")
+        os.makedirs(self.tmp_directory, exist_ok=True)
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.files = OrderedDict()  # Map digest -> size, least recently used first
+        self.size = 0
+
+        # Leftover uploads are useless after a restart
+        for name in os.listdir(self.tmp_directory):
+            os.unlink(os.path.join(self.tmp_directory, name))
+
+        # Last use survives restarts as the file's modification time
+        found = []
+        for prefix in os.listdir(self.directory):
+            folder = os.path.join(self.directory, prefix)
+            if prefix == "tmp" or not os.path.isdir(folder):
+                continue
+            for digest in os.listdir(folder):
+                stat = os.stat(os.path.join(folder, digest))
+                found.append((stat.st_mtime, digest, stat.st_size))
+        for _, digest, size in sorted(found):
+            self.files[digest] = size
+            self.size += size
+        self.evict()
+
+        metrics.active.gauge("file_store_bytes", lambda: self.size)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def has(self, digest, size=None):
+        """Returns True if the store holds the file (of the given size)."""
+        with self.lock:
+            stored = self.files.get(digest)
+        return stored is not None and (size is None or stored == size)
+
+    def begin(self):
+        """Starts an upload."""
+        return Upload(self)
+
+    def put(self, data):
+        """Stores bytes held in memory and returns their digest."""
+        upload = self.begin()
+        if not upload.write(0, data):
+            upload.abort()
+            raise ValueError("file larger than the store")
+        return upload.finish()
+
+    def commit(self, temp_path, digest, size):
+        """Moves a finished upload into the store unless it is already there."""
+        with self.lock:
+            known = digest in self.files
+            if known:
+                self.files.move_to_end(digest)
+            else:
+                os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+                os.replace(temp_path, self.path(digest))
+                self.files[digest] = size
+                self.size += size
+                self.evict(keep=digest)
+
+        if known:
+            os.unlink(temp_path)
+            os.utime(self.path(digest))
+            metrics.active.count("file_store_dedup_bytes", size)
+        return digest
+
+    def read(self, digest, offset, length):
+        """
+        Reads part of a stored file.
+
+        Returns:
+            The bytes (short or empty past the end), or None if the file is
+            not in the store.
+        """
+        with self.lock:
+            if digest not in self.files:
+                return None
+            self.files.move_to_end(digest)
+        try:
+            with open(self.path(digest), "rb") as f:
+                if offset == 0:
+                    os.utime(f.fileno())  # Record the use for the next start
+                return os.pread(f.fileno(), length, offset)
+        except FileNotFoundError:
+            return None  # Evicted since the check
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used files until the store fits.
+
+        Call with self.lock held, or before the store is shared.
+        """
+        for digest in list(self.files):
+            if self.size <= self.capacity:
+                break
+            if digest == keep:
+                continue
+            self.size -= self.files.pop(digest)
+            try:
+                os.unlink(self.path(digest))
+            except FileNotFoundError:
+                pass
+            metrics.active.count("file_store_evictions")
@@ -0,0 +1,295 @@
+"""
+Persistent message history: an append-only, segmented log with per-room and
+per-conversation indexes.
+
+Records are msgpack maps {"ts", "type", "data"} stored in segment files
+(00000000.log, 00000001.log, ...) as a 4-byte length followed by the body.
+Every key (a room or a private conversation) has an index file of fixed-size
+entries pointing at its records, so the last N messages of a key, or the N
+before a given position, are one slice of the index and one read per record.
+
+Appends are handed to a writer thread that writes whatever has queued up
+as one batch and fsyncs once per batch, so the server never waits on the
+disk. Readers map the index files into memory and see a record as soon as
+its batch is written.
+"""
+
+import hashlib
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import msgpack
+
+import metrics
+
+RECORD_HEADER = struct.Struct(">I")  # Record body length
+INDEX_ENTRY = struct.Struct(">IQI")  # Segment number, body position, length
+SEGMENT_SIZE = 64 * 1024 * 1024  # Bytes per segment before starting a new one
+MAX_BATCH = 1024  # Records written (and fsynced) together at most
+
+
+def room_key(room):
+    """Returns the history key of a room."""
+    return f"room:{room}"
+
+
+def conversation_key(user_a, user_b):
+    """Returns the history key of the private conversation of two users."""
+    return "dm:" + "\0".join(sorted([user_a, user_b]))
+
+
+class MessageLog:
+    """
+    Append-only message log with one offset index per key.
+
+    Args:
+        directory: Where segments (and the index/ subdirectory) are kept.
+        segment_size: Bytes per segment file before rolling to a new one.
+        max_batch: Records per write and fsync; 1 fsyncs every record.
+        fsync: Whether batches are fsynced at all.
+    """
+
+    def __init__(
+        self, directory, segment_size=SEGMENT_SIZE, max_batch=MAX_BATCH, fsync=True
+    ):
+        self.directory = directory
+        self.index_directory = os.path.join(directory, "index")
+        os.makedirs(self.index_directory, exist_ok=True)
+        self.segment_size = segment_size
+        self.max_batch = max_batch
+        self.fsync = fsync
+
+        self.pending = queue.Queue()  # (keys, record bytes) or None to stop
+        self.lock = threading.Lock()  # Guards the read-side caches
+        self.maps = {}  # Map index path -> (mmap, mapped size)
+        self.segment_files = {}  # Map segment number -> read-only file
+        self.index_files = {}  # Map index path -> append file (writer only)
+
+        self.recover()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f"{number:08d}.log")
+
+    def index_path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.index_directory, f"{digest}.idx")
+
+    def recover(self):
+        """
+        Opens the newest segment for appending, cutting off a record (and
+        any index entries) left incomplete by a crash.
+        """
+        numbers = sorted(
+            int(name[:-4])
+            for name in os.listdir(self.directory)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+        self.segment_number = numbers[-1] if numbers else 0
+        path = self.segment_path(self.segment_number)
+
+        with open(path, "ab+") as f:
+            f.seek(0)
+            data = f.read()
+        end = 0
+        while end + RECORD_HEADER.size <= len(data):
+            (length,) = RECORD_HEADER.unpack_from(data, end)
+            if end + RECORD_HEADER.size + length > len(data):
+                break
+            end += RECORD_HEADER.size + length
+        if end < len(data):
+            print(f"[HISTORY] Dropping {len(data) - end} bytes of a partial record")
+            os.truncate(path, end)
+
+        for name in os.listdir(self.index_directory):
+            self.trim_index(os.path.join(self.index_directory, name), end)
+
+        self.segment = open(path, "ab")
+        self.segment_position = end
+
+    def trim_index(self, path, segment_end):
+        """Drops index entries pointing past the end of the current segment."""
+        size = os.path.getsize(path)
+        keep = size - size % INDEX_ENTRY.size
+        with open(path, "rb") as f:
+            while keep:
+                f.seek(keep - INDEX_ENTRY.size)
+                number, position, length = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+                if number < self.segment_number or (
+                    number == self.segment_number and position + length <= segment_end
+                ):
+                    break
+                keep -= INDEX_ENTRY.size
+        if keep < size:
+            os.truncate(path, keep)
+
+    def append(self, keys, cmd, data, ts=None):
+        """
+        Queues one message for the log; returns immediately.
+
+        Args:
+            keys: History keys the message is listed under.
+            cmd: The packet type (CMD_MSG or CMD_FILE).
+            data: The packet data as delivered to clients.
+            ts: Send time; defaults to now.
+        """
+        record = {"ts": ts or time.time(), "type": cmd, "data": data}
+        self.pending.put((keys, msgpack.packb(record)))
+
+    def run(self):
+        """Writer thread: writes queued records in batches."""
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                try:
+                    self.write_batch(batch)
+                except OSError as e:
+                    print(f"[HISTORY ERROR] {e}")
+            if stop:
+                break
+
+    def write_batch(self, batch):
+        """Appends records and their index entries, then syncs them once."""
+        timer = metrics.active
+        start = timer.clock()
+
+        chunks = []
+        entries = {}  # Map index path -> list of packed entries
+        for keys, body in batch:
+            size = RECORD_HEADER.size + len(body)
+            if self.segment_position and (
+                self.segment_position + size > self.segment_size
+            ):
+                self.write_segment(chunks)
+                chunks = []
+                self.roll_segment()
+
+            chunks.append(RECORD_HEADER.pack(len(body)))
+            chunks.append(body)
+            entry = INDEX_ENTRY.pack(
+                self.segment_number,
+                self.segment_position + RECORD_HEADER.size,
+                len(body),
+            )
+            for key in keys:
+                entries.setdefault(self.index_path(key), []).append(entry)
+            self.segment_position += size
+
+        # Records first, so an index entry never points at missing data
+        self.write_segment(chunks)
+        for path, packed in entries.items():
+            index = self.index_files.get(path)
+            if index is None:
+                index = self.index_files[path] = open(path, "ab")
+            index.write(b"".join(packed))
+            index.flush()
+        start = timer.lap("history_write", start)
+
+        if self.fsync:
+            os.fsync(self.segment.fileno())
+            for path in entries:
+                os.fsync(self.index_files[path].fileno())
+            timer.lap("history_fsync", start)
+        timer.count("history_records", len(batch))
+
+    def write_segment(self, chunks):
+        self.segment.write(b"".join(chunks))
+        self.segment.flush()
+
+    def roll_segment(self):
+        """Closes the current segment and starts the next one."""
+        if self.fsync:
+            os.fsync(self.segment.fileno())
+        self.segment.close()
+        self.segment_number += 1
+        self.segment = open(self.segment_path(self.segment_number), "ab")
+        self.segment_position = 0
+
+    def index_view(self, key):
+        """
+        Returns a memory map of a key's index covering every entry written
+        so far, or None if the key has no messages.
+        """
+        path = self.index_path(key)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        size -= size % INDEX_ENTRY.size
+        if not size:
+            return None
+
+        with self.lock:
+            mapped = self.maps.get(path)
+            if mapped is None or mapped[1] < size:
+                with open(path, "rb") as f:
+                    view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                # An older, shorter map is left to other readers still using it
+                usable = len(view) - len(view) % INDEX_ENTRY.size
+                mapped = self.maps[path] = (view, usable)
+        return mapped
+
+    def read_record(self, number, position, length):
+        with self.lock:
+            segment = self.segment_files.get(number)
+            if segment is None:
+                segment = self.segment_files[number] = open(
+                    self.segment_path(number), "rb"
+                )
+        return msgpack.unpackb(os.pread(segment.fileno(), length, position), raw=False)
+
+    def read(self, key, limit, before=None):
+        """
+        Returns a page of a key's history, oldest first.
+
+        Args:
+            key: History key from room_key() or conversation_key().
+            limit: Most messages to return.
+            before: Index position to page back from; None for the newest.
+
+        Returns:
+            A tuple of (records, start), where start is the index position
+            of the first record, to be passed as `before` for the previous
+            page (0 when the beginning has been reached).
+        """
+        mapped = self.index_view(key)
+        if mapped is None:
+            return [], 0
+        view, size = mapped
+
+        count = size // INDEX_ENTRY.size
+        end = count if before is None else max(0, min(before, count))
+        start = max(0, end - limit)
+        records = [
+            self.read_record(*INDEX_ENTRY.unpack_from(view, i * INDEX_ENTRY.size))
+            for i in range(start, end)
+        ]
+        return records, start
+
+    def close(self):
+        """Writes everything queued so far and stops the writer thread."""
+        self.pending.put(None)
+        self.writer.join()
+        self.segment.close()
+        for index in self.index_files.values():
+            index.close()
+        with self.lock:
+            for view, _ in self.maps.values():
+                view.close()
+            for segment in self.segment_files.values():
+                segment.close()
+            self.maps.clear()
+            self.segment_files.clear()
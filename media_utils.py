@@ -1,13 +1,35 @@
 import cv2
-import pyaudio
+import math
 import threading
+import time
+import warnings
+from collections import deque
+
 import numpy as np
 
+try:
+    import pyaudio
+except ImportError:  # Headless tools (benchmark.py) only use the video code
+    pyaudio = None
+
+try:
+    import opuslib
+except ImportError:  # Optional; audio falls back to ADPCM or mu-law
+    opuslib = None
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+except ImportError:  # Removed in Python 3.13
+    audioop = None
+
 # Audio configuration constants
-FORMAT = pyaudio.paInt16
+FORMAT = pyaudio.paInt16 if pyaudio else None
 CHANNELS = 1
 RATE = 16000
-CHUNK = 1024
+CHUNK = 640  # 40 ms, a frame size Opus accepts
+CAMERA_FPS = 30  # Frame rate of synthetic sources and files that give none
 
 
 class AudioRecorder:
@@ -102,37 +124,390 @@ class AudioPlayer:
                 pass
 
 
-class VideoCamera:
+# Audio codecs in order of preference; "pcm" is the raw 16-bit samples of
+# clients without codecs and is always understood
+AUDIO_CODECS = (["opus"] if opuslib else []) + (["adpcm"] if audioop else [])
+AUDIO_CODECS += ["ulaw", "pcm"]
+OPUS_BITRATE = 24000  # Bits per second
+CODECS_EVERY = 25  # Chunks between listings of the codecs a sender decodes
+
+JITTER_WINDOW = 250  # Recent chunks whose transit times set the delay (10 s)
+JITTER_PERCENTILE = 99  # Share of those the delay lets arrive in time
+MAX_BUFFERED = 10  # Most chunks held back for playout (400 ms)
+SHRINK_AFTER = 25  # Chunks over the target before one is skipped
+CONCEAL_LIMIT = 3  # Missing chunks filled in before playing silence
+UNDERRUN_RESET = 25  # Chunks without audio after which buffering restarts
+
+
+def build_ulaw_tables():
     """
-    Handles video capture from the webcam.
+    Returns the G.711 mu-law tables: every 16-bit sample (indexed as
+    unsigned) to its code byte, and every code byte to its sample.
     """
+    samples = np.arange(-32768, 32768, dtype=np.int32)
+    sign = (samples < 0).astype(np.int32) << 7
+    magnitude = np.minimum(np.abs(samples), 32635) + 132
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 7
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    codes = (~(sign | exponent << 4 | mantissa) & 0xFF).astype(np.uint8)
+    encode = np.roll(codes, -32768)  # Index 0 is sample 0
+
+    code = ~np.arange(256, dtype=np.int32) & 0xFF
+    magnitude = (((code & 0x0F) << 3) + 132 << ((code >> 4) & 0x07)) - 132
+    decode = np.where(code & 0x80, -magnitude, magnitude).astype(np.int16)
+    return encode, decode
+
+
+ULAW_ENCODE, ULAW_DECODE = build_ulaw_tables()
+
+
+class AudioEncoder:
+    """
+    Sender side of the audio codecs.
+
+    Until the partner lists its codecs, chunks are raw PCM, which is what
+    clients without codecs play. After that, each chunk is compressed with
+    the first codec in AUDIO_CODECS both sides have: Opus (about 3 KB/s) if
+    opuslib is installed on both, else IMA ADPCM (8 KB/s), else mu-law
+    (16 KB/s), against 32 KB/s of PCM. Every ADPCM chunk carries the coder
+    state it starts from, so any chunk decodes without the ones before it.
+    """
+
+    def __init__(self):
+        self.codec = "pcm"
+        self.chunks = 0
+        self.adpcm_state = None
+        self.opus = None
+
+    def on_partner(self, codecs):
+        """Takes the list of codecs the partner decodes."""
+        codec = next(c for c in AUDIO_CODECS if c in codecs or c == "pcm")
+        if codec == "opus" and self.opus is None:
+            self.opus = opuslib.Encoder(RATE, CHANNELS, opuslib.APPLICATION_VOIP)
+            self.opus.bitrate = OPUS_BITRATE
+        self.codec = codec
+
+    def encode(self, pcm):
+        """
+        Encodes one chunk of 16-bit samples.
+
+        Returns:
+            The AUDIO_CHUNK fields for it ("chunk" plus the codec fields).
+        """
+        fields = {"chunk": pcm}
+        if self.codec != "pcm":
+            fields["codec"] = self.codec
+        if self.codec == "ulaw":
+            samples = np.frombuffer(pcm, dtype=np.int16)
+            fields["chunk"] = ULAW_ENCODE[samples.view(np.uint16)].tobytes()
+        elif self.codec == "adpcm":
+            fields["state"] = self.adpcm_state
+            fields["chunk"], self.adpcm_state = audioop.lin2adpcm(
+                pcm, 2, self.adpcm_state
+            )
+        elif self.codec == "opus":
+            fields["chunk"] = self.opus.encode(pcm, len(pcm) // 2)
+
+        if self.chunks % CODECS_EVERY == 0:
+            fields["codecs"] = AUDIO_CODECS
+        self.chunks += 1
+        return fields
+
+
+class AudioDecoder:
+    """Receiver side of the audio codecs."""
 
     def __init__(self):
+        self.opus = None
+
+    def decode(self, data):
+        """
+        Decodes one AUDIO_CHUNK.
+
+        Returns:
+            The samples as an int16 array, or None for an unknown codec.
+        """
+        codec, chunk = data.get("codec", "pcm"), data["chunk"]
+        if codec == "pcm":
+            return np.frombuffer(chunk, dtype=np.int16)
+        if codec == "ulaw":
+            return ULAW_DECODE[np.frombuffer(chunk, dtype=np.uint8)]
+        if codec == "adpcm" and audioop:
+            state = tuple(data["state"]) if data.get("state") else None
+            pcm, _ = audioop.adpcm2lin(chunk, 2, state)
+            return np.frombuffer(pcm, dtype=np.int16)
+        if codec == "opus" and opuslib:
+            if self.opus is None:
+                self.opus = opuslib.Decoder(RATE, CHANNELS)
+            return np.frombuffer(self.opus.decode(chunk, CHUNK), dtype=np.int16)
+        return None
+
+
+class JitterBuffer:
+    """
+    Receiver side of audio playout: holds chunks back long enough to absorb
+    the network's jitter and hands them out in order, one per `pop()`,
+    which the playback loop calls once per chunk duration.
+
+    The delay adapts: the buffer aims to hold enough chunks for
+    JITTER_PERCENTILE percent of the last JITTER_WINDOW chunks to have
+    arrived in time, judged by how much later than the fastest one each
+    arrived. When it has held more than that for SHRINK_AFTER chunks, a
+    chunk is skipped. When the next chunk is missing, it is taken as lost
+    once it is later than that share of chunks ever are, or once a full
+    target has arrived after it; until then a concealment chunk is played
+    while it is waited for, which adds a chunk of delay. Judging losses by
+    time keeps them from adding delay the jitter does not call for.
+    Missing chunks are concealed by repeating the last one, fading out over
+    CONCEAL_LIMIT chunks.
+
+    Args:
+        chunk_seconds: Duration of one chunk.
+    """
+
+    def __init__(self, chunk_seconds=CHUNK / RATE):
+        self.chunk_seconds = chunk_seconds
+        self.decoder = AudioDecoder()
+        self.lock = threading.Lock()
+        self.chunks = {}  # Map seq -> data of chunks waiting to be played
+        self.next_seq = None  # Next chunk to play once playing
+        self.playing = False
+        self.transits = deque(maxlen=JITTER_WINDOW)  # Seconds, with clock offset
+        self.last = None  # Last samples played, for concealment
+        self.position = None  # "ts" of the chunk last played
+        self.position_seq = None  # Its "seq"
+        self.concealed_run = 0
+        self.underruns = 0
+        self.excess_run = 0  # Consecutive chunks played above the target
+        self.unnumbered = 0  # Next seq given to chunks that have none
+        self.stats = {"played": 0, "concealed": 0, "late": 0, "skipped": 0}
+
+    def push(self, data, now=None):
+        """
+        Adds an AUDIO_CHUNK. Chunks from senders that do not number them
+        are numbered and timestamped on arrival.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if "seq" not in data:
+                data = dict(data, seq=self.unnumbered, ts=now)
+                self.unnumbered += 1
+            # Transit times include the clock offset; only their spread counts
+            self.transits.append(now - data["ts"])
+            if self.playing and data["seq"] < self.next_seq:
+                self.stats["late"] += 1
+                return
+            self.chunks[data["seq"]] = data
+
+    def transit_limit(self):
+        """
+        Returns the transit time JITTER_PERCENTILE percent of recent chunks
+        arrived within, or None before any arrived.
+        """
+        if not self.transits:
+            return None
+        return np.percentile(np.asarray(self.transits), JITTER_PERCENTILE)
+
+    def target(self, limit=None):
+        """Returns the number of chunks the buffer aims to hold."""
+        if limit is None:
+            return 1
+        spread = limit - min(self.transits)
+        wanted = math.ceil(spread / self.chunk_seconds)
+        return max(1, min(MAX_BUFFERED, wanted))
+
+    def overdue(self, newest, limit, now):
+        """
+        Returns whether the next chunk is later than nearly every chunk ever
+        is, judged from the send time of the chunk last played. Chunks the
+        sender did not number are only known to be missing once later ones
+        arrived, and after CONCEAL_LIMIT chunks missing in a row only a
+        later chunk shows the sender did not just pause.
+        """
+        if limit is None or self.position is None or self.unnumbered:
+            return False
+        if newest <= self.next_seq and self.concealed_run >= CONCEAL_LIMIT:
+            return False
+        skipped = self.next_seq - self.position_seq
+        return now - (self.position + skipped * self.chunk_seconds) > limit
+
+    def pop(self, now=None):
+        """
+        Returns the next chunk's samples, or None while buffering (the
+        caller plays silence).
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            limit = self.transit_limit()
+            target = self.target(limit)
+            if not self.playing:
+                if len(self.chunks) < target:
+                    return None
+                self.playing = True
+                self.next_seq = min(self.chunks)
+
+            newest = max(self.chunks, default=self.next_seq - 1)
+            if newest - self.next_seq + 1 > target + 1:
+                self.excess_run += 1
+            else:
+                self.excess_run = 0
+            if self.excess_run >= SHRINK_AFTER:
+                if self.chunks.pop(self.next_seq, None):
+                    self.stats["skipped"] += 1
+                self.next_seq += 1
+                self.excess_run = 0
+
+            data = self.chunks.pop(self.next_seq, None)
+            if data is not None:
+                samples = self.decoder.decode(data)
+            else:
+                samples = None
+            if (
+                data is not None
+                or newest - self.next_seq + 1 > target
+                or self.overdue(newest, limit, now)
+            ):
+                self.next_seq += 1  # Played, or lost: too late or a target came after
+            if data is not None:
+                self.underruns = 0
+            else:
+                self.underruns += 1
+                if self.underruns >= UNDERRUN_RESET:
+                    self.playing = False  # The stream stopped; buffer again
+                    self.underruns = 0
+
+            if samples is not None:
+                self.last, self.concealed_run = samples, 0
+                self.position, self.position_seq = data["ts"], data["seq"]
+                self.stats["played"] += 1
+                return samples
+            return self.conceal()
+
+    def conceal(self):
+        """Returns a stand-in for a missing chunk."""
+        self.stats["concealed"] += 1
+        self.concealed_run += 1
+        if self.last is None or self.concealed_run > CONCEAL_LIMIT:
+            return np.zeros(int(self.chunk_seconds * RATE), dtype=np.int16)
+        fade = 1 - self.concealed_run / (CONCEAL_LIMIT + 1)
+        return (self.last * fade).astype(np.int16)
+
+
+def audio_level(samples):
+    """
+    Returns the level of 16-bit PCM (bytes or an int16 array) in dBov, from
+    0 at full scale down to -127 for silence; group calls send it with
+    every chunk for the server to find the active speakers.
+    """
+    if isinstance(samples, bytes):
+        samples = np.frombuffer(samples, dtype=np.int16)
+    if not len(samples):
+        return -127
+    rms = math.sqrt(np.mean(np.square(samples, dtype=np.float64)))
+    if rms < 1:
+        return -127
+    return max(-127, round(20 * math.log10(rms / 32768)))
+
+
+class VideoCamera:
+    """
+    Video source for calls: a webcam, a video file (played in a loop) or
+    synthetic frames, captured on a thread of its own.
+
+    The capture thread reads into a reused buffer and resizes straight into
+    a LatestFrame buffer at the size last asked for, so get_frame() returns
+    the newest frame at once and never waits on the camera. Without a
+    working source, a cached "NO CAMERA" placeholder is returned.
+
+    Args:
+        source: None for the first webcam that opens (0, then 1), a device
+            number, a video file path, or "synthetic".
+    """
+
+    def __init__(self, source=None):
         self.cap = None
+        self.synthetic = source == "synthetic"
+        self.looping = isinstance(source, str) and not self.synthetic
+        self.interval = 0  # Seconds between captures; 0 when the device paces
         try:
-            # Try opening default camera (0), then fallback to (1)
-            self.cap = cv2.VideoCapture(0)
-            if not self.cap.isOpened():
-                self.cap = cv2.VideoCapture(1)
+            if source is None:
+                # Try opening default camera (0), then fallback to (1)
+                self.cap = cv2.VideoCapture(0)
                 if not self.cap.isOpened():
-                    print("[WARNING] No camera found. Using placeholder.")
-                    self.cap = None
+                    self.cap = cv2.VideoCapture(1)
+            elif not self.synthetic:
+                self.cap = cv2.VideoCapture(source)
+            if self.cap is not None and not self.cap.isOpened():
+                print("[WARNING] No camera found. Using placeholder.")
+                self.cap = None
         except Exception as e:
             print(f"[ERROR] Failed to initialize camera: {e}")
             self.cap = None
 
-    def get_frame_bytes(self):
-        """Captures a frame, resizes it, and encodes it as JPEG bytes."""
-        frame = None
-        if self.cap is not None and self.cap.isOpened():
-            try:
-                ret, read_frame = self.cap.read()
-                if ret:
-                    frame = read_frame
-            except:
-                pass
+        if self.synthetic:
+            self.interval = 1 / CAMERA_FPS
+        elif self.looping and self.cap is not None:
+            self.interval = 1 / (self.cap.get(cv2.CAP_PROP_FPS) or CAMERA_FPS)
+
+        self.frames = LatestFrame()
+        self.size = (240, 180)  # (width, height) the capture thread resizes to
+        self.frame = None  # Frame last returned by get_frame()
+        self.placeholders = {}  # Map (width, height) -> placeholder frame
+        self.running = self.cap is not None or self.synthetic
+        self.thread = None
+        if self.running:
+            self.thread = threading.Thread(target=self.capture, daemon=True)
+            self.thread.start()
+
+    def capture(self):
+        """Capture thread: publishes resized frames until cleanup()."""
+        raw = None
+        index = 0
+        next_capture = time.monotonic()
+        while self.running:
+            if self.synthetic:
+                raw = synthetic_frame(index)
+            else:
+                try:
+                    captured, raw = self.cap.read(raw)
+                except cv2.error:
+                    captured = False
+                if not captured:
+                    if self.looping and index:
+                        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                        index = 0
+                        continue
+                    print("[WARNING] Camera stopped. Using placeholder.")
+                    break
+
+            width, height = self.size
+            cv2.resize(raw, (width, height), dst=self.frames.buffer(width, height))
+            self.frames.swap()
+            index += 1
+            if self.interval:
+                next_capture = max(next_capture + self.interval, time.monotonic())
+                time.sleep(max(0, next_capture - time.monotonic()))
+        self.running = False
+
+    def get_frame(self, width=240, height=180):
+        """
+        Returns the newest frame at the given size, without waiting for the
+        camera. The array stays valid until the next call.
+        """
+        self.size = (width, height)
+        frame = self.frames.take()
+        if frame is not None:
+            self.frame = frame
+        if self.frame is None or not (self.running or frame is not None):
+            return self.placeholder(width, height)
+        if self.frame.shape[:2] != (height, width):
+            # The capture thread has not caught up with a new size yet
+            return cv2.resize(self.frame, (width, height))
+        return self.frame
 
-        # If no frame captured, create a placeholder black frame
+    def placeholder(self, width, height):
+        """Returns the cached "NO CAMERA" frame for a size."""
+        frame = self.placeholders.get((width, height))
         if frame is None:
             frame = np.zeros((480, 640, 3), dtype=np.uint8)
             cv2.putText(
@@ -144,20 +519,573 @@ class VideoCamera:
                 (255, 255, 255),
                 2,
             )
+            frame = self.placeholders[(width, height)] = cv2.resize(
+                frame, (width, height)
+            )
+        return frame
 
-        # Resize and encode frame
-        frame = cv2.resize(frame, (240, 180))
-        success, buffer = cv2.imencode(
-            ".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), 30]
-        )
-        if success:
-            return buffer.tobytes()
-        return None
+    def get_frame_bytes(self, width=240, height=180, quality=30):
+        """Returns the newest frame, resized, as JPEG bytes."""
+        return encode_jpeg(self.get_frame(width, height), quality)
 
     def cleanup(self):
-        """Releases the camera resource."""
+        """Stops the capture thread and releases the camera."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
         if self.cap is not None:
             try:
                 self.cap.release()
             except:
                 pass
+
+
+def synthetic_frame(index, width=640, height=480):
+    """
+    Returns a test frame: a gradient with a ball moving across it and the
+    frame number, for benchmarks without a camera.
+    """
+    y, x = np.mgrid[0:height, 0:width]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[..., 0] = x * 255 // width
+    frame[..., 1] = y * 255 // height
+    frame[..., 2] = 96
+    center = (int(width / 2 + width / 3 * np.sin(index / 10)), height // 2)
+    cv2.circle(frame, center, height // 8, (255, 255, 255), -1)
+    cv2.putText(
+        frame,
+        f"frame {index}",
+        (20, 40),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        1,
+        (0, 0, 0),
+        2,
+    )
+    return frame
+
+
+# Video settings from worst to best link: (width, height, JPEG quality, fps)
+VIDEO_LEVELS = [
+    (160, 120, 25, 5),
+    (240, 180, 30, 10),  # The fixed setting before rate control
+    (320, 240, 40, 12),
+    (480, 360, 50, 15),
+    (640, 480, 60, 20),
+]
+# Group call video layers, indexed by protocol.LAYER_LOW and LAYER_HIGH
+CALL_LAYERS = [VIDEO_LEVELS[0], VIDEO_LEVELS[2]]
+FEEDBACK_INTERVAL = 0.5  # Seconds between VIDEO_FEEDBACK reports
+FEEDBACK_TIMEOUT = 2.0  # Seconds without a report that count as congestion
+DELAY_THRESHOLD = 0.1  # Queueing delay (round trip above the best) seen as congestion
+LOSS_THRESHOLD = 0.05  # Fraction of lost frames seen as congestion
+PROBE_INTERVAL = 3.0  # Seconds without congestion before trying a better level
+MAX_PROBE_INTERVAL = 30.0
+BASE_RTT_WINDOW = 30.0  # Seconds the best round trip is remembered
+
+# Inter-frame video: keyframes are whole JPEGs, the frames in between carry
+# only the TILE_SIZE x TILE_SIZE tiles that changed, packed into one JPEG
+TILE_SIZE = 16  # Pixels; a multiple of the 16x16 JPEG block keeps tiles apart
+TILE_THRESHOLD = 6  # Mean difference (0-255) at which a tile is sent again
+MOSAIC_COLUMNS = 16  # Tiles per row of the changed-tile mosaic
+KEYFRAME_INTERVAL = 10.0  # Seconds between keyframes when nothing is lost
+KEYFRAME_RETRY = 0.5  # Seconds between repeated keyframe requests
+VIDEO_CODECS = ["tiles"]  # Listed in VIDEO_FEEDBACK by receivers that decode them
+
+
+class VideoFeedback:
+    """
+    Receiver side of video rate control: counts the frames of one incoming
+    stream and produces a VIDEO_FEEDBACK report every FEEDBACK_INTERVAL.
+
+    A lost frame (a gap in the sequence numbers) or one that could not be
+    decoded makes the next report due at once, asking for a keyframe.
+    """
+
+    def __init__(self, interval=FEEDBACK_INTERVAL):
+        self.interval = interval
+        self.first_seq = None  # First sequence number of the current report
+        self.last_seq = None
+        self.received = 0
+        self.last_report = time.monotonic()
+        self.keyframe_pending = False
+        self.last_request = 0.0  # Time of the latest keyframe request
+
+    def on_frame(self, data, undecodable=False):
+        """
+        Records a received VIDEO_FRAME.
+
+        Args:
+            data: The frame's data dictionary.
+            undecodable: The frame could not be decoded (a delta without
+                the frame it builds on).
+
+        Returns:
+            The feedback dictionary to send back, or None if none is due
+            (or the sender does not number its frames).
+        """
+        seq = data.get("seq")
+        if seq is None:
+            return None
+        lost = self.last_seq is not None and seq > self.last_seq + 1
+        if self.last_seq is None or seq <= self.last_seq:
+            self.first_seq, self.received = seq, 0  # A new stream
+        self.last_seq = seq
+        self.received += 1
+        if data.get("key"):
+            self.keyframe_pending = False
+        elif data.get("codec") and (lost or undecodable):
+            self.keyframe_pending = True  # Plain JPEG frames stand alone
+
+        now = time.monotonic()
+        urgent = self.keyframe_pending and now - self.last_request >= KEYFRAME_RETRY
+        if now - self.last_report < self.interval and not urgent:
+            return None
+        report = {
+            "echo": data["ts"],
+            "received": self.received,
+            "expected": seq - self.first_seq + 1,
+            "codecs": VIDEO_CODECS,
+        }
+        if self.keyframe_pending:
+            report["keyframe"] = True
+            self.last_request = now
+        self.first_seq, self.received = seq + 1, 0
+        self.last_report = now
+        return report
+
+
+class VideoController:
+    """
+    Sender side of video rate control: picks one of VIDEO_LEVELS from the
+    receiver's feedback and the local send queue.
+
+    The link counts as congested when the round trip is DELAY_THRESHOLD
+    above the best one seen and still growing, more than LOSS_THRESHOLD of
+    the frames are lost (the server drops the oldest video frames of a slow
+    recipient), video frames pile up in the local send queue, or reports
+    stop coming. Congestion steps the level down at most once per second
+    (two levels when severe). Reports about frames sent before the old
+    level's backlog could drain (one queueing delay after a step down) are
+    ignored, as is a shrinking delay, so a backlog is not counted twice.
+    PROBE_INTERVAL seconds without any delay or loss step the level up. A
+    step up that is followed by congestion doubles the wait before the next
+    one, so the level does not keep bouncing at the link's limit.
+
+    Without any feedback (a receiver that does not send it) the level only
+    ever goes down, on local queue growth.
+
+    Args:
+        levels: Settings from worst to best.
+        start: Index of the level to start at.
+    """
+
+    def __init__(self, levels=VIDEO_LEVELS, start=1):
+        self.levels = levels
+        self.level = start
+        self.lock = threading.Lock()
+        self.rtts = deque()  # (time, round trip) within BASE_RTT_WINDOW
+        self.rtt = None  # Latest round trip in seconds
+        self.delay = 0.0  # Latest round trip above the best one
+        self.loss = 0.0  # Lost fraction in the latest report
+        self.probe = PROBE_INTERVAL
+
+        now = time.monotonic()
+        self.last_feedback = None  # Time of the latest report
+        self.last_down = now - 1.0
+        self.settle_until = 0.0  # Reports on frames sent earlier are ignored
+        self.last_up = 0.0
+        self.clean_since = now
+
+    def settings(self):
+        """Returns (width, height, JPEG quality, fps) of the current level."""
+        return self.levels[self.level]
+
+    def on_feedback(self, report):
+        """Takes a VIDEO_FEEDBACK report from the receiver."""
+        now = time.monotonic()
+        rtt = max(0.0, now - report["echo"])
+        expected = max(report["expected"], 1)
+        loss = 1 - min(report["received"], expected) / expected
+
+        with self.lock:
+            self.last_feedback = now
+            self.rtt, self.loss = rtt, loss
+            self.rtts.append((now, rtt))
+            while self.rtts[0][0] < now - BASE_RTT_WINDOW:
+                self.rtts.popleft()
+            base = min(sample for _, sample in self.rtts)
+
+            delay = rtt - base
+            growing = delay > self.delay
+            self.delay = delay
+            if delay > DELAY_THRESHOLD or loss > LOSS_THRESHOLD:
+                self.clean_since = now
+            if report["echo"] < self.settle_until:
+                return  # Sent before the old level's backlog could clear
+
+            # A shrinking delay is a backlog draining at the current level
+            congested = loss > LOSS_THRESHOLD or (delay > DELAY_THRESHOLD and growing)
+            severe = loss > 4 * LOSS_THRESHOLD or (
+                delay > 4 * DELAY_THRESHOLD and growing
+            )
+            self.adjust(now, congested, severe)
+
+    def update(self, queued):
+        """
+        Called before each frame with the number of video frames waiting
+        in the local send queue.
+
+        Returns:
+            (width, height, JPEG quality, fps) for the frame.
+        """
+        now = time.monotonic()
+        with self.lock:
+            silent = (
+                self.last_feedback is not None
+                and now - self.last_feedback > FEEDBACK_TIMEOUT
+            )
+            self.adjust(now, queued > 1 or silent, queued > 4)
+            return self.levels[self.level]
+
+    def adjust(self, now, congested, severe):
+        """Moves the level; call with self.lock held."""
+        if congested:
+            self.clean_since = now
+            if self.level == 0 or now - self.last_down < 1.0:
+                return
+            if now - self.last_up < self.probe:
+                # The last step up was too much for the link
+                self.probe = min(self.probe * 2, MAX_PROBE_INTERVAL)
+            self.level = max(0, self.level - (2 if severe else 1))
+            self.last_down = now
+            # Frames sent now still wait behind the backlog for about a delay
+            self.settle_until = now + self.delay
+            return
+
+        if now - self.last_down > MAX_PROBE_INTERVAL:
+            self.probe = PROBE_INTERVAL
+        if (
+            self.last_feedback is not None
+            and self.level < len(self.levels) - 1
+            and now - self.clean_since >= self.probe
+        ):
+            self.level += 1
+            self.last_up = now
+            self.clean_since = now
+
+
+def encode_jpeg(image, quality):
+    """Returns a BGR image as JPEG bytes, or None if encoding failed."""
+    success, buffer = cv2.imencode(
+        ".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    )
+    return buffer.tobytes() if success else None
+
+
+class TileEncoder:
+    """
+    Sender side of the inter-frame video codec.
+
+    A keyframe is the whole frame as one JPEG. Later frames send only the
+    tiles whose content moved more than TILE_THRESHOLD from what was last
+    sent for them, gathered into one mosaic JPEG with their indexes, so a
+    mostly still picture costs a few tiles per frame. Comparing with what
+    was last sent, rather than the previous frame, lets slow changes add up
+    until the tile is sent. Keyframes follow a change of size, a request
+    from the receiver, and every KEYFRAME_INTERVAL seconds.
+
+    Until the receiver lists "tiles" in its feedback every frame is a plain
+    JPEG, which is what receivers without the codec expect.
+    """
+
+    def __init__(self, tile=TILE_SIZE, threshold=TILE_THRESHOLD):
+        self.tile = tile
+        self.threshold = threshold
+        self.enabled = False  # The receiver decodes tiles
+        self.reference = None  # Padded frame as the receiver has it
+        self.keyframe_requested = False
+        self.last_keyframe = 0.0
+
+    def on_feedback(self, report):
+        """Takes a VIDEO_FEEDBACK report from the receiver."""
+        if "tiles" in report.get("codecs", ()):
+            self.enabled = True
+        if report.get("keyframe"):
+            self.keyframe_requested = True
+
+    def encode(self, frame, quality):
+        """
+        Encodes one BGR frame.
+
+        Returns:
+            The VIDEO_FRAME fields for it ("frame" plus the codec fields),
+            or None if JPEG encoding failed.
+        """
+        if not self.enabled:
+            jpeg = encode_jpeg(frame, quality)
+            return {"frame": jpeg} if jpeg else None
+
+        height, width = frame.shape[:2]
+        padded = pad_to_tiles(frame, self.tile)
+        fields = {"codec": "tiles", "size": [width, height], "tile": self.tile}
+
+        now = time.monotonic()
+        if (
+            self.reference is None
+            or self.reference.shape != padded.shape
+            or self.keyframe_requested
+            or now - self.last_keyframe >= KEYFRAME_INTERVAL
+        ):
+            jpeg = encode_jpeg(frame, quality)
+            if jpeg is None:
+                return None
+            self.reference = padded
+            self.keyframe_requested = False
+            self.last_keyframe = now
+            return dict(fields, key=True, frame=jpeg)
+
+        # Mean difference per tile, from a box-filtered difference image
+        rows, columns = padded.shape[0] // self.tile, padded.shape[1] // self.tile
+        difference = cv2.absdiff(padded, self.reference)
+        means = cv2.resize(difference, (columns, rows), interpolation=cv2.INTER_AREA)
+        changed = np.flatnonzero(means.max(axis=2) > self.threshold)
+        fields.update(key=False, tiles=changed.tolist(), frame=b"")
+        if not changed.size:
+            return fields  # Still sent: the receiver's feedback needs it
+
+        tile_rows, tile_columns = np.divmod(changed, columns)
+        current = tile_view(padded, self.tile)
+        blocks = current[tile_rows, :, tile_columns]
+        jpeg = encode_jpeg(build_mosaic(blocks), quality)
+        if jpeg is None:
+            return None
+        tile_view(self.reference, self.tile)[tile_rows, :, tile_columns] = blocks
+        fields["frame"] = jpeg
+        return fields
+
+
+class TileDecoder:
+    """
+    Receiver side of the inter-frame video codec; also decodes the plain
+    JPEG frames of senders without it.
+    """
+
+    def __init__(self):
+        self.reference = None  # Padded frame the next delta applies to
+        self.size = None  # (width, height) of the reference
+
+    def decode(self, data):
+        """
+        Decodes one VIDEO_FRAME.
+
+        Returns:
+            The BGR frame, or None if it cannot be decoded (a corrupt JPEG,
+            or a delta without its keyframe). The frame is a view of the
+            decoder's reference and changes with the next delta.
+        """
+        if data.get("codec") != "tiles" or data.get("key"):
+            image = decode_jpeg(data["frame"])
+            if image is not None and data.get("codec") == "tiles":
+                self.reference = pad_to_tiles(image, data["tile"], self.reference)
+                self.size = tuple(data["size"])
+            return image
+
+        size, tile = tuple(data["size"]), data["tile"]
+        if self.reference is None or size != self.size:
+            return None
+        if data["tiles"]:
+            mosaic = decode_jpeg(data["frame"])
+            if mosaic is None:
+                return None
+            count = len(data["tiles"])
+            tiles = np.asarray(data["tiles"])
+            tile_rows, tile_columns = np.divmod(tiles, self.reference.shape[1] // tile)
+            blocks = split_mosaic(mosaic, tile, count)
+            tile_view(self.reference, tile)[tile_rows, :, tile_columns] = blocks
+        width, height = size
+        return self.reference[:height, :width]
+
+
+class LatestFrame:
+    """
+    Hands the newest frame from a producing thread (video decoding, the
+    camera) to a consumer (the display, the sender) without allocating per
+    frame. Three buffers rotate between the writer, the newest finished
+    frame and the reader (triple buffering), so neither side waits on the
+    other and a frame the consumer never got to is simply overwritten.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.writing = None
+        self.ready = None
+        self.reading = None
+        self.fresh = False  # ready holds a frame not yet taken
+        self.published = 0
+        self.skipped = 0  # Frames replaced before they were taken
+
+    def buffer(self, width, height):
+        """Returns the writer's buffer, to be filled before swap()."""
+        if self.writing is None or self.writing.shape[:2] != (height, width):
+            self.writing = np.empty((height, width, 3), dtype=np.uint8)
+        return self.writing
+
+    def publish(self, image):
+        """Stores a BGR frame, as RGB, as the newest one."""
+        height, width = image.shape[:2]
+        cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=self.buffer(width, height))
+        self.swap()
+
+    def swap(self):
+        """Makes the filled writer's buffer the newest frame."""
+        with self.lock:
+            self.writing, self.ready = self.ready, self.writing
+            self.skipped += self.fresh
+            self.fresh = True
+            self.published += 1
+
+    def take(self):
+        """
+        Returns the newest frame if it has not been taken yet, else None.
+        The array stays valid until the next take().
+        """
+        with self.lock:
+            if not self.fresh:
+                return None
+            self.reading, self.ready = self.ready, self.reading
+            self.fresh = False
+            return self.reading
+
+
+def decode_jpeg(data):
+    """Returns JPEG bytes as a BGR image, or None if they do not decode."""
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def pad_to_tiles(frame, tile, out=None):
+    """
+    Extends a frame by repeating its edges to whole tiles, into `out` if
+    it has the right shape (reusing the buffer) or else a new array.
+    """
+    height, width = frame.shape[:2]
+    bottom, right = -height % tile, -width % tile
+    shape = (height + bottom, width + right, 3)
+    if out is None or out.shape != shape:
+        out = np.empty(shape, dtype=np.uint8)
+    return cv2.copyMakeBorder(frame, 0, bottom, 0, right, cv2.BORDER_REPLICATE, dst=out)
+
+
+def tile_view(frame, tile):
+    """
+    Returns a (rows, tile, columns, tile, 3) view of a padded frame, so
+    view[row, :, column] is one tile.
+    """
+    height, width = frame.shape[:2]
+    return frame.reshape(height // tile, tile, width // tile, tile, 3)
+
+
+def build_mosaic(blocks):
+    """Lays (count, tile, tile, 3) blocks out in rows of MOSAIC_COLUMNS."""
+    count, tile = blocks.shape[:2]
+    columns = min(count, MOSAIC_COLUMNS)
+    rows = -(-count // columns)
+    padded = np.zeros((rows * columns, tile, tile, 3), dtype=np.uint8)
+    padded[:count] = blocks
+    grid = padded.reshape(rows, columns, tile, tile, 3).swapaxes(1, 2)
+    return grid.reshape(rows * tile, columns * tile, 3)
+
+
+def split_mosaic(mosaic, tile, count):
+    """Returns the first `count` (tile, tile, 3) blocks of a mosaic."""
+    rows, columns = mosaic.shape[0] // tile, mosaic.shape[1] // tile
+    grid = mosaic.reshape(rows, tile, columns, tile, 3).swapaxes(1, 2)
+    return grid.reshape(rows * columns, tile, tile, 3)[:count]
+
+
+class CallReceiver:
+    """
+    Receiving side of a group call: a jitter buffer per participant heard,
+    mixed into one playback stream, and a decoder per video layer with the
+    newest frame per participant seen.
+
+    The server moves a participant between video layers when the speakers
+    change, so a layer's frames stop and later resume. A gap in a layer's
+    sequence numbers drops its decoder's reference, so the deltas that
+    follow are not drawn over a stale picture while the keyframe asked for
+    is on its way.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = {}  # Map sender -> JitterBuffer
+        self.streams = {}  # Map (sender, layer) -> (TileDecoder, VideoFeedback)
+        self.frames = {}  # Map sender -> LatestFrame
+
+    def push_audio(self, data, now=None):
+        """Adds a forwarded AUDIO_CHUNK to its sender's jitter buffer."""
+        with self.lock:
+            buffer = self.buffers.get(data["sender"])
+            if buffer is None:
+                buffer = self.buffers[data["sender"]] = JitterBuffer()
+        buffer.push(data, now)
+
+    def mix(self):
+        """
+        Returns the next chunk of every participant's audio added together,
+        or None while nobody's is playing (the caller plays silence).
+        """
+        with self.lock:
+            buffers = list(self.buffers.values())
+        mixed = None
+        for buffer in buffers:
+            samples = buffer.pop()
+            if samples is None:
+                continue
+            if mixed is None:
+                mixed = np.zeros(len(samples), dtype=np.int32)
+            count = min(len(mixed), len(samples))
+            mixed[:count] += samples[:count]
+        if mixed is None:
+            return None
+        return np.clip(mixed, -32768, 32767).astype(np.int16)
+
+    def decode_video(self, data):
+        """
+        Decodes one forwarded VIDEO_FRAME into its sender's newest frame.
+
+        Returns:
+            The VIDEO_FEEDBACK report (with the frame's "layer") to send
+            the sender, or None if none is due.
+        """
+        sender, layer = data["sender"], data["layer"]
+        with self.lock:
+            stream = self.streams.get((sender, layer))
+            if stream is None:
+                stream = self.streams[(sender, layer)] = (
+                    TileDecoder(),
+                    VideoFeedback(),
+                )
+            frames = self.frames.setdefault(sender, LatestFrame())
+        decoder, feedback = stream
+
+        seq = data.get("seq")
+        if seq is not None and feedback.last_seq is not None:
+            if seq > feedback.last_seq + 1:
+                decoder.reference = None
+        image = decoder.decode(data)
+        report = feedback.on_frame(data, undecodable=image is None)
+        if image is not None:
+            frames.publish(image)
+        if report is not None:
+            report["layer"] = layer
+        return report
+
+    def keep(self, participants):
+        """Forgets the audio and video of senders no longer in the call."""
+        with self.lock:
+            for sender in [s for s in self.buffers if s not in participants]:
+                del self.buffers[sender]
+            for key in [k for k in self.streams if k[0] not in participants]:
+                del self.streams[key]
+            for sender in [s for s in self.frames if s not in participants]:
+                del self.frames[sender]
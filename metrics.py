@@ -0,0 +1,256 @@
+"""
+Counters and latency histograms for the server's hot paths.
+
+Instrumentation is off by default: `active` is a NullMetrics whose methods
+do nothing, so an instrumented call site costs one empty method call.
+enable() swaps in a Metrics registry, which can then be read with
+snapshot(), served over HTTP with start_endpoint() or printed periodically
+with start_dump().
+"""
+
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds in seconds: 1 us doubling up to about 8 s
+BUCKETS = [1e-6 * 2**i for i in range(24)]
+
+
+class Histogram:
+    """
+    Fixed log-scale histogram of durations in seconds.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """Returns the upper bound of the bucket holding the given quantile."""
+        rank = fraction * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return 0.0
+
+    def snapshot(self):
+        """Returns count, mean, p50, p99 and max (microseconds)."""
+        mean = self.total / self.count if self.count else 0.0
+        return {
+            "count": self.count,
+            "mean_us": round(mean * 1e6, 1),
+            "p50_us": round(self.quantile(0.5) * 1e6, 1),
+            "p99_us": round(self.quantile(0.99) * 1e6, 1),
+            "max_us": round(self.max * 1e6, 1),
+        }
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, packet/byte totals, histograms and
+    gauges.
+
+    Counters and histograms are created on first use. Gauges are callables
+    evaluated when a snapshot is taken.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.packets = {}  # Map "direction.name" -> [packets, bytes]
+        self.histograms = {}
+        self.gauges = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def packet(self, direction, name, size):
+        """Counts one packet and its bytes, e.g. packet("in", "MSG", 120)."""
+        key = f"{direction}.{name}"
+        with self.lock:
+            entry = self.packets.get(key)
+            if entry is None:
+                entry = self.packets[key] = [0, 0]
+            entry[0] += 1
+            entry[1] += size
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def clock(self):
+        """Returns a start time for lap()."""
+        return time.perf_counter()
+
+    def lap(self, name, start):
+        """
+        Records the time since `start` in a histogram.
+
+        Returns:
+            The current time, to be used as the start of the next lap.
+        """
+        now = time.perf_counter()
+        self.observe(name, now - start)
+        return now
+
+    def gauge(self, name, func):
+        """Registers a callable whose result is included in every snapshot."""
+        self.gauges[name] = func
+
+    def wrap_lock(self, name, lock):
+        """Returns a lock that records how long each acquire waited."""
+        return TimedLock(self, name, lock)
+
+    def snapshot(self):
+        """Returns every counter, packet total, histogram and gauge as plain data."""
+        with self.lock:
+            counters = dict(self.counters)
+            packets = {
+                key: {"packets": entry[0], "bytes": entry[1]}
+                for key, entry in self.packets.items()
+            }
+            histograms = {
+                name: histogram.snapshot()
+                for name, histogram in self.histograms.items()
+            }
+        gauges = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "counters": counters,
+            "packets": packets,
+            "histograms": histograms,
+            "gauges": gauges,
+        }
+
+
+class NullMetrics:
+    """
+    Disabled registry: every method is a no-op.
+    """
+
+    enabled = False
+
+    def count(self, name, amount=1):
+        pass
+
+    def packet(self, direction, name, size):
+        pass
+
+    def observe(self, name, seconds):
+        pass
+
+    def clock(self):
+        return 0.0
+
+    def lap(self, name, start):
+        return 0.0
+
+    def gauge(self, name, func):
+        pass
+
+    def wrap_lock(self, name, lock):
+        return lock
+
+    def snapshot(self):
+        return {}
+
+
+class TimedLock:
+    """
+    Lock wrapper that records acquire wait times in a histogram.
+    """
+
+    def __init__(self, metrics, name, lock):
+        self.metrics = metrics
+        self.name = name
+        self.inner = lock
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.inner.acquire(blocking, timeout)
+        self.metrics.observe(self.name, time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.inner.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# The registry used by every instrumented call site
+active = NullMetrics()
+
+
+def enable():
+    """Turns instrumentation on and returns the active Metrics registry."""
+    global active
+    if not active.enabled:
+        active = Metrics()
+    return active
+
+
+def start_endpoint(port, host="127.0.0.1"):
+    """
+    Serves the active registry's snapshot as JSON on http://host:port/.
+
+    Returns:
+        The running HTTP server.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(active.snapshot(), indent=2).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_dump(interval):
+    """Prints the active registry's snapshot every `interval` seconds."""
+
+    def dump():
+        while True:
+            time.sleep(interval)
+            print(f"[METRICS] {json.dumps(active.snapshot())}")
+
+    threading.Thread(target=dump, daemon=True).start()
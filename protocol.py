@@ -1,20 +1,37 @@
+import os
 import socket
 import struct
 import msgpack
+import metrics
 import threading
-from cryptography.fernet import Fernet
+import time
+import zlib
+from collections import deque
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 # Default encryption key for Fernet cipher
 DEFAULT_KEY = b"WnZo5y1XoXFzZ2_gTq3yF6X-Yt4ou9kEz2wV2xY1l8c="
-cipher = Fernet(DEFAULT_KEY)
 
 # Network configuration constants
 PORT = 5050
 HEADER_LENGTH = 4  # Size of the header containing payload length
 BUFFER_SIZE = 4096
+RECV_BUFFER_SIZE = 64 * 1024  # Initial size of a per-connection receive buffer
+MAX_RETAINED_BUFFER = 1024 * 1024  # Larger payloads get a one-off buffer
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Largest payload accepted: a 10 MB file, encrypted
 ADDR = ("0.0.0.0", PORT)
 DISCONNECT_MSG = "!DISCONNECT"
 
+# Media relay framing: payload = marker, route length, route, opaque body.
+# Regular payloads start with a cipher token (see CIPHER_IDS) or a msgpack
+# map, never 0.
+RELAY_MARKER = 0
+RELAY_HEADER = struct.Struct(">BH")
+
 # Command constants for different protocol actions
 CMD_LOGIN = "LOGIN"
 CMD_MSG = "MSG"
@@ -27,38 +44,832 @@ CMD_LIST_UPDATE = "LIST"
 CMD_ACCEPT_CALL = "ACCEPT_CALL"
 CMD_END_CALL = "END_CALL"
 
+# Video rate control: VIDEO_FRAME data carries a "seq" number and the
+# sender's clock "ts"; the receiver answers every FEEDBACK_INTERVAL with a
+# VIDEO_FEEDBACK relay packet {"echo": newest ts, "received", "expected"},
+# from which the sender measures round trip and loss (media_utils.py).
+CMD_VIDEO_FEEDBACK = "VIDEO_FEEDBACK"
+RELAY_COMMANDS = [CMD_VIDEO, CMD_AUDIO, CMD_VIDEO_FEEDBACK]
+
+# Group calls (calls.py): CMD_CALL_JOIN {"codecs"} puts a client in the call
+# of its current room, CMD_CALL_LEAVE takes it out, and every participant
+# gets CMD_CALL_STATE {"room", "participants", "speakers", "videos",
+# "codecs"} when those change. Call media are relay frames routed by
+# {"call": room} instead of "target"; audio adds the chunk's "level" and
+# video its "layer" for the server to choose what to forward. Receivers
+# see "sender" and the route fields, and send VIDEO_FEEDBACK (with "layer")
+# to the sender as in a 1:1 call.
+CMD_CALL_JOIN = "CALL_JOIN"
+CMD_CALL_LEAVE = "CALL_LEAVE"
+CMD_CALL_STATE = "CALL_STATE"
+LAYER_LOW = 0  # Small video, sent by participants in "videos"
+LAYER_HIGH = 1  # Full-size video, sent by the "speakers"
+SILENCE_LEVEL = -127  # dBov of a silent audio chunk, the lowest level
+
+# Presence: a versioned CMD_LIST_UPDATE snapshot on login, then CMD_PRESENCE
+# batches {"since", "version", <event>: [names]} that move a client's lists
+# from one version to the next. Clients that see a version gap send an empty
+# CMD_LIST_UPDATE to ask for a fresh snapshot.
+CMD_PRESENCE = "PRESENCE"
+PRESENCE_USER_JOINED = "joined"
+PRESENCE_USER_LEFT = "left"
+PRESENCE_ROOM_ADDED = "rooms"
+PRESENCE_EVENTS = [PRESENCE_USER_JOINED, PRESENCE_USER_LEFT, PRESENCE_ROOM_ADDED]
+PRESENCE_COALESCE = 0.05  # Seconds presence changes are batched before sending
+
+# Message history: CMD_HISTORY {"room"} or {"with": user}, optional "limit"
+# and "before"; the reply repeats the key and carries "messages" (oldest
+# first) and "start", the "before" of the previous page (0 at the beginning)
+CMD_HISTORY = "HISTORY"
+HISTORY_LIMIT = 50  # Messages per page unless the client asks otherwise
+HISTORY_MAX = 500  # Largest page a client may ask for
+
+# Chunked file transfer: offer, chunks acknowledged by the server, complete
+CMD_FILE_OFFER = "FILE_OFFER"
+CMD_FILE_CHUNK = "FILE_CHUNK"
+CMD_FILE_ACK = "FILE_ACK"
+CMD_FILE_COMPLETE = "FILE_COMPLETE"
+FILE_CHUNK_SIZE = 64 * 1024  # Bytes of file data per FILE_CHUNK
+FILE_WINDOW = 8  # Chunks a sender may have in flight before waiting for acks
+
+# Resumable transfers: chunks carry a CRC-32 "crc" of their data, and the
+# server keeps a transfer whose sender disconnected for RESUME_TIMEOUT
+# seconds. An offer repeated with "resume": True on a new connection (same
+# username and transfer_id) is answered with FILE_ACK {"offset", "resume":
+# True}: the offset the sender continues from. The same ack rewinds the
+# sender when a chunk fails its checksum or arrives out of order.
+RESUME_TIMEOUT = 300
+
+# Stored files: an offer carrying the file's SHA-256 "hash" is uploaded into
+# the server's file store (or skipped if the store has it: the FILE_ACK then
+# says "stored"), and recipients get a FILE_REF {"hash", "filename", "size",
+# "from"} instead of the bytes. Clients that log in with "file_refs" get refs
+# for whole-file CMD_FILE packets too. A FILE_GET {"hash", "offset",
+# "length"} is answered with FILE_DATA chunks {"hash", "offset", "data",
+# "crc"} ({"missing": True} if the store no longer has the file).
+CMD_FILE_REF = "FILE_REF"
+CMD_FILE_GET = "FILE_GET"
+CMD_FILE_DATA = "FILE_DATA"
+FILE_RANGE = FILE_WINDOW * FILE_CHUNK_SIZE  # Largest range one FILE_GET returns
+
+# Outbound queue lanes, highest priority first
+KIND_CONTROL = "control"  # Chat, presence and signalling: never dropped
+KIND_AUDIO = "audio"  # Audio chunks: oldest dropped when the lane is full
+KIND_VIDEO = "video"  # Video frames: oldest dropped when the lane is full
+KIND_FILE = "file"  # File offers, chunks and completion: never dropped
+LANES = [KIND_CONTROL, KIND_AUDIO, KIND_VIDEO, KIND_FILE]
+DROPPABLE_LANES = {KIND_AUDIO, KIND_VIDEO}
 
-def send_packet(sock, cmd_type, data_dict, is_encrypted=True):
+# Slow-consumer policy defaults
+MAX_MEDIA_QUEUE = 32  # Frames per media lane before dropping the oldest
+BACKLOG_TIMEOUT = 10.0  # Seconds the oldest queued frame may wait before disconnect
+NOTSENT_LOWAT = 64 * 1024  # Unsent bytes the kernel may hold per socket
+
+# Ciphers: the first byte of every encrypted payload names its cipher, so a
+# receiver can decrypt any token whatever was negotiated for its own sends.
+CIPHER_FERNET = "fernet"  # Base64 AES-CBC + HMAC tokens; always starts with "g"
+CIPHER_AESGCM = "aesgcm"
+CIPHER_CHACHA20 = "chacha20"
+CIPHER_IDS = {CIPHER_FERNET: 0x67, CIPHER_AESGCM: 1, CIPHER_CHACHA20: 2}
+CIPHER_PREFERENCE = [CIPHER_AESGCM, CIPHER_CHACHA20, CIPHER_FERNET]
+CMD_LOGIN_ACK = "LOGIN_ACK"
+
+
+class FernetCipher:
     """
-    Sends a packet to the specified socket.
+    The original Fernet cipher, kept for clients that do not negotiate.
+    """
+
+    name = CIPHER_FERNET
+
+    def __init__(self, key=DEFAULT_KEY):
+        self.fernet = Fernet(key)
+
+    def encrypt(self, data):
+        return self.fernet.encrypt(bytes(data))
+
+    def decrypt(self, token):
+        # Fernet only accepts bytes, so this is the one copy of a view
+        return self.fernet.decrypt(bytes(token))
+
+
+class AEADCipher:
+    """
+    AEAD cipher working on raw bytes.
+
+    Tokens are the cipher id byte, a random 12-byte nonce, then the
+    ciphertext and 16-byte tag: 29 bytes of overhead and no base64.
+    The key is derived from the shared key with HKDF, one per algorithm.
+    """
+
+    NONCE_SIZE = 12
+
+    def __init__(self, name, algorithm, key=DEFAULT_KEY):
+        self.name = name
+        self.prefix = bytes([CIPHER_IDS[name]])
+        derived = HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=name.encode()
+        ).derive(key)
+        self.aead = algorithm(derived)
+
+    def encrypt(self, data):
+        nonce = os.urandom(self.NONCE_SIZE)
+        return b"".join([self.prefix, nonce, self.aead.encrypt(nonce, data, None)])
+
+    def decrypt(self, token):
+        view = memoryview(token)
+        nonce_end = 1 + self.NONCE_SIZE
+        return self.aead.decrypt(view[1:nonce_end], view[nonce_end:], None)
+
+
+CIPHERS = {
+    CIPHER_FERNET: FernetCipher(),
+    CIPHER_AESGCM: AEADCipher(CIPHER_AESGCM, AESGCM),
+    CIPHER_CHACHA20: AEADCipher(CIPHER_CHACHA20, ChaCha20Poly1305),
+}
+CIPHERS_BY_ID = {CIPHER_IDS[name]: c for name, c in CIPHERS.items()}
+
+# Default cipher for connections that have not negotiated one
+DEFAULT_CIPHER = CIPHERS[CIPHER_FERNET]
+cipher = DEFAULT_CIPHER
+
+
+def get_cipher(name):
+    """Returns the cipher registered under a name, or the default cipher."""
+    return CIPHERS.get(name, DEFAULT_CIPHER)
+
+
+def negotiate_cipher(offered):
+    """
+    Picks the cipher to use with a peer.
+
+    Args:
+        offered: Cipher names the peer supports, or None for old clients.
+
+    Returns:
+        The most preferred cipher both sides support, Fernet otherwise.
+    """
+    for name in CIPHER_PREFERENCE:
+        if name in (offered or ()):
+            return CIPHERS[name]
+    return DEFAULT_CIPHER
+
+
+def cipher_for_token(token):
+    """Returns the cipher that produced an encrypted payload."""
+    try:
+        return CIPHERS_BY_ID[token[0]]
+    except (IndexError, KeyError):
+        raise ValueError("Unknown cipher token") from None
+
+
+def encode_packet(cmd_type, data_dict, is_encrypted=True, cipher=None):
+    """
+    Serializes a packet into its on-the-wire form.
 
     Args:
-        sock: The socket object to send data to.
         cmd_type: The type of command (e.g., CMD_MSG, CMD_LOGIN).
         data_dict: A dictionary containing the data payload.
         is_encrypted: Boolean flag to determine if payload should be encrypted.
+        cipher: Cipher to encrypt with; defaults to the module's Fernet cipher.
 
     Returns:
-        True if successful, False otherwise.
+        The length header followed by the (optionally encrypted) payload.
     """
-    try:
-        if sock is None or sock.fileno() == -1:
+    timer = metrics.active
+    start = timer.clock()
+
+    # Prepare the payload
+    payload = {"type": cmd_type, "data": data_dict}
+    final_payload = msgpack.packb(payload)
+    start = timer.lap("pack", start)
+
+    if is_encrypted:
+        final_payload = (cipher or DEFAULT_CIPHER).encrypt(final_payload)
+        timer.lap("encrypt", start)
+
+    # Create header with payload length
+    header = struct.pack(">I", len(final_payload))
+    return header + final_payload
+
+
+def encode_relay_frame(cmd_type, route, body):
+    """
+    Builds a media relay frame around an already encoded body.
+
+    Args:
+        cmd_type: The media command (one of RELAY_COMMANDS).
+        route: Unencrypted routing fields (e.g., {"target": ...}).
+        body: The opaque, already encrypted body bytes.
+
+    Returns:
+        The length header followed by the relay payload.
+    """
+    route_bytes = msgpack.packb(dict(route, type=cmd_type))
+    payload_length = RELAY_HEADER.size + len(route_bytes) + len(body)
+    return b"".join(
+        [
+            struct.pack(">I", payload_length),
+            RELAY_HEADER.pack(RELAY_MARKER, len(route_bytes)),
+            route_bytes,
+            body,
+        ]
+    )
+
+
+def encode_routed_packet(cmd_type, route, data_dict, is_encrypted=True, cipher=None):
+    """
+    Serializes a media packet as a relay frame: the routing fields stay
+    readable by the server, the media fields are encrypted.
+
+    Args:
+        cmd_type: The media command (one of RELAY_COMMANDS).
+        route: Routing fields: {"target": username} for a 1:1 call, or
+            {"call": room} plus "layer" or "level" for a group call.
+        data_dict: The media fields (e.g., {"frame": ...}).
+        is_encrypted: Boolean flag to determine if the body should be encrypted.
+        cipher: Cipher to encrypt with; defaults to the module's Fernet cipher.
+
+    Returns:
+        The encoded relay frame.
+    """
+    body = msgpack.packb(data_dict)
+    if is_encrypted:
+        body = (cipher or DEFAULT_CIPHER).encrypt(body)
+    return encode_relay_frame(cmd_type, route, body)
+
+
+def encode_relay_packet(cmd_type, target, data_dict, is_encrypted=True, cipher=None):
+    """
+    Serializes a media packet addressed to one user, whose routing header
+    the server can read without decrypting the body.
+
+    Args:
+        cmd_type: The media command (one of RELAY_COMMANDS).
+        target: Username the media is addressed to.
+        data_dict: The media fields (e.g., {"frame": ...}).
+        is_encrypted: Boolean flag to determine if the body should be encrypted.
+        cipher: Cipher to encrypt with; defaults to the module's Fernet cipher.
+
+    Returns:
+        The encoded relay frame.
+    """
+    route = {"target": target}
+    return encode_routed_packet(cmd_type, route, data_dict, is_encrypted, cipher)
+
+
+def is_relay_payload(payload):
+    """Returns True if a payload uses the media relay framing."""
+    return len(payload) > 0 and payload[0] == RELAY_MARKER
+
+
+def split_relay_payload(payload):
+    """
+    Separates a relay payload into its routing header and opaque body.
+
+    Returns:
+        A tuple of (route dictionary, body memoryview).
+    """
+    view = memoryview(payload)
+    marker, route_length = RELAY_HEADER.unpack_from(view)
+    body_start = RELAY_HEADER.size + route_length
+    route = msgpack.unpackb(view[RELAY_HEADER.size : body_start], raw=False)
+    return route, view[body_start:]
+
+
+def decode_payload(payload, is_encrypted=True):
+    """
+    Decrypts and unpacks a payload received without its length header.
+
+    Relay payloads are returned in the regular packet shape, with the
+    routing fields merged into the data dictionary.
+
+    Args:
+        payload: The raw payload as bytes or a memoryview.
+        is_encrypted: Boolean flag to indicate if the payload is encrypted.
+            The cipher is identified from the token itself.
+
+    Returns:
+        The unpacked payload dictionary.
+    """
+    if is_relay_payload(payload):
+        route, body = split_relay_payload(payload)
+        data = decode_payload(body, is_encrypted)
+        if not isinstance(route, dict) or not isinstance(data, dict):
+            raise ValueError("Malformed relay payload")
+        cmd_type = route.pop("type")
+        data.update(route)
+        return {"type": cmd_type, "data": data}
+
+    timer = metrics.active
+    start = timer.clock()
+    if is_encrypted:
+        payload = cipher_for_token(payload).decrypt(payload)
+        start = timer.lap("decrypt", start)
+
+    packet = msgpack.unpackb(payload, raw=False)
+    timer.lap("unpack", start)
+    return packet
+
+
+class FrameTooLarge(ValueError):
+    """A length header claims more than the reader accepts."""
+
+
+# What decode_payload raises for a damaged, forged or foreign payload
+DECODE_ERRORS = (
+    InvalidToken,
+    InvalidTag,
+    ValueError,
+    KeyError,
+    struct.error,
+    msgpack.UnpackException,
+)
+
+
+class ReceiveBuffer:
+    """
+    Reusable receive buffer for one connection.
+
+    Payloads are read straight into a preallocated bytearray with recv_into
+    and handed on as a memoryview, so receiving a packet does not build up
+    intermediate bytes objects. The buffer grows to fit payloads up to
+    MAX_RETAINED_BUFFER; anything larger is read into a one-off buffer so a
+    single big file does not pin its size in memory for the connection's
+    lifetime. Lengths above `max_size` are refused before anything is
+    allocated, since the header is whatever the peer sent.
+    """
+
+    def __init__(self, size=RECV_BUFFER_SIZE, max_size=MAX_FRAME_SIZE):
+        self.header = bytearray(HEADER_LENGTH)
+        self.buffer = bytearray(size)
+        self.max_size = max_size
+
+    def view(self, length):
+        """
+        Returns a writable memoryview of exactly `length` bytes.
+
+        Raises:
+            FrameTooLarge: `length` is above max_size.
+        """
+        if length > self.max_size:
+            raise FrameTooLarge(f"{length} byte payload")
+        if length > len(self.buffer):
+            if length > MAX_RETAINED_BUFFER:
+                return memoryview(bytearray(length))
+            self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+        return memoryview(self.buffer)[:length]
+
+
+def recv_exact_into(sock, view):
+    """
+    Fills a memoryview completely from the socket.
+
+    Returns:
+        True once the view is full, False if the connection closed first.
+    """
+    received = 0
+    length = len(view)
+    while received < length:
+        count = sock.recv_into(view[received:], length - received)
+        if not count:
+            return False
+        received += count
+    return True
+
+
+class FrameReader:
+    """
+    Stateful length-prefixed frame reader for one socket.
+
+    Each fill() performs a single recv_into of up to a whole buffer, and
+    frames() then yields every complete frame found in it, so a burst of
+    small packets costs one syscall instead of two per packet. A partial
+    frame left at the end of the buffer is moved to the front before the
+    next read, and the buffer only grows when a single frame does not fit.
+    A header claiming more than `max_size` ends the connection before the
+    buffer is grown for it.
+    """
+
+    def __init__(
+        self, sock, is_encrypted=True, size=RECV_BUFFER_SIZE, max_size=MAX_FRAME_SIZE
+    ):
+        self.sock = sock
+        self.is_encrypted = is_encrypted
+        self.size = size
+        self.max_size = max_size
+        self.buffer = bytearray(size)
+        self.start = 0  # Offset of the first unconsumed byte
+        self.end = 0  # Offset one past the last received byte
+
+    def pending_length(self):
+        """Returns the full size of the frame at the read offset, if known."""
+        if self.end - self.start < HEADER_LENGTH:
+            return HEADER_LENGTH
+        return HEADER_LENGTH + struct.unpack_from(">I", self.buffer, self.start)[0]
+
+    def check_pending(self, needed):
+        """Raises FrameTooLarge if a frame of `needed` bytes is above max_size."""
+        if needed - HEADER_LENGTH > self.max_size:
+            raise FrameTooLarge(f"{needed - HEADER_LENGTH} byte payload")
+
+    def make_room(self):
+        """
+        Compacts or grows the buffer so the pending frame fits.
+
+        Raises:
+            FrameTooLarge: The pending frame is above max_size.
+        """
+        needed = self.pending_length()
+        self.check_pending(needed)
+        leftover = self.end - self.start
+
+        if needed > len(self.buffer):
+            new_buffer = bytearray(needed)
+            new_buffer[:leftover] = self.buffer[self.start : self.end]
+            self.buffer = new_buffer
+        elif self.start + needed > len(self.buffer):
+            self.buffer[:leftover] = self.buffer[self.start : self.end]
+        else:
+            return
+
+        self.start = 0
+        self.end = leftover
+
+    def fill(self):
+        """
+        Performs one recv_into into the free space of the buffer.
+
+        Returns:
+            The number of bytes received, 0 if the connection closed.
+
+        Raises:
+            FrameTooLarge: The pending frame is above max_size.
+        """
+        self.make_room()
+        view = memoryview(self.buffer)[self.end :]
+        count = self.sock.recv_into(view, len(view))
+        self.end += count
+        self.check_pending(self.pending_length())  # Before any more arrives
+        return count
+
+    def frames(self):
+        """Yields a memoryview of every complete payload currently buffered."""
+        while self.end - self.start >= HEADER_LENGTH:
+            frame_length = self.pending_length()
+            if self.end - self.start < frame_length:
+                break
+
+            payload_start = self.start + HEADER_LENGTH
+            self.start += frame_length
+            yield memoryview(self.buffer)[payload_start : self.start]
+
+        if self.start == self.end:
+            self.start = self.end = 0
+            # Drop a buffer that was grown for one oversized frame
+            if len(self.buffer) > MAX_RETAINED_BUFFER:
+                self.buffer = bytearray(self.size)
+
+    def payloads(self):
+        """
+        Yields raw payload views until the connection closes or the peer
+        announces a frame above max_size.
+        """
+        try:
+            while self.fill():
+                yield from self.frames()
+        except FrameTooLarge as e:
+            print(f"[PROTOCOL] Dropping connection: {e}")
+        except OSError:
+            return
+
+    def packets(self):
+        """
+        Yields decoded packets until the connection closes or a frame fails
+        to decode.
+        """
+        try:
+            for payload in self.payloads():
+                yield decode_payload(payload, self.is_encrypted)
+        except DECODE_ERRORS as e:
+            print(f"[PROTOCOL] Dropping connection: undecodable packet ({e!r})")
+
+
+def chunk_checksum(data):
+    """Returns the CRC-32 sent with a file chunk as its "crc"."""
+    return zlib.crc32(data)
+
+
+def chunk_intact(chunk):
+    """Returns False if a chunk's data does not match its "crc" (if any)."""
+    return "crc" not in chunk or chunk["crc"] == zlib.crc32(chunk["data"])
+
+
+class AckWindow:
+    """
+    Sliding window flow control for one outgoing file transfer.
+
+    The sending thread calls wait() before each chunk and blocks while more
+    than FILE_WINDOW chunks are unacknowledged; the receiving thread calls
+    ack() for every FILE_ACK, and resume() when the server asks the sender
+    to continue from an earlier offset.
+    """
+
+    def __init__(self, window=FILE_WINDOW * FILE_CHUNK_SIZE):
+        self.window = window
+        self.acked = 0  # Highest offset acknowledged by the server
+        self.cancelled = False
+        self.finished = False  # The server has the whole file already
+        self.restart = None  # Offset to continue from, set by resume()
+        self.condition = threading.Condition()
+
+    def wait(self, offset, timeout=30, drain=False):
+        """
+        Blocks until `offset` is within the window of acknowledged bytes, or
+        with drain=True until everything up to `offset` is acknowledged. A
+        pending restart ends the wait early.
+
+        Returns:
+            True if the sender may continue, False on cancel or timeout.
+        """
+        window = 1 if drain else self.window
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.cancelled or self.can_send(offset, window), timeout
+            )
+            return not self.cancelled and self.can_send(offset, window)
+
+    def can_send(self, offset, window):
+        return self.finished or self.restart is not None or offset - self.acked < window
+
+    def ack(self, offset):
+        """Records an acknowledged offset and wakes the sender."""
+        with self.condition:
+            self.acked = max(self.acked, offset)
+            self.condition.notify_all()
+
+    def resume(self, offset):
+        """Makes the sender continue from `offset` and wakes it."""
+        with self.condition:
+            self.acked = offset
+            self.restart = offset
+            self.condition.notify_all()
+
+    def take_restart(self):
+        """
+        Returns the offset the sender must continue from, or None to carry
+        on where it is.
+        """
+        with self.condition:
+            restart, self.restart = self.restart, None
+            return restart
+
+    def finish(self):
+        """Ends the transfer early because the server needs no more chunks."""
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def cancel(self):
+        """Aborts the transfer and wakes the sender."""
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+
+class SendQueue:
+    """
+    Bounded, prioritized outbound queue for one connection.
+
+    Frames are queued in per-kind lanes and written control first, then
+    audio, video and file data, so chat never waits behind media or bulk
+    transfers (prioritized=False keeps plain arrival order instead). Each
+    media lane holds at most max_media frames and pushes out its oldest
+    frame when full; control and file frames are never dropped.
+    is_stalled() reports a recipient whose oldest frame has waited longer
+    than backlog_timeout so the owner can disconnect it. Every on_sent
+    callback runs exactly once: after the frame is written, or when it is
+    dropped or discarded by close().
+    """
+
+    def __init__(
+        self,
+        max_media=MAX_MEDIA_QUEUE,
+        backlog_timeout=BACKLOG_TIMEOUT,
+        prioritized=True,
+    ):
+        self.max_media = max_media
+        self.backlog_timeout = backlog_timeout
+        self.prioritized = prioritized
+        self.lanes = {kind: deque() for kind in LANES}
+        self.sequence = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        # Metrics
+        self.queued_bytes = 0
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def depth(self, kind):
+        """Returns the number of frames waiting in one lane."""
+        with self.condition:
+            return len(self.lanes[kind])
+
+    def put(self, frame, kind=KIND_CONTROL, on_sent=None):
+        """
+        Queues a frame for writing.
+
+        Returns:
+            True if queued, False if the queue is closed.
+        """
+        discarded = None
+        with self.condition:
+            queued = not self.closed
+            if not queued:
+                discarded = on_sent
+            else:
+                lane = self.lanes[kind]
+                if kind in DROPPABLE_LANES and len(lane) >= self.max_media:
+                    oldest = lane.popleft()
+                    self.queued_bytes -= len(oldest[1])
+                    self.dropped += 1
+                    discarded = oldest[2]
+
+                self.sequence += 1
+                lane.append((self.sequence, frame, on_sent, time.monotonic()))
+                self.queued_bytes += len(frame)
+                self.max_depth = max(self.max_depth, len(self))
+                self.condition.notify()
+
+        # Callbacks run outside the lock as they may queue more frames
+        if discarded:
+            discarded()
+        return queued
+
+    def pop(self):
+        """Removes the next item to write. Caller holds the condition."""
+        lanes = [lane for lane in self.lanes.values() if lane]
+        if self.prioritized:
+            lane = lanes[0]
+        else:
+            lane = min(lanes, key=lambda lane: lane[0][0])
+        item = lane.popleft()
+        self.queued_bytes -= len(item[1])
+        self.sent += 1
+        return item[1], item[2]
+
+    def get(self):
+        """
+        Blocks until a frame is available.
+
+        Returns:
+            A tuple of (frame, on_sent), or None once the queue is closed.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or len(self))
+            if self.closed:
+                return None
+            return self.pop()
+
+    def get_nowait(self):
+        """Returns (frame, on_sent) if a frame is queued, otherwise None."""
+        with self.condition:
+            if self.closed or not len(self):
+                return None
+            return self.pop()
+
+    def backlog_age(self):
+        """Returns how long the oldest queued frame has been waiting."""
+        with self.condition:
+            oldest = [lane[0][3] for lane in self.lanes.values() if lane]
+        return time.monotonic() - min(oldest) if oldest else 0.0
+
+    def is_stalled(self):
+        """
+        Returns True once the backlog is older than backlog_timeout
+        (never if backlog_timeout is None).
+        """
+        if self.backlog_timeout is None:
+            return False
+        return self.backlog_age() > self.backlog_timeout
+
+    def close(self):
+        """Discards queued frames, runs their callbacks and wakes the writer."""
+        with self.condition:
+            self.closed = True
+            pending = [item for lane in self.lanes.values() for item in lane]
+            for lane in self.lanes.values():
+                lane.clear()
+            self.queued_bytes = 0
+            self.condition.notify_all()
+
+        for item in pending:
+            if item[2]:
+                item[2]()
+
+    def stats(self):
+        """Returns a snapshot of the queue's depth and counters."""
+        with self.condition:
+            return {
+                "depth": len(self),
+                "bytes": self.queued_bytes,
+                "max_depth": self.max_depth,
+                "sent": self.sent,
+                "dropped": self.dropped,
+            }
+
+
+class PacketSender:
+    """
+    Prioritized SendQueue drained by a dedicated writer thread.
+
+    Any thread may queue packets without holding a lock; the writer is the
+    only thread that writes to the socket.
+    """
+
+    def __init__(self, sock, queue=None, cipher=None):
+        self.sock = sock
+        self.queue = queue or SendQueue()
+        self.cipher = cipher or DEFAULT_CIPHER  # Switched once negotiated
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send_packet(self, cmd_type, data_dict, kind=KIND_CONTROL, on_sent=None):
+        """
+        Encodes a packet and queues it on the given lane.
+
+        Returns:
+            True if queued, False if the sender is closed or encoding failed.
+        """
+        try:
+            frame = encode_packet(cmd_type, data_dict, cipher=self.cipher)
+        except Exception as e:
+            print(f"[PROTOCOL SEND ERROR] {e}")
             return False
+        return self.queue.put(frame, kind, on_sent)
+
+    def send_frame(self, frame, kind=KIND_CONTROL, on_sent=None):
+        """Queues an already encoded frame on the given lane."""
+        return self.queue.put(frame, kind, on_sent)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            frame, on_sent = item
+            ok = send_frame(self.sock, frame)
+            if on_sent:
+                on_sent()
+            if not ok:
+                self.queue.close()
+                break
+
+    def close(self):
+        """Discards anything still queued and stops the writer."""
+        self.queue.close()
+
+
+def limit_unsent(sock):
+    """
+    Caps the unsent data the kernel buffers for a socket.
+
+    Without this the kernel accepts megabytes ahead of the receiver, and
+    frames sitting there can no longer be overtaken by higher priority
+    lanes. Not every platform supports the option.
+    """
+    if hasattr(socket, "TCP_NOTSENT_LOWAT"):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, NOTSENT_LOWAT)
+        except OSError:
+            pass
+
 
-        # Prepare the payload
-        payload = {"type": cmd_type, "data": data_dict}
-        packed_payload = msgpack.packb(payload)
+def send_frame(sock, frame):
+    """
+    Sends a frame built by encode_packet to the specified socket.
 
-        final_payload = packed_payload
-        if is_encrypted:
-            final_payload = cipher.encrypt(packed_payload)
+    The same frame can be sent to any number of sockets, so fan-out only
+    pays for serialization and encryption once.
 
-        # Create header with payload length
-        length = len(final_payload)
-        header = struct.pack(">I", length)
+    Args:
+        sock: The socket object to send data to.
+        frame: The encoded frame bytes (header followed by payload).
 
-        # Send header followed by payload
-        sock.sendall(header + final_payload)
+    Returns:
+        True if successful, False otherwise.
+    """
+    try:
+        if sock is None or sock.fileno() == -1:
+            return False
+
+        sock.sendall(frame)
         return True
     except OSError as e:
         if e.errno == 10038:
@@ -71,41 +882,86 @@ def send_packet(sock, cmd_type, data_dict, is_encrypted=True):
         return False
 
 
-def receive_packet(sock, is_encrypted=True):
+def send_packet(sock, cmd_type, data_dict, is_encrypted=True, cipher=None):
+    """
+    Sends a packet to the specified socket.
+
+    Args:
+        sock: The socket object to send data to.
+        cmd_type: The type of command (e.g., CMD_MSG, CMD_LOGIN).
+        data_dict: A dictionary containing the data payload.
+        is_encrypted: Boolean flag to determine if payload should be encrypted.
+        cipher: Cipher to encrypt with; defaults to the module's Fernet cipher.
+
+    Returns:
+        True if successful, False otherwise.
+    """
+    try:
+        frame = encode_packet(cmd_type, data_dict, is_encrypted, cipher)
+    except Exception as e:
+        print(f"[PROTOCOL SEND ERROR] {e}")
+        return False
+
+    # Send header followed by payload
+    return send_frame(sock, frame)
+
+
+def send_relay_packet(
+    sock, cmd_type, target, data_dict, is_encrypted=True, cipher=None
+):
+    """
+    Sends a media packet using the relay framing.
+
+    Args:
+        sock: The socket object to send data to.
+        cmd_type: The media command (one of RELAY_COMMANDS).
+        target: Username the media is addressed to.
+        data_dict: The media fields (e.g., {"frame": ...}).
+        is_encrypted: Boolean flag to determine if the body should be encrypted.
+        cipher: Cipher to encrypt with; defaults to the module's Fernet cipher.
+
+    Returns:
+        True if successful, False otherwise.
+    """
+    try:
+        frame = encode_relay_packet(cmd_type, target, data_dict, is_encrypted, cipher)
+    except Exception as e:
+        print(f"[PROTOCOL SEND ERROR] {e}")
+        return False
+
+    return send_frame(sock, frame)
+
+
+def receive_packet(sock, is_encrypted=True, buffer=None):
     """
     Receives a packet from the specified socket.
 
     Args:
         sock: The socket object to receive data from.
         is_encrypted: Boolean flag to indicate if the incoming payload is encrypted.
+        buffer: Optional ReceiveBuffer reused across calls on the same socket.
 
     Returns:
         The unpacked payload dictionary, or None if an error occurs.
     """
     try:
+        if buffer is None:
+            buffer = ReceiveBuffer(0)
+
         # Read the header to get payload length
-        header = b""
-        while len(header) < HEADER_LENGTH:
-            chunk = sock.recv(HEADER_LENGTH - len(header))
-            if not chunk:
-                return None
-            header += chunk
+        if not recv_exact_into(sock, memoryview(buffer.header)):
+            return None
 
-        payload_length = struct.unpack(">I", header)[0]
+        payload_length = struct.unpack(">I", buffer.header)[0]
 
-        # Read the payload based on the length
-        payload = b""
-        while len(payload) < payload_length:
-            to_read = payload_length - len(payload)
-            read_size = min(to_read, BUFFER_SIZE)
-            chunk = sock.recv(read_size)
-            if not chunk:
-                return None
-            payload += chunk
+        # Read the payload straight into the buffer
+        payload = buffer.view(payload_length)
+        if not recv_exact_into(sock, payload):
+            return None
 
-        if is_encrypted:
-            payload = cipher.decrypt(payload)
-
-        return msgpack.unpackb(payload, raw=False)
-    except Exception as e:
+        return decode_payload(payload, is_encrypted)
+    except OSError:
+        return None
+    except DECODE_ERRORS as e:
+        print(f"[PROTOCOL] Undecodable packet: {e!r}")
         return None
@@ -0,0 +1,106 @@
+import threading
+
+
+class Room:
+    """
+    One chat room: its password and the set of member sessions.
+
+    Each room has its own lock, so joins, leaves and broadcasts in one room
+    never wait on traffic in another.
+    """
+
+    def __init__(self, name, password=None):
+        self.name = name
+        self.password = password
+        self.members = set()  # ClientSession objects
+        self.lock = threading.Lock()
+
+    def add(self, session):
+        with self.lock:
+            self.members.add(session)
+
+    def discard(self, session):
+        with self.lock:
+            self.members.discard(session)
+
+    def snapshot(self):
+        """Returns the current members as a list safe to iterate unlocked."""
+        with self.lock:
+            return list(self.members)
+
+
+class RoomRegistry:
+    """
+    Rooms by name.
+
+    The registry lock is only held to look up or create a room; membership
+    changes lock just the rooms involved.
+    """
+
+    def __init__(self, default="General"):
+        self.lock = threading.Lock()
+        self.rooms = {default: Room(default)}
+
+    def get(self, name):
+        """Returns the named Room, or None."""
+        with self.lock:
+            return self.rooms.get(name)
+
+    def names(self):
+        with self.lock:
+            return list(self.rooms.keys())
+
+    def all(self):
+        """Returns every Room."""
+        with self.lock:
+            return list(self.rooms.values())
+
+    def add(self, name, password=None):
+        """
+        Creates a room unless it already exists.
+
+        Returns:
+            A tuple of (room, created).
+        """
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is not None:
+                return room, False
+            room = self.rooms[name] = Room(name, password)
+            return room, True
+
+    def join(self, session, name, password=None):
+        """
+        Moves a session into a room, creating the room if it does not exist.
+
+        Args:
+            session: The ClientSession joining; its current_room is updated.
+            name: The room to join.
+            password: Password for an existing room, or for the new room.
+
+        Returns:
+            A tuple of (joined, created). joined is False if the password
+            did not match.
+        """
+        room, created = self.add(name, password)
+        old_room = self.get(session.current_room)
+
+        if room.password and room.password != password:
+            return False, False
+
+        if old_room is not None and old_room is not room:
+            old_room.discard(session)
+        room.add(session)
+        session.current_room = name
+        return True, created
+
+    def leave(self, session):
+        """Removes a session from its current room."""
+        room = self.get(session.current_room)
+        if room:
+            room.discard(session)
+
+    def members(self, name):
+        """Returns the sessions in a room (empty if it does not exist)."""
+        room = self.get(name)
+        return room.snapshot() if room else []
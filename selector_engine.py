@@ -0,0 +1,213 @@
+import heapq
+import itertools
+import selectors
+import socket
+import time
+from collections import deque
+
+import protocol
+
+
+class Connection:
+    """
+    Buffered state for one non-blocking client socket.
+    """
+
+    def __init__(self, sock, session, max_frame_size=protocol.MAX_FRAME_SIZE):
+        self.sock = sock
+        self.session = session
+        self.reader = protocol.FrameReader(sock, max_size=max_frame_size)
+        self.pending = None  # Unwritten rest of the frame being sent
+        self.on_sent = None  # Callback of the frame being sent
+        self.events = selectors.EVENT_READ
+        self.closed = False
+
+
+class SelectorEngine:
+    """
+    Single-threaded event loop engine for ChatServer.
+
+    All sockets are non-blocking and multiplexed with the platform's best
+    selector (epoll on Linux). Complete frames are dispatched to
+    ChatServer.handle_payload on the loop thread, and each session's send
+    queue is drained whenever its socket is writable.
+    """
+
+    def __init__(self, server, max_frame_size=protocol.MAX_FRAME_SIZE):
+        self.server = server
+        self.max_frame_size = max_frame_size  # Larger headers drop the connection
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}  # Map socket -> Connection
+        self.timers = []  # Heap of (deadline, sequence, callback)
+        self.sequence = itertools.count()
+        self.ready = deque()  # Callbacks handed over by other threads
+        self.waker, self.wake_sender = socket.socketpair()
+
+    def serve_forever(self):
+        """Runs the event loop until the process exits."""
+        listener = self.server.server_socket
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, None)
+        self.waker.setblocking(False)
+        self.wake_sender.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ, None)
+
+        while True:
+            for key, mask in self.selector.select(self.next_timeout()):
+                if key.fileobj is self.waker:
+                    self.run_ready()
+                    continue
+                if key.data is None:
+                    self.accept(key.fileobj)
+                    continue
+
+                conn = key.data
+                if mask & selectors.EVENT_READ:
+                    self.read(conn)
+                if mask & selectors.EVENT_WRITE and not conn.closed:
+                    self.flush(conn.sock)
+
+            self.run_timers()
+
+    def call_later(self, delay, callback):
+        """
+        Runs callback on the loop thread after `delay` seconds. Must itself
+        be called on the loop thread.
+        """
+        deadline = time.monotonic() + delay
+        heapq.heappush(self.timers, (deadline, next(self.sequence), callback))
+
+    def call_soon_threadsafe(self, callback):
+        """Runs callback on the loop thread; safe to call from any thread."""
+        self.ready.append(callback)
+        try:
+            self.wake_sender.send(b"\0")
+        except BlockingIOError:
+            pass  # Wakeup already pending
+
+    def run_ready(self):
+        """Runs callbacks handed over by call_soon_threadsafe."""
+        try:
+            while self.waker.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.ready:
+            callback = self.ready.popleft()
+            try:
+                callback()
+            except Exception as e:
+                print(f"[CALLBACK ERROR] {e}")
+
+    def next_timeout(self):
+        """Returns how long select may block before the next timer is due."""
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - time.monotonic())
+
+    def run_timers(self):
+        """Runs every timer whose deadline has passed."""
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            callback = heapq.heappop(self.timers)[2]
+            try:
+                callback()
+            except Exception as e:
+                print(f"[TIMER ERROR] {e}")
+
+    def accept(self, listener):
+        """Accepts a pending connection and registers it for reading."""
+        try:
+            sock, address = listener.accept()
+        except BlockingIOError:
+            return
+
+        sock.setblocking(False)
+        session = self.server.open_session(sock)
+        conn = Connection(sock, session, self.max_frame_size)
+        self.connections[sock] = conn
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def read(self, conn):
+        """Reads available bytes and dispatches every complete frame."""
+        try:
+            count = conn.reader.fill()
+        except BlockingIOError:
+            return
+        except protocol.FrameTooLarge as e:
+            print(f"[PROTOCOL] Dropping connection: {e}")
+            count = 0
+        except OSError:
+            count = 0
+
+        if not count:
+            self.drop(conn)
+            return
+
+        for payload in conn.reader.frames():
+            try:
+                self.server.handle_payload(conn.session, payload)
+            except Exception as e:
+                print(f"[ERROR] {conn.session.username}: {e}")
+                self.drop(conn)
+                return
+
+            if conn.closed:
+                return
+
+    def flush(self, sock):
+        """
+        Writes queued frames until the send queue is empty or the socket
+        would block, then selects for writability only while output remains.
+        """
+        conn = self.connections.get(sock)
+        if conn is None or conn.closed:
+            return
+
+        while True:
+            if conn.pending is None:
+                item = conn.session.queue.get_nowait()
+                if item is None:
+                    break
+                conn.pending = memoryview(item[0])
+                conn.on_sent = item[1]
+
+            try:
+                sent = sock.send(conn.pending)
+            except BlockingIOError:
+                break
+            except OSError:
+                self.drop(conn)
+                return
+
+            conn.pending = conn.pending[sent:]
+            if conn.pending:
+                break
+            self.frame_done(conn)
+
+        events = selectors.EVENT_READ
+        if conn.pending is not None:
+            events |= selectors.EVENT_WRITE
+        if events != conn.events:
+            conn.events = events
+            self.selector.modify(sock, events, conn)
+
+    def frame_done(self, conn):
+        """Finishes the frame in progress and runs its callback."""
+        on_sent = conn.on_sent
+        conn.pending = None
+        conn.on_sent = None
+        if on_sent:
+            on_sent()
+
+    def drop(self, conn):
+        """Unregisters a connection and lets the server clean up after it."""
+        if conn.closed:
+            return
+        conn.closed = True
+        if conn.pending is not None:
+            self.frame_done(conn)
+
+        self.selector.unregister(conn.sock)
+        del self.connections[conn.sock]
+        self.server.disconnect(conn.session)
@@ -1,6 +1,46 @@
+import argparse
+import multiprocessing
+import os
+import signal
 import socket
+import sys
+import tempfile
 import threading
+import uuid
+import metrics
 import protocol
+from bus import BusHub, connect_backplane
+from calls import CallRegistry
+from filestore import DEFAULT_CAPACITY, FileStore
+from history import MessageLog, conversation_key, room_key
+from rooms import RoomRegistry
+from selector_engine import SelectorEngine
+
+# Largest stored file sent as one CMD_FILE, so it still fits a frame encrypted
+MAX_INLINE_FILE = protocol.MAX_FRAME_SIZE * 2 // 3
+
+
+def valid_file_get(data):
+    """Returns whether a FILE_GET's optional "offset" and "length" are integers."""
+    return isinstance(data.get("offset", 0), int) and isinstance(
+        data.get("length", protocol.FILE_RANGE), int
+    )
+
+
+class ClientSession:
+    """
+    Per-connection state shared by every server engine.
+    """
+
+    def __init__(self, sock, queue):
+        self.sock = sock
+        self.username = ""
+        self.current_room = "General"
+        self.queue = queue  # Outbound SendQueue
+        self.cipher = protocol.cipher  # Cipher for outbound packets, set at login
+        self.presence_deltas = False  # Understands CMD_PRESENCE, set at login
+        self.file_refs = False  # Gets FILE_REF for whole-file CMD_FILE, set at login
+        self.relay = False  # Reads media relay frames, set at login
 
 
 class ChatServer:
@@ -8,23 +48,104 @@ class ChatServer:
     Main server class handling client connections, message routing, and room management.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        addr=protocol.ADDR,
+        engine="threaded",
+        max_media_queue=protocol.MAX_MEDIA_QUEUE,
+        backlog_timeout=protocol.BACKLOG_TIMEOUT,
+        prioritized=True,
+        metrics_port=None,
+        metrics_interval=None,
+        reuse_port=False,
+        backplane=None,
+        worker_id=0,
+        history_dir=None,
+        files_dir=None,
+        files_capacity=DEFAULT_CAPACITY,
+    ):
+        # Instrumentation stays a no-op unless it is exported somewhere
+        if metrics_port or metrics_interval:
+            metrics.enable()
+
         # Initialize server socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind(protocol.ADDR)
+        if reuse_port:
+            # Worker processes share the port; the kernel spreads connections
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind(addr)
         self.server_socket.listen()
 
         # Data structures for managing clients and rooms
+        self.sessions = {}  # Map socket -> ClientSession
         self.clients = {}  # Map socket -> username
         self.username_to_socket = {}  # Map username -> socket
-        self.rooms = {"General": {"users": [], "password": None}}
+        self.rooms = RoomRegistry("General")  # Member sessions, locked per room
+        self.calls = CallRegistry()  # Group calls by room, locked per call
+        self.transfers = {}  # Map transfer_id -> chunked file transfer state
+        self.remote_users = {}  # Map username -> worker id, for other workers
+        self.bus_members = set()  # Ids of the other workers and nodes seen
+        self.file_access = {}  # Map digest -> usernames that were sent its FILE_REF
+
+        # Thread safety lock (records acquire waits when metrics are on)
+        self.lock = metrics.active.wrap_lock("lock_wait", threading.Lock())
 
-        self.lock = threading.Lock()  # Thread safety lock
+        # Presence changes are versioned and sent in coalesced batches
+        self.presence_version = 0
+        self.presence_events = []  # (event, name) since the last flush
+        self.presence_flushed = 0  # Version of the last flush
+        self.presence_waiting = set()  # Sessions owed a full snapshot
+        self.presence_scheduled = False
+        self.presence_lock = threading.Lock()  # Keeps flushes in version order
 
-        print(f"[SERVER] Running on port {protocol.ADDR[1]}")
+        # Slow-consumer policy for every connection's send queue
+        self.max_media_queue = max_media_queue
+        self.backlog_timeout = backlog_timeout
+        self.prioritized = prioritized
+
+        # Event-loop engine (None means one thread per client)
+        self.engine = SelectorEngine(self) if engine == "selector" else None
+
+        # Message history log (None keeps no history)
+        self.history = None
+        if history_dir:
+            if backplane:
+                # Every worker and node keeps its own log
+                history_dir = os.path.join(history_dir, str(worker_id))
+            self.history = MessageLog(history_dir)
+
+        # Content-addressed store for uploaded files (None relays files inline)
+        self.files = None
+        if files_dir:
+            if backplane:
+                files_dir = os.path.join(files_dir, str(worker_id))
+            self.files = FileStore(files_dir, files_capacity)
+
+        # Backplane to the other workers and cluster nodes (None when alone)
+        self.bus = None
+        if backplane:
+            self.bus = connect_backplane(
+                backplane,
+                worker_id,
+                lambda message: self.run_soon(lambda: self.handle_bus(message)),
+            )
+
+        metrics.active.gauge("sessions", lambda: len(self.sessions))
+        metrics.active.gauge("queues", self.queue_metrics)
+        if metrics_port:
+            metrics.start_endpoint(metrics_port)
+            print(f"[SERVER] Metrics on http://127.0.0.1:{metrics_port}/")
+        if metrics_interval:
+            metrics.start_dump(metrics_interval)
+
+        worker = f", member {worker_id}" if self.bus else ""
+        print(f"[SERVER] Running on port {addr[1]} ({engine} engine{worker})")
         print(f"[SERVER] Local IP Address: {self.get_local_ip()}")
-        self.receive()
+        if self.engine:
+            self.engine.serve_forever()
+        else:
+            self.receive()
 
     def get_local_ip(self):
         """Retrieves the local IP address of the server."""
@@ -37,7 +158,127 @@ class ChatServer:
         except:
             return "127.0.0.1"
 
-    def broadcast(self, msg_packet, exclude_socket=None, target_room=None):
+    def open_session(self, sock):
+        """Creates and registers the session for a newly accepted socket."""
+        queue = protocol.SendQueue(
+            self.max_media_queue, self.backlog_timeout, self.prioritized
+        )
+        protocol.limit_unsent(sock)
+        session = ClientSession(sock, queue)
+        metrics.active.count("connections")
+        with self.lock:
+            self.sessions[sock] = session
+        return session
+
+    def send(self, sock, cmd_type, data_dict, kind=protocol.KIND_CONTROL):
+        """
+        Sends a packet to a client through the active engine.
+
+        Returns:
+            True if the packet was sent (or queued), False otherwise.
+        """
+        frame = self.encode_for(sock, cmd_type, data_dict)
+        return self.send_frame(sock, frame, kind)
+
+    def encode_for(self, sock, cmd_type, data_dict, frames=None):
+        """
+        Encodes a packet with the cipher negotiated by a client.
+
+        Args:
+            sock: The recipient's socket.
+            frames: Optional dict of frames by cipher name, shared across
+                the recipients of one packet so each cipher encrypts once.
+
+        Returns:
+            The encoded frame.
+        """
+        session = self.sessions.get(sock)
+        cipher = session.cipher if session else protocol.cipher
+        if frames is not None and cipher.name in frames:
+            return frames[cipher.name]
+
+        frame = protocol.encode_packet(cmd_type, data_dict, cipher=cipher)
+        if frames is not None:
+            frames[cipher.name] = frame
+        return frame
+
+    def send_frame(self, sock, frame, kind=protocol.KIND_CONTROL, on_sent=None):
+        """
+        Queues an already encoded frame on a client's send queue.
+
+        The sender never blocks on the recipient: the threaded engine's
+        writer thread or the selector loop drains the queue. A recipient
+        whose backlog is older than the timeout is disconnected.
+
+        Args:
+            sock: The recipient's socket.
+            frame: The encoded frame bytes.
+            kind: The send queue lane (one of protocol.LANES).
+            on_sent: Optional callback run once the frame is written or discarded.
+
+        Returns:
+            True if the frame was queued, False otherwise.
+        """
+        session = self.sessions.get(sock)
+        if session is None:
+            if on_sent:
+                on_sent()
+            return False
+
+        if not session.queue.put(frame, kind, on_sent):
+            return False
+        metrics.active.packet("out", kind, len(frame))
+        if self.engine:
+            self.engine.flush(sock)
+
+        if session.queue.is_stalled():
+            self.kick(session, "slow consumer")
+        return True
+
+    def write_loop(self, session):
+        """Writes a client's queued frames (threaded engine writer thread)."""
+        while True:
+            item = session.queue.get()
+            if item is None:
+                break
+
+            frame, on_sent = item
+            ok = protocol.send_frame(session.sock, frame)
+            if on_sent:
+                on_sent()
+            if not ok:
+                if not session.queue.closed:
+                    self.kick(session, "send failed")
+                break
+
+    def kick(self, session, reason):
+        """
+        Shuts a client's socket down so its normal disconnect path runs.
+        """
+        print(f"[KICK] {session.username}: {reason}")
+        metrics.active.count("kicks")
+        session.queue.close()
+        try:
+            session.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def queue_metrics(self):
+        """Returns send queue statistics for every connected client."""
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return {
+            session.username or str(session.sock.fileno()): session.queue.stats()
+            for session in sessions
+        }
+
+    def broadcast(
+        self,
+        msg_packet,
+        exclude_socket=None,
+        target_room=None,
+        kind=protocol.KIND_CONTROL,
+    ):
         """
         Broadcasts a message to multiple clients.
 
@@ -45,47 +286,1265 @@ class ChatServer:
             msg_packet: The message packet to send.
             exclude_socket: Socket to exclude from broadcast (e.g., sender).
             target_room: Specific room to broadcast to. If None, broadcasts to all.
+            kind: The send queue lane for the message.
         """
-        with self.lock:
-            targets = []
-            if target_room:
-                room_data = self.rooms.get(target_room)
-                if room_data:
-                    users = room_data["users"]
-                    for user in users:
-                        sock = self.username_to_socket.get(user)
-                        if sock:
-                            targets.append(sock)
-            else:
+        timer = metrics.active
+        start = timer.clock()
+        if target_room:
+            targets = [member.sock for member in self.rooms.members(target_room)]
+        else:
+            with self.lock:
                 targets = list(self.clients.keys())
 
+        if not targets:
+            return
+
+        # Serialize and encrypt once per cipher, then reuse the frames
+        frames = {}
+
         for client_socket in targets:
             if client_socket != exclude_socket:
                 try:
                     if client_socket and client_socket.fileno() != -1:
-                        protocol.send_packet(
-                            client_socket, msg_packet["type"], msg_packet["data"]
+                        frame = self.encode_for(
+                            client_socket,
+                            msg_packet["type"],
+                            msg_packet["data"],
+                            frames,
                         )
+                        self.send_frame(client_socket, frame, kind)
                 except Exception as e:
                     print(f"[BROADCAST ERROR] {e}")
+        timer.lap("broadcast_fanout", start)
+
+    def broadcast_room(
+        self, msg_packet, target_room, exclude_socket=None, kind=protocol.KIND_CONTROL
+    ):
+        """Broadcasts to a room's members on this and every other worker."""
+        self.broadcast(msg_packet, exclude_socket, target_room, kind)
+        self.publish_room(msg_packet, target_room, kind)
+
+    def publish_room(self, msg_packet, target_room, kind=protocol.KIND_CONTROL):
+        """Sends a room broadcast to the other workers only."""
+        if self.bus:
+            message = {"op": "room_msg", "room": target_room, "packet": msg_packet}
+            self.bus.publish(dict(message, kind=kind), kind)
+
+    def send_to_user(self, username, cmd_type, data_dict, kind=protocol.KIND_CONTROL):
+        """
+        Sends a packet to a user connected to this or another worker.
+
+        Returns:
+            True if the packet was queued locally or handed to the bus.
+        """
+        sock = self.username_to_socket.get(username)
+        if sock:
+            return self.send(sock, cmd_type, data_dict, kind)
+        worker_id = self.remote_users.get(username)
+        if worker_id is None or not self.bus:
+            return False
+        message = {"op": "user", "to": username, "cmd": cmd_type, "data": data_dict}
+        return self.bus.send(worker_id, dict(message, kind=kind), kind)
+
+    def send_frame_to_user(self, username, frame, kind):
+        """Sends a relay frame to a user connected to this or another worker."""
+        sock = self.username_to_socket.get(username)
+        if sock:
+            return self.send_relay_frame([sock], frame, kind)
+        worker_id = self.remote_users.get(username)
+        if worker_id is None or not self.bus:
+            return False
+        message = {"op": "frame", "to": username, "frame": frame, "kind": kind}
+        return self.bus.send(worker_id, message, kind)
+
+    def send_relay_frame(self, targets, frame, kind):
+        """
+        Queues a media relay frame for local clients.
+
+        Clients that did not log in with "relay" only parse fully encrypted
+        packets, so for them the body is decrypted, once per frame, and the
+        packet sent the older way, with the routing fields in its data and
+        encrypted once per cipher.
+
+        Returns:
+            True if the frame was queued for every target.
+        """
+        packet, frames = None, {}
+        queued = True
+        for sock in targets:
+            session = self.sessions.get(sock)
+            if session is None or session.relay:
+                queued = self.send_frame(sock, frame, kind) and queued
+                continue
+            if packet is None:
+                payload = memoryview(frame)[protocol.HEADER_LENGTH :]
+                packet = protocol.decode_payload(payload)
+            old = self.encode_for(sock, packet["type"], packet["data"], frames)
+            queued = self.send_frame(sock, old, kind) and queued
+        return queued
+
+    def run_soon(self, callback):
+        """Runs callback on the engine's loop thread, or right away if threaded."""
+        if self.engine:
+            self.engine.call_soon_threadsafe(callback)
+        else:
+            callback()
+
+    def handle_bus(self, message):
+        """
+        Applies a message from another server on the backplane (a worker
+        process or cluster node).
+
+        Servers announce their users and rooms, and forward room broadcasts,
+        packets for one user and already encoded frames (media relay) to
+        whichever server holds the recipients. Stored files are read from
+        the server whose store holds them ("file_get", "file_push").
+        """
+        op = message["op"]
+        worker_id = message.get("worker")  # None for "disconnected"
+        if op == "gone":
+            self.bus_members.discard(worker_id)
+        elif op == "disconnected":
+            self.bus_members.clear()
+        else:
+            self.bus_members.add(worker_id)
+
+        if op == "hello":
+            # A worker (re)connected: tell it who and what lives here
+            with self.lock:
+                users = list(self.username_to_socket.keys())
+            rooms = [[room.name, room.password] for room in self.rooms.all()]
+            state = {"op": "state", "users": users, "rooms": rooms}
+            self.bus.send(worker_id, state)
+
+        elif op == "state":
+            for name, password in message["rooms"]:
+                self.add_remote_room(name, password)
+            for username in message["users"]:
+                self.add_remote_user(username, worker_id)
+
+        elif op == "joined":
+            self.add_remote_user(message["name"], worker_id)
+
+        elif op == "left":
+            with self.lock:
+                if self.remote_users.get(message["name"]) != worker_id:
+                    return
+                del self.remote_users[message["name"]]
+                self.publish_presence(protocol.PRESENCE_USER_LEFT, message["name"])
+            self.schedule_presence()
+
+        elif op == "gone":
+            self.drop_remote_users(message["worker"])
+
+        elif op == "disconnected":
+            self.drop_remote_users()
+
+        elif op == "room":
+            self.add_remote_room(message["name"], message["password"])
+
+        elif op == "room_msg":
+            packet = message["packet"]
+            if packet["type"] == protocol.CMD_FILE_REF:
+                members = self.rooms.members(message["room"])
+                self.send_file_ref([member.sock for member in members], packet["data"])
+            else:
+                self.broadcast(
+                    packet, target_room=message["room"], kind=message["kind"]
+                )
+            self.record_history(
+                room_key(message["room"]), packet["type"], packet["data"]
+            )
+
+        elif op == "user":
+            cmd, data = message["cmd"], message["data"]
+            sock = self.username_to_socket.get(message["to"])
+            if cmd == protocol.CMD_FILE_REF:
+                self.send_file_ref([sock] if sock else [], data)
+            elif sock:
+                self.send(sock, cmd, data, message["kind"])
+            if cmd in (protocol.CMD_FILE, protocol.CMD_FILE_REF) or data.get(
+                "is_private"
+            ):
+                key = conversation_key(data["from"], message["to"])
+                self.record_history(key, cmd, data)
+
+        elif op == "frame":
+            sock = self.username_to_socket.get(message["to"])
+            if sock:
+                self.send_relay_frame([sock], message["frame"], message["kind"])
+
+        elif op == "file_get":
+            self.answer_file_get(message["to"], message["request"])
+
+        elif op == "file_push":
+            self.send_stored_file(message["to"], message["ref"])
+
+    def add_remote_user(self, username, worker_id):
+        with self.lock:
+            self.remote_users[username] = worker_id
+            self.publish_presence(protocol.PRESENCE_USER_JOINED, username)
+        self.schedule_presence()
+
+    def drop_remote_users(self, worker_id=None):
+        """Forgets the users of one server that left, or of every server."""
+        with self.lock:
+            for username, user_worker in list(self.remote_users.items()):
+                if worker_id is None or user_worker == worker_id:
+                    del self.remote_users[username]
+                    self.publish_presence(protocol.PRESENCE_USER_LEFT, username)
+        self.schedule_presence()
+
+    def add_remote_room(self, name, password):
+        room, created = self.rooms.add(name, password)
+        if created:
+            with self.lock:
+                self.publish_presence(protocol.PRESENCE_ROOM_ADDED, name)
+            self.schedule_presence()
 
     def handle_private_msg(self, sender, target_user, text):
         """Handles sending a private message between two users."""
         target_socket = self.username_to_socket.get(target_user)
+        data = {"from": sender, "text": text, "is_private": True}
         if target_socket:
-            data = {"from": sender, "text": text, "is_private": True}
-            protocol.send_packet(target_socket, protocol.CMD_MSG, data)
-            protocol.send_packet(
-                self.username_to_socket[sender], protocol.CMD_MSG, data
+            frames = {}
+            for sock in [target_socket, self.username_to_socket[sender]]:
+                self.send_frame(
+                    sock, self.encode_for(sock, protocol.CMD_MSG, data, frames)
+                )
+        elif self.send_to_user(target_user, protocol.CMD_MSG, data):
+            # Target is on another worker; echo to the sender here
+            self.send_to_user(sender, protocol.CMD_MSG, data)
+        else:
+            return
+        self.record_history(
+            conversation_key(sender, target_user), protocol.CMD_MSG, data
+        )
+
+    def record_history(self, key, cmd, data):
+        """Queues a chat message or file message for the history log."""
+        if not self.history or cmd not in [
+            protocol.CMD_MSG,
+            protocol.CMD_FILE,
+            protocol.CMD_FILE_REF,
+        ]:
+            return
+        if cmd == protocol.CMD_FILE:
+            # The log keeps the message, not the file itself
+            content = data.get("content") or b""
+            data = {k: v for k, v in data.items() if k != "content"}
+            data["size"] = len(content)
+        self.history.append([key], cmd, data)
+
+    def send_history(self, session, data):
+        """
+        Answers a CMD_HISTORY request with a page of messages, oldest first.
+
+        A client may read the history of its current room and of its own
+        private conversations. A request with a malformed "limit", "before"
+        or "with" gets an empty page.
+        """
+        limit = data.get("limit") or protocol.HISTORY_LIMIT
+        before = data.get("before")
+        valid = isinstance(limit, int) and (before is None or isinstance(before, int))
+        if data.get("with"):
+            reply = {"with": data["with"]}
+            valid = valid and isinstance(data["with"], str)
+            key = conversation_key(session.username, data["with"]) if valid else None
+        else:
+            room = data.get("room") or session.current_room
+            reply = {"room": room}
+            key = room_key(room) if room == session.current_room else None
+
+        messages, start = [], 0
+        if self.history and key and valid:
+            limit = max(1, min(limit, protocol.HISTORY_MAX))
+            messages, start = self.history.read(key, limit, before)
+            # Files shared in a history the client may read, it may fetch
+            for message in messages:
+                if message["type"] == protocol.CMD_FILE_REF:
+                    self.grant_file(message["data"]["hash"], [session.username])
+        reply.update(messages=messages, start=start)
+        self.send(session.sock, protocol.CMD_HISTORY, reply)
+
+    def publish_presence(self, event, name):
+        """
+        Records a presence change for the next flush. Call with self.lock held.
+        """
+        self.presence_version += 1
+        self.presence_events.append((event, name))
+
+    def schedule_presence(self):
+        """
+        Flushes presence changes after PRESENCE_COALESCE seconds, so a burst
+        of logins, joins or disconnects costs each client one packet.
+        """
+        with self.lock:
+            if self.presence_scheduled:
+                return
+            self.presence_scheduled = True
+        self.call_later(protocol.PRESENCE_COALESCE, self.flush_presence)
+
+    def call_later(self, delay, callback):
+        """Runs callback after `delay` seconds on the active engine."""
+        if self.engine:
+            self.engine.call_later(delay, callback)
+        else:
+            timer = threading.Timer(delay, callback)
+            timer.daemon = True
+            timer.start()
+
+    def flush_presence(self):
+        """
+        Sends pending presence changes.
+
+        Sessions that just logged in or asked to resync get a versioned
+        CMD_LIST_UPDATE snapshot; other clients that understand deltas get
+        one CMD_PRESENCE batch, and older clients a full snapshot. Within a
+        batch only the last event per name is kept (a user who joined and
+        left again is just listed as left).
+        """
+        with self.presence_lock:
+            with self.lock:
+                self.presence_scheduled = False
+                events = self.presence_events
+                self.presence_events = []
+                waiting = self.presence_waiting
+                self.presence_waiting = set()
+                snapshot = {
+                    "users": list(self.username_to_socket.keys())
+                    + list(self.remote_users.keys()),
+                    "rooms": self.rooms.names(),
+                    "version": self.presence_version,
+                }
+                delta = {"since": self.presence_flushed, "version": snapshot["version"]}
+                self.presence_flushed = self.presence_version
+                sessions = [s for s in self.sessions.values() if s.username]
+
+            latest = {}
+            for event, name in events:
+                latest.pop(name, None)  # Re-insert so dict order follows events
+                latest[name] = event
+            for event in protocol.PRESENCE_EVENTS:
+                delta[event] = [name for name, last in latest.items() if last == event]
+
+            snapshots, deltas = {}, {}
+            for session in sessions:
+                sock = session.sock
+                if session in waiting or (events and not session.presence_deltas):
+                    frame = self.encode_for(
+                        sock, protocol.CMD_LIST_UPDATE, snapshot, snapshots
+                    )
+                elif events:
+                    frame = self.encode_for(sock, protocol.CMD_PRESENCE, delta, deltas)
+                else:
+                    continue
+                self.send_frame(sock, frame)
+
+    def handle_payload(self, session, payload):
+        """
+        Dispatches one raw frame payload from a client.
+
+        Media relay frames are routed by their plaintext header and forwarded
+        without decrypting the body; everything else is decoded and passed to
+        handle_packet.
+        """
+        if protocol.is_relay_payload(payload):
+            cmd = self.relay_media(session, payload)
+        else:
+            packet = protocol.decode_payload(payload)
+            cmd = packet["type"]
+            self.handle_packet(session, packet)
+        metrics.active.packet("in", cmd, len(payload))
+
+    def relay_media(self, session, payload):
+        """
+        Forwards a media relay frame (RELAY_COMMANDS) to its target as is.
+
+        Returns:
+            The command named in the routing header.
+        """
+        route, body = protocol.split_relay_payload(payload)
+        cmd = route.get("type")
+        if "call" in route:
+            self.forward_call_media(session, cmd, route, body)
+            return cmd
+        target = route.get("target")
+        if cmd not in protocol.RELAY_COMMANDS or not target:
+            return cmd
+
+        try:
+            # Inject Sender into the routing header, body stays opaque
+            route = {"target": target, "sender": session.username}
+            frame = protocol.encode_relay_frame(cmd, route, body)
+            self.send_frame_to_user(target, frame, self.media_kind(cmd))
+        except Exception as e:
+            print(f"[MEDIA ROUTING ERROR] {e}")
+        return cmd
+
+    def forward_call_media(self, session, cmd, route, body):
+        """
+        Forwards the media of a group call to the participants its call
+        selects, as one frame built once for all of them.
+        """
+        call = self.calls.get(session.current_room)
+        if call is None or route["call"] != call.room:
+            return
+        username = session.username
+
+        if cmd == protocol.CMD_AUDIO:
+            level = route.get("level", protocol.SILENCE_LEVEL)
+            if call.on_audio(username, level):
+                self.send_call_state(call)
+            targets = call.audio_targets(username)
+            route = {"call": call.room, "sender": username, "level": level}
+        elif cmd == protocol.CMD_VIDEO:
+            layer = route.get("layer", protocol.LAYER_HIGH)
+            targets = call.video_targets(username, layer)
+            route = {"call": call.room, "sender": username, "layer": layer}
+        else:
+            return
+
+        if targets:
+            frame = protocol.encode_relay_frame(cmd, route, body)
+            sockets = [target.sock for target in targets]
+            self.send_relay_frame(sockets, frame, self.media_kind(cmd))
+        metrics.active.count("call_frames_forwarded", len(targets))
+
+    def join_call(self, session, data):
+        """Adds a client to the call of its room and tells every participant."""
+        call = self.calls.join(session, data.get("codecs") or ["pcm"])
+        print(f"[CALL] {session.username} joined the call in {call.room}")
+        self.send_call_state(call)
+
+    def leave_call(self, session, room):
+        """Takes a client out of a room's call, if it is in it."""
+        call = self.calls.leave(session, room)
+        if call:
+            print(f"[CALL] {session.username} left the call in {room}")
+            self.send_call_state(call)
+
+    def send_call_state(self, call):
+        """Sends a call's participants and forwarding choices to each of them."""
+        with call.notify_lock:
+            data, sessions = call.state()
+            for session in sessions:
+                self.send(session.sock, protocol.CMD_CALL_STATE, data)
+
+    def media_kind(self, cmd):
+        """Returns the send queue lane for a media command."""
+        if cmd == protocol.CMD_AUDIO:
+            return protocol.KIND_AUDIO
+        if cmd == protocol.CMD_VIDEO_FEEDBACK:
+            return protocol.KIND_CONTROL  # Must not queue behind the video
+        return protocol.KIND_VIDEO
+
+    def handle_packet(self, session, packet):
+        """
+        Dispatches a single decoded packet from a client.
+
+        Args:
+            session: The ClientSession of the sending client.
+            packet: The decoded packet dictionary.
+        """
+        client_socket = session.sock
+        username = session.username
+        current_room = session.current_room
+
+        cmd = packet["type"]
+        data = packet["data"]
+
+        if cmd == protocol.CMD_LOGIN:
+            username = data["username"]
+            session.username = username
+            # Older clients offer nothing and stay on Fernet
+            session.cipher = protocol.negotiate_cipher(data.get("ciphers"))
+            self.send(
+                client_socket,
+                protocol.CMD_LOGIN_ACK,
+                {"cipher": session.cipher.name},
             )
+            session.presence_deltas = bool(data.get("presence"))
+            session.file_refs = bool(data.get("file_refs"))
+            session.relay = bool(data.get("relay"))
+            with self.lock:
+                self.clients[client_socket] = username
+                self.username_to_socket[username] = client_socket
+                self.publish_presence(protocol.PRESENCE_USER_JOINED, username)
+                self.presence_waiting.add(session)
+
+            self.rooms.join(session, session.current_room)
+            if self.bus:
+                self.bus.publish({"op": "joined", "name": username})
+
+            print(f"[NEW CONN] {username} connected.")
+            self.schedule_presence()
+
+        elif cmd == protocol.CMD_LIST_UPDATE:
+            # Client lost track of presence versions and wants a snapshot
+            with self.lock:
+                self.presence_waiting.add(session)
+            self.schedule_presence()
+
+        elif cmd == protocol.CMD_MSG:
+            msg_text = data["text"]
+            to_user = data.get("to")
+
+            if to_user and to_user != "All":
+                self.handle_private_msg(username, to_user, msg_text)
+            else:
+                # Broadcast to room
+                payload = {
+                    "from": username,
+                    "text": msg_text,
+                    "room": current_room,
+                }
+                self.broadcast_room(
+                    {"type": protocol.CMD_MSG, "data": payload}, current_room
+                )
+                self.record_history(room_key(current_room), protocol.CMD_MSG, payload)
+
+        elif cmd == protocol.CMD_ROOM_JOIN:
+            new_room = data["room"]
+            password = data.get("password")
+
+            # Creates the room if needed and moves the session out of its old one
+            joined, created = self.rooms.join(session, new_room, password)
+            if not joined:
+                self.send(
+                    client_socket,
+                    protocol.CMD_MSG,
+                    {
+                        "from": "System",
+                        "text": f"Incorrect password for {new_room}",
+                    },
+                )
+                return  # Skip joining
+
+            if new_room != current_room:
+                self.leave_call(session, current_room)
+            if created:
+                with self.lock:
+                    self.publish_presence(protocol.PRESENCE_ROOM_ADDED, new_room)
+                if self.bus:
+                    room = {"op": "room", "name": new_room, "password": password}
+                    self.bus.publish(room)
+                self.schedule_presence()
+            # Ack for current clients, System msg for display
+            self.send(client_socket, protocol.CMD_ROOM_JOIN, {"room": new_room})
+            self.send(
+                client_socket,
+                protocol.CMD_MSG,
+                {"from": "System", "text": f"Joined {new_room}"},
+            )
+
+        elif cmd == protocol.CMD_FILE:
+            # Route file to room or user
+            target_user = data.get("to")
+            payload = data  # Forward entire file payload
+            payload["from"] = username
+
+            if self.files and len(payload["content"]) <= self.files.capacity:
+                self.store_inline_file(session, payload, target_user)
+            elif target_user:
+                if self.send_to_user(
+                    target_user, protocol.CMD_FILE, payload, protocol.KIND_FILE
+                ):
+                    key = conversation_key(username, target_user)
+                    self.record_history(key, protocol.CMD_FILE, payload)
+            else:
+                self.broadcast_room(
+                    {"type": protocol.CMD_FILE, "data": payload},
+                    current_room,
+                    exclude_socket=client_socket,
+                    kind=protocol.KIND_FILE,
+                )
+                key = room_key(current_room)
+                self.record_history(key, protocol.CMD_FILE, payload)
+
+        elif cmd == protocol.CMD_HISTORY:
+            self.send_history(session, data)
+
+        elif cmd == protocol.CMD_FILE_GET:
+            self.send_file_range(session, data)
 
-    def send_active_list(self):
-        """Sends the updated list of active users and rooms to all clients."""
-        users = list(self.username_to_socket.keys())
-        rooms_list = list(self.rooms.keys())
+        elif cmd == protocol.CMD_FILE_OFFER:
+            self.start_transfer(session, data)
 
-        packet = {"users": users, "rooms": rooms_list}
-        self.broadcast({"type": protocol.CMD_LIST_UPDATE, "data": packet})
+        elif cmd == protocol.CMD_FILE_CHUNK:
+            self.relay_chunk(session, data)
+
+        elif cmd == protocol.CMD_FILE_COMPLETE:
+            self.finish_transfer(session, data["transfer_id"])
+
+        # MEDIA ROUTING (Audio/Video Frames)
+        # Fully encrypted media packets from older clients; current clients
+        # use relay frames, which relay_media forwards without decrypting
+        elif cmd in [protocol.CMD_VIDEO, protocol.CMD_AUDIO]:
+            target = data.get("target")
+            if target:
+                try:
+                    # Inject Sender and forward to the target
+                    data["sender"] = username
+                    self.send_to_user(target, cmd, data, self.media_kind(cmd))
+                except Exception as e:
+                    print(f"[MEDIA ROUTING ERROR] {e}")
+
+        elif cmd == protocol.CMD_CALL_JOIN:
+            self.join_call(session, data)
+
+        elif cmd == protocol.CMD_CALL_LEAVE:
+            self.leave_call(session, current_room)
+
+        elif cmd == protocol.CMD_END_CALL:
+            # Forward end call notification
+            target = data.get("target")
+            if target:
+                try:
+                    self.send_to_user(target, protocol.CMD_END_CALL, {})
+                except Exception as e:
+                    print(f"[END CALL ERROR] {e}")
+
+    def start_transfer(self, session, data):
+        """
+        Registers a chunked file transfer and forwards the offer.
+
+        Recipients are fixed when the offer arrives: the private target, or
+        everyone else in the sender's current room. Recipients on other
+        servers get the transfer over the bus; an offer for a user who is
+        not connected anywhere is refused with an aborted FILE_ACK. An offer
+        marked "resume" picks up the sender's earlier transfer with the same
+        ID, if the server still has it.
+        """
+        transfer_id = data["transfer_id"]
+        target_user = data.get("to")
+        if data.get("resume") and self.resume_transfer(session, transfer_id):
+            return
+
+        with self.lock:
+            if target_user:
+                target_sock = self.username_to_socket.get(target_user)
+                targets = [target_sock] if target_sock else []
+                remote = not targets and target_user in self.remote_users
+                refused = not targets and not remote
+            else:
+                targets = [
+                    member.sock
+                    for member in self.rooms.members(session.current_room)
+                    if member is not session
+                ]
+                remote = self.bus is not None  # Members may be on other servers
+                refused = False
+            transfer = {
+                "sender": session,
+                "username": session.username,
+                "targets": targets,
+                "remote": remote,  # Also sent over the bus
+                "offer": data,
+                "room": session.current_room,
+                "offset": 0,  # Next byte expected from the sender
+                "rewinding": False,  # Asked the sender to go back to offset
+                "parked": None,  # Token of the pending expiry while disconnected
+            }
+            if not refused:
+                self.transfers[transfer_id] = transfer
+
+        if refused:
+            print(f"[FILE] {target_user} is not connected, refusing offer")
+            ack = {"transfer_id": transfer_id, "offset": 0, "aborted": True}
+            self.send(session.sock, protocol.CMD_FILE_ACK, ack)
+            return
+
+        if data.get("resume"):
+            # Too late to resume: the sender starts over
+            ack = {"transfer_id": transfer_id, "offset": 0, "resume": True}
+            self.send(session.sock, protocol.CMD_FILE_ACK, ack)
+
+        if self.files and data.get("hash"):
+            self.start_upload(session, transfer)
+            return
+
+        offer = {
+            "transfer_id": transfer_id,
+            "filename": data["filename"],
+            "size": data["size"],
+            "from": session.username,
+        }
+        self.send_to_transfer(transfer, protocol.CMD_FILE_OFFER, offer)
+
+    def send_to_transfer(self, transfer, cmd_type, data_dict, on_all_sent=None):
+        """
+        Sends a packet of a relayed transfer to its recipients on the file
+        lane: to local ones directly, and over the bus to the private target
+        or the room's members on other servers.
+
+        Args:
+            on_all_sent: Optional callback run once every local copy has been
+                written and the bus has taken the remote one.
+        """
+        if transfer["remote"]:
+            target_user = transfer["offer"].get("to")
+            if target_user:
+                self.send_to_user(target_user, cmd_type, data_dict, protocol.KIND_FILE)
+            else:
+                packet = {"type": cmd_type, "data": data_dict}
+                self.publish_room(packet, transfer["room"], protocol.KIND_FILE)
+        self.send_to_targets(
+            transfer["targets"],
+            cmd_type,
+            data_dict,
+            protocol.KIND_FILE,
+            on_all_sent=on_all_sent,
+        )
+
+    def resume_transfer(self, session, transfer_id):
+        """
+        Hands a transfer to its sender's new connection and tells the sender
+        where to continue.
+
+        Returns:
+            False if the server no longer has the sender's transfer.
+        """
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            if transfer is None or transfer["username"] != session.username:
+                return False
+            transfer["sender"] = session
+            transfer["parked"] = None
+            transfer["rewinding"] = False
+            offset = transfer["offset"]
+
+        ack = {"transfer_id": transfer_id, "offset": offset, "resume": True}
+        self.send(session.sock, protocol.CMD_FILE_ACK, ack)
+        print(f"[FILE] {session.username} resumed {transfer_id} at {offset}")
+        return True
+
+    def park_transfer(self, transfer):
+        """
+        Keeps a disconnected sender's transfer for RESUME_TIMEOUT seconds,
+        then aborts it unless the sender resumed it.
+        """
+        token = object()
+        with self.lock:
+            transfer["parked"] = token
+
+        def expire():
+            with self.lock:
+                expired = transfer["parked"] is token
+            if expired:
+                transfer_id = transfer["offer"]["transfer_id"]
+                self.finish_transfer(transfer["sender"], transfer_id, aborted=True)
+
+        self.call_later(protocol.RESUME_TIMEOUT, expire)
+
+    def accept_chunk(self, session, data):
+        """
+        Checks that a chunk is intact and continues the transfer.
+
+        A damaged or out-of-order chunk is dropped, and the sender is asked
+        once to resend from the last good offset; the chunks it already had
+        in flight are dropped too until the resent one arrives.
+
+        Returns:
+            The transfer, or None if the chunk must be ignored.
+        """
+        with self.lock:
+            transfer = self.transfers.get(data["transfer_id"])
+            if transfer is None or transfer["sender"] is not session:
+                return None
+            if data["offset"] == transfer["offset"] and protocol.chunk_intact(data):
+                transfer["offset"] += len(data["data"])
+                transfer["rewinding"] = False
+                return transfer
+            rewind = not transfer["rewinding"]
+            transfer["rewinding"] = True
+            offset = transfer["offset"]
+
+        if rewind:
+            ack = {"transfer_id": data["transfer_id"], "offset": offset, "resume": True}
+            self.send(session.sock, protocol.CMD_FILE_ACK, ack)
+            print(f"[FILE] Rewinding {data['transfer_id']} to {offset}")
+        return None
+
+    def relay_chunk(self, session, data):
+        """
+        Forwards one file chunk to the transfer's recipients and acks it once
+        every recipient's writer has sent it.
+
+        Acking only after the write ties the sender's ack window to the
+        slowest recipient, so the server holds at most FILE_WINDOW chunks
+        per transfer no matter how slow a recipient is.
+        """
+        transfer = self.accept_chunk(session, data)
+        if transfer is None:
+            return
+        if "upload" in transfer:
+            self.upload_chunk(session, transfer, data)
+            return
+
+        ack = {
+            "transfer_id": data["transfer_id"],
+            "offset": data["offset"] + len(data["data"]),
+        }
+        self.send_to_transfer(
+            transfer,
+            protocol.CMD_FILE_CHUNK,
+            data,
+            on_all_sent=lambda: self.send(session.sock, protocol.CMD_FILE_ACK, ack),
+        )
+
+    def finish_transfer(self, session, transfer_id, aborted=False):
+        """Tells the recipients a transfer ended and forgets it."""
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            if transfer is None or transfer["sender"] is not session:
+                return
+            del self.transfers[transfer_id]
+
+        if "upload" in transfer:
+            self.finish_upload(session, transfer, aborted)
+            return
+
+        data = {"transfer_id": transfer_id, "aborted": aborted}
+        # Same lane as the chunks so completion never overtakes them
+        self.send_to_transfer(transfer, protocol.CMD_FILE_COMPLETE, data)
+
+    def start_upload(self, session, transfer):
+        """
+        Receives an offered file into the file store instead of relaying it.
+
+        If the store already has a file with the offered hash and the sender
+        has shared or been sent that file before, nothing is uploaded: the
+        sender is told the file is stored and the recipients get its
+        reference right away. Anyone else uploads it, and the hash it claims
+        is checked against the bytes before the file is shared, so knowing a
+        digest does not give access to a stored file.
+        """
+        offer = transfer["offer"]
+        digest = offer["hash"]
+        if self.files.has(digest, offer["size"]) and self.may_fetch(
+            session.username, digest
+        ):
+            with self.lock:
+                self.transfers.pop(offer["transfer_id"], None)
+            metrics.active.count("file_store_dedup_bytes", offer["size"])
+            self.file_stored(session, transfer, digest)
+        else:
+            transfer["upload"] = self.files.begin()
+
+    def upload_chunk(self, session, transfer, data):
+        """Writes one uploaded chunk to the store and acks it."""
+        offer = transfer["offer"]
+        if not transfer["upload"].write(data["offset"], data["data"]):
+            print(f"[FILE ERROR] {offer['filename']} does not fit the store")
+            self.finish_transfer(session, offer["transfer_id"], aborted=True)
+            self.reject_upload(session, offer)
+            return
+        ack = {
+            "transfer_id": offer["transfer_id"],
+            "offset": data["offset"] + len(data["data"]),
+        }
+        self.send(session.sock, protocol.CMD_FILE_ACK, ack)
+
+    def finish_upload(self, session, transfer, aborted):
+        """Stores a completed upload if it matches the offered hash."""
+        upload, offer = transfer["upload"], transfer["offer"]
+        if aborted:
+            upload.abort()
+            return
+        if upload.size != offer["size"]:
+            print(f"[FILE ERROR] Size mismatch for {offer['filename']}")
+            upload.abort()
+            self.reject_upload(session, offer)
+            return
+        digest = upload.finish()
+        if digest != offer["hash"]:
+            # The stored bytes are fine, but not what the sender announced
+            print(f"[FILE ERROR] Hash mismatch for {offer['filename']}")
+            self.reject_upload(session, offer)
+            return
+        self.file_stored(session, transfer, digest)
+
+    def reject_upload(self, session, offer):
+        """Tells the sender its upload was not stored."""
+        ack = {"transfer_id": offer["transfer_id"], "aborted": True}
+        self.send(session.sock, protocol.CMD_FILE_ACK, ack)
+
+    def file_stored(self, session, transfer, digest):
+        """Confirms a stored file to its sender and sends its recipients a reference."""
+        offer = transfer["offer"]
+        ack = {"transfer_id": offer["transfer_id"], "offset": offer["size"]}
+        self.send(session.sock, protocol.CMD_FILE_ACK, dict(ack, stored=True))
+
+        ref = self.file_ref(digest, offer["filename"], offer["size"], session.username)
+        self.grant_file(digest, [session.username])
+        self.send_file_ref(transfer["targets"], ref)
+        if transfer["remote"]:
+            # Other servers fetch the file from this one's store
+            if offer.get("to"):
+                self.send_to_user(offer["to"], protocol.CMD_FILE_REF, ref)
+            else:
+                packet = {"type": protocol.CMD_FILE_REF, "data": ref}
+                self.publish_room(packet, transfer["room"])
+        if offer.get("to"):
+            key = conversation_key(session.username, offer["to"])
+        else:
+            key = room_key(transfer["room"])
+        self.record_history(key, protocol.CMD_FILE_REF, ref)
+
+    def store_inline_file(self, session, payload, target_user):
+        """
+        Stores a whole-file CMD_FILE and sends its reference, instead of the
+        content, to recipients that logged in with "file_refs". Older clients
+        and recipients on other servers still get the content inline.
+        """
+        digest = self.files.put(payload["content"])
+        ref = self.file_ref(
+            digest, payload["filename"], len(payload["content"]), session.username
+        )
+
+        if target_user:
+            key = conversation_key(session.username, target_user)
+            target_sock = self.username_to_socket.get(target_user)
+            if target_sock:
+                targets = [target_sock]
+            elif self.send_to_user(
+                target_user, protocol.CMD_FILE, payload, protocol.KIND_FILE
+            ):
+                targets = []
+            else:
+                return
+        else:
+            key = room_key(session.current_room)
+            targets = [
+                member.sock
+                for member in self.rooms.members(session.current_room)
+                if member is not session
+            ]
+            packet = {"type": protocol.CMD_FILE, "data": payload}
+            self.publish_room(packet, session.current_room, protocol.KIND_FILE)
+
+        refs, inline = self.split_file_refs(targets)
+        self.grant_file(digest, [session.username] + self.usernames(refs))
+        self.send_to_targets(refs, protocol.CMD_FILE_REF, ref)
+        self.send_to_targets(inline, protocol.CMD_FILE, payload, protocol.KIND_FILE)
+        self.record_history(key, protocol.CMD_FILE_REF, ref)
+
+    def file_ref(self, digest, filename, size, sender):
+        """
+        Builds the FILE_REF of a file in this server's store. With a
+        backplane it names this server as the "node" to fetch it from.
+        """
+        ref = {"hash": digest, "filename": filename, "size": size, "from": sender}
+        if self.bus:
+            ref["node"] = self.bus.worker_id
+        return ref
+
+    def is_local_file(self, node):
+        """Returns True if a FILE_REF's node is this server."""
+        return not self.bus or node is None or node == self.bus.worker_id
+
+    def grant_file(self, digest, usernames):
+        """Lets users fetch a stored file with FILE_GET."""
+        with self.lock:
+            self.file_access.setdefault(digest, set()).update(usernames)
+
+    def may_fetch(self, username, digest):
+        """Returns True if a user was sent the FILE_REF of a stored file."""
+        with self.lock:
+            return username in self.file_access.get(digest, ())
+
+    def usernames(self, targets):
+        """Returns the usernames of recipient sockets."""
+        with self.lock:
+            return [self.clients[sock] for sock in targets if sock in self.clients]
+
+    def send_file_ref(self, targets, ref):
+        """
+        Sends a stored file's reference to the local recipients that take
+        FILE_REF, and the file itself to the others: from this server's
+        store, or by asking the server that holds it to push it. Only the
+        recipients of a reference may fetch the file.
+        """
+        refs, pushes = self.split_file_refs(targets)
+        self.grant_file(ref["hash"], self.usernames(refs))
+        self.send_to_targets(refs, protocol.CMD_FILE_REF, ref)
+        if not pushes:
+            return
+        if not self.is_local_file(ref.get("node")):
+            for username in self.usernames(pushes):
+                message = {"op": "file_push", "to": username, "ref": ref}
+                self.bus.send(ref["node"], message, protocol.KIND_FILE)
+        elif ref["size"] <= MAX_INLINE_FILE:
+            # Older clients only understand whole-file CMD_FILE packets
+            payload = self.stored_file_payload(ref)
+            if payload:
+                self.send_to_targets(
+                    pushes, protocol.CMD_FILE, payload, protocol.KIND_FILE
+                )
+        else:
+            for target_sock in pushes:
+                self.push_stored_file(target_sock, ref)
+
+    def stored_file_payload(self, ref):
+        """
+        Reads a stored file into a CMD_FILE payload.
+
+        Returns:
+            The payload, or None if the file is no longer in the store.
+        """
+        content = self.files.read(ref["hash"], 0, ref["size"]) if self.files else None
+        if content is None:
+            print(f"[FILE] {ref['filename']} is no longer in the store")
+            return None
+        return {"filename": ref["filename"], "content": content, "from": ref["from"]}
+
+    def send_stored_file(self, username, ref):
+        """
+        Sends a stored file to a user on another server that does not take
+        FILE_REF: as one CMD_FILE up to MAX_INLINE_FILE, else as a chunked
+        transfer, all handed to the bus at once.
+        """
+        digest, size = ref["hash"], ref["size"]
+        if size <= MAX_INLINE_FILE:
+            payload = self.stored_file_payload(ref)
+            if payload:
+                self.send_to_user(
+                    username, protocol.CMD_FILE, payload, protocol.KIND_FILE
+                )
+            return
+
+        transfer_id = uuid.uuid4().hex
+        offer = {
+            "transfer_id": transfer_id,
+            "filename": ref["filename"],
+            "size": size,
+            "from": ref["from"],
+        }
+        self.send_to_user(username, protocol.CMD_FILE_OFFER, offer, protocol.KIND_FILE)
+        aborted = False
+        for offset in range(0, size, protocol.FILE_CHUNK_SIZE):
+            chunk = self.files.read(digest, offset, protocol.FILE_CHUNK_SIZE)
+            if not chunk:
+                aborted = True  # Evicted meanwhile
+                break
+            data = {
+                "transfer_id": transfer_id,
+                "offset": offset,
+                "data": chunk,
+                "crc": protocol.chunk_checksum(chunk),
+            }
+            self.send_to_user(
+                username, protocol.CMD_FILE_CHUNK, data, protocol.KIND_FILE
+            )
+        data = {"transfer_id": transfer_id, "aborted": aborted}
+        self.send_to_user(
+            username, protocol.CMD_FILE_COMPLETE, data, protocol.KIND_FILE
+        )
+
+    def split_file_refs(self, targets):
+        """
+        Splits recipient sockets by whether they logged in with "file_refs".
+
+        Returns:
+            A tuple of (sockets that take FILE_REF, sockets that do not).
+        """
+        with self.lock:
+            sessions = [self.sessions.get(sock) for sock in targets]
+        refs = [s.sock for s in sessions if s and s.file_refs]
+        others = [s.sock for s in sessions if s and not s.file_refs]
+        return refs, others
+
+    def push_stored_file(self, sock, ref):
+        """
+        Sends a stored file to a client without FILE_REF support as a chunked
+        transfer. A chunk is read from the store each time an earlier one has
+        been written, so at most FILE_WINDOW chunks are queued per recipient.
+        """
+        session = self.sessions.get(sock)
+        if session is None:
+            return
+        digest, size = ref["hash"], ref["size"]
+        transfer_id = uuid.uuid4().hex
+        offer = {
+            "transfer_id": transfer_id,
+            "filename": ref["filename"],
+            "size": size,
+            "from": ref["from"],
+        }
+        self.send(sock, protocol.CMD_FILE_OFFER, offer, protocol.KIND_FILE)
+
+        # Chunks must be queued in order, whichever thread writes the last one
+        lock = threading.RLock()
+        position = [0]
+
+        def complete(aborted):
+            data = {"transfer_id": transfer_id, "aborted": aborted}
+            self.send(sock, protocol.CMD_FILE_COMPLETE, data, protocol.KIND_FILE)
+
+        def send_next():
+            with lock:
+                offset = position[0]
+                if offset >= size or session.queue.closed:
+                    return
+                chunk = self.files.read(digest, offset, protocol.FILE_CHUNK_SIZE)
+                if not chunk:
+                    position[0] = size
+                    complete(aborted=True)  # Evicted meanwhile
+                    return
+                position[0] += len(chunk)
+                last = position[0] >= size
+
+                data = {
+                    "transfer_id": transfer_id,
+                    "offset": offset,
+                    "data": chunk,
+                    "crc": protocol.chunk_checksum(chunk),
+                }
+                frame = self.encode_for(sock, protocol.CMD_FILE_CHUNK, data)
+                # Deferred: the selector engine may run on_sent right away
+                on_sent = lambda: self.run_soon(send_next)
+                self.send_frame(sock, frame, protocol.KIND_FILE, on_sent)
+                if last:
+                    complete(aborted=False)
+
+        if not size:
+            complete(aborted=False)
+        for _ in range(protocol.FILE_WINDOW):
+            send_next()
+
+    def send_file_range(self, session, data):
+        """
+        Answers a FILE_GET with FILE_DATA chunks of the requested range
+        (at most FILE_RANGE bytes) on the file lane.
+
+        Only users that were sent the file's FILE_REF may fetch it; others
+        are told it is missing. A request naming another server's "node" is
+        passed to that server, which answers over the bus; if it has left,
+        the file is missing, as it is for a request with a malformed
+        "offset" or "length". One without a string "hash" is dropped.
+        """
+        digest = data.get("hash")
+        if not isinstance(digest, str):
+            return
+        if not valid_file_get(data) or not self.may_fetch(session.username, digest):
+            reply = {"hash": digest, "offset": data.get("offset", 0), "missing": True}
+            self.send(session.sock, protocol.CMD_FILE_DATA, reply)
+            return
+        node = data.get("node")
+        if not self.is_local_file(node) and node in self.bus_members:
+            message = {"op": "file_get", "to": session.username, "request": data}
+            self.bus.send(node, message, protocol.KIND_FILE)
+            return
+        self.answer_file_get(session.username, data)
+
+    def answer_file_get(self, username, data):
+        """Sends a user the FILE_DATA chunks of a FILE_GET from this store."""
+        digest = data.get("hash")
+        if not isinstance(digest, str) or not valid_file_get(data):
+            return
+        offset = max(0, data.get("offset", 0))
+        length = min(data.get("length", protocol.FILE_RANGE), protocol.FILE_RANGE)
+
+        content = self.files.read(digest, offset, length) if self.files else None
+        if content is None:
+            reply = {"hash": digest, "offset": offset, "missing": True}
+            self.send_to_user(username, protocol.CMD_FILE_DATA, reply)
+            return
+
+        view = memoryview(content)
+        for start in range(0, len(content), protocol.FILE_CHUNK_SIZE):
+            chunk = bytes(view[start : start + protocol.FILE_CHUNK_SIZE])
+            reply = {
+                "hash": digest,
+                "offset": offset + start,
+                "data": chunk,
+                "crc": protocol.chunk_checksum(chunk),
+            }
+            self.send_to_user(
+                username, protocol.CMD_FILE_DATA, reply, protocol.KIND_FILE
+            )
+        metrics.active.count("file_store_read_bytes", len(content))
+
+    def send_to_targets(
+        self,
+        targets,
+        cmd_type,
+        data_dict,
+        kind=protocol.KIND_CONTROL,
+        on_all_sent=None,
+    ):
+        """
+        Encodes a packet once per cipher and sends it to every socket in targets.
+
+        Args:
+            kind: The send queue lane for the packet.
+            on_all_sent: Optional callback run once every target's copy has
+                been written or discarded.
+        """
+        timer = metrics.active
+        start = timer.clock()
+        frames = {}
+        on_sent = None
+        if on_all_sent:
+            remaining = [len(targets)]
+            lock = threading.Lock()
+
+            def count_sent():
+                with lock:
+                    remaining[0] -= 1
+                    done = remaining[0] == 0
+                if done:
+                    on_all_sent()
+
+            on_sent = count_sent
+            if not targets:
+                on_all_sent()
+
+        for target_sock in targets:
+            frame = self.encode_for(target_sock, cmd_type, data_dict, frames)
+            self.send_frame(target_sock, frame, kind, on_sent)
+        timer.lap("targets_fanout", start)
+
+    def disconnect(self, session):
+        """Removes a client from all server state and closes its socket."""
+        client_socket = session.sock
+        username = session.username
+
+        self.rooms.leave(session)
+        self.leave_call(session, session.current_room)
+        with self.lock:
+            if client_socket in self.clients:
+                del self.clients[client_socket]
+            # A reconnecting client may have logged in again already
+            departed = bool(username) and (
+                self.username_to_socket.get(username) is client_socket
+            )
+            if departed:
+                del self.username_to_socket[username]
+                self.publish_presence(protocol.PRESENCE_USER_LEFT, username)
+            self.presence_waiting.discard(session)
+
+            unfinished = [
+                transfer
+                for transfer in self.transfers.values()
+                if transfer["sender"] is session
+            ]
+
+        if departed and self.bus:
+            self.bus.publish({"op": "left", "name": username})
+
+        for transfer in unfinished:
+            self.park_transfer(transfer)
+
+        session.queue.close()
+        with self.lock:
+            self.sessions.pop(client_socket, None)
+
+        client_socket.close()
+        if departed:
+            self.schedule_presence()
+        print(f"[DISCONN] {username}")
 
     def handle_client(self, client_socket):
         """
@@ -94,158 +1553,19 @@ class ChatServer:
         Args:
             client_socket: The socket object for the connected client.
         """
-        username = ""
-        current_room = "General"
+        session = self.open_session(client_socket)
+        reader = protocol.FrameReader(client_socket)
+        threading.Thread(target=self.write_loop, args=(session,), daemon=True).start()
 
         try:
-            while True:
-                packet = protocol.receive_packet(client_socket)
-                if not packet:
-                    break
-
-                cmd = packet["type"]
-                data = packet["data"]
-
-                if cmd == protocol.CMD_LOGIN:
-                    username = data["username"]
-                    with self.lock:
-                        self.clients[client_socket] = username
-                        self.username_to_socket[username] = client_socket
-                        self.rooms["General"]["users"].append(username)
-
-                    print(f"[NEW CONN] {username} connected.")
-                    self.send_active_list()
-
-                elif cmd == protocol.CMD_MSG:
-                    msg_text = data["text"]
-                    to_user = data.get("to")
-
-                    if to_user and to_user != "All":
-                        self.handle_private_msg(username, to_user, msg_text)
-                    else:
-                        # Broadcast to room
-                        payload = {
-                            "from": username,
-                            "text": msg_text,
-                            "room": current_room,
-                        }
-                        self.broadcast(
-                            {"type": protocol.CMD_MSG, "data": payload},
-                            target_room=current_room,
-                        )
-
-                elif cmd == protocol.CMD_ROOM_JOIN:
-                    new_room = data["room"]
-                    password = data.get("password")
-
-                    with self.lock:
-                        # Check if room exists
-                        if new_room in self.rooms:
-                            # Verify password if one is set
-                            room_pass = self.rooms[new_room]["password"]
-                            if room_pass and room_pass != password:
-                                protocol.send_packet(
-                                    client_socket,
-                                    protocol.CMD_MSG,
-                                    {
-                                        "from": "System",
-                                        "text": f"Incorrect password for {new_room}",
-                                    },
-                                )
-                                continue  # Skip joining
-                        else:
-                            # Create new room
-                            self.rooms[new_room] = {"users": [], "password": password}
-
-                        # Remove from old room
-                        old_room_data = self.rooms.get(current_room)
-                        if old_room_data and username in old_room_data["users"]:
-                            old_room_data["users"].remove(username)
-
-                        # Add to new room
-                        self.rooms[new_room]["users"].append(username)
-                        current_room = new_room
-
-                    self.send_active_list()
-                    # System msg
-                    protocol.send_packet(
-                        client_socket,
-                        protocol.CMD_MSG,
-                        {"from": "System", "text": f"Joined {new_room}"},
-                    )
-
-                elif cmd == protocol.CMD_FILE:
-                    # Route file to room or user
-                    target_user = data.get("to")
-                    payload = data  # Forward entire file payload
-                    payload["from"] = username
-
-                    if target_user:
-                        target_sock = self.username_to_socket.get(target_user)
-                        if target_sock:
-                            protocol.send_packet(
-                                target_sock, protocol.CMD_FILE, payload
-                            )
-                    else:
-                        self.broadcast(
-                            {"type": protocol.CMD_FILE, "data": payload},
-                            exclude_socket=client_socket,
-                            target_room=current_room,
-                        )
-
-                # MEDIA ROUTING (Audio/Video Frames)
-                # Highly efficient routing for "Calling"
-                elif cmd in [protocol.CMD_VIDEO, protocol.CMD_AUDIO]:
-                    target = data.get("target")
-                    if target:
-                        target_sock = self.username_to_socket.get(target)
-                        if target_sock:
-                            try:
-                                # Check if target socket is still valid
-                                if target_sock.fileno() != -1:
-                                    # Forward directly to target
-                                    packet_to_send = packet
-                                    # Inject Sender
-                                    packet_to_send["data"]["sender"] = username
-                                    protocol.send_packet(
-                                        target_sock,
-                                        cmd,
-                                        packet_to_send["data"],
-                                        is_encrypted=True,
-                                    )
-                            except Exception as e:
-                                print(f"[MEDIA ROUTING ERROR] {e}")
-
-                elif cmd == protocol.CMD_END_CALL:
-                    # Forward end call notification
-                    target = data.get("target")
-                    if target:
-                        target_sock = self.username_to_socket.get(target)
-                        if target_sock:
-                            try:
-                                protocol.send_packet(
-                                    target_sock, protocol.CMD_END_CALL, {}
-                                )
-                            except Exception as e:
-                                print(f"[END CALL ERROR] {e}")
+            for payload in reader.payloads():
+                self.handle_payload(session, payload)
 
         except Exception as e:
-            print(f"[ERROR] {username}: {e}")
+            print(f"[ERROR] {session.username}: {e}")
         finally:
             # Cleanup
-            with self.lock:
-                if client_socket in self.clients:
-                    del self.clients[client_socket]
-                if username in self.username_to_socket:
-                    del self.username_to_socket[username]
-
-                room_data = self.rooms.get(current_room)
-                if room_data and username in room_data["users"]:
-                    room_data["users"].remove(username)
-
-            client_socket.close()
-            self.send_active_list()
-            print(f"[DISCONN] {username}")
+            self.disconnect(session)
 
     def receive(self):
         """Accepts incoming connections and starts a new thread for each client."""
@@ -255,5 +1575,152 @@ class ChatServer:
             thread.start()
 
 
+def run_worker(args, backplane=None, worker=0):
+    """
+    Runs one ChatServer with the command line options.
+
+    Args:
+        backplane: Address of the BusHub to join, or None to run alone.
+        worker: Index of this process among the node's workers.
+    """
+    metrics_port = args.metrics_port
+    if metrics_port and args.workers > 1:
+        metrics_port += worker  # One endpoint per worker
+
+    ChatServer(
+        addr=(protocol.ADDR[0], args.port),
+        engine=args.engine,
+        max_media_queue=args.max_media_queue,
+        backlog_timeout=args.backlog_timeout,
+        prioritized=not args.fifo_queues,
+        metrics_port=metrics_port,
+        metrics_interval=args.metrics_interval,
+        reuse_port=args.workers > 1,
+        backplane=backplane,
+        worker_id=args.node_id << 8 | worker,  # Unique across the cluster
+        history_dir=None if args.no_history else args.history_dir,
+        files_dir=None if args.no_file_store else args.files_dir,
+        files_capacity=args.files_capacity * 1024 * 1024,
+    )
+
+
+def stop_workers(signum, frame):
+    """SIGTERM handler of the worker parent: exit once, running atexit hooks."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+
+def run_workers(args):
+    """
+    Runs args.workers ChatServer processes on one port. They join the
+    cluster backplane if one is given, otherwise a BusHub served by this
+    process.
+    """
+    hub = None
+    backplane = args.backplane
+    if not backplane:
+        backplane = os.path.join(tempfile.mkdtemp(prefix="pychat-"), "bus.sock")
+        hub = BusHub(backplane)
+
+    processes = [
+        multiprocessing.Process(
+            target=run_worker, args=(args, backplane, worker), daemon=True
+        )
+        for worker in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    # Exit normally on SIGTERM so the daemon workers are stopped as well
+    signal.signal(signal.SIGTERM, stop_workers)
+    print(f"[SERVER] {args.workers} workers sharing port {args.port}")
+    if hub:
+        hub.serve_forever()
+    for process in processes:
+        process.join()
+
+
 if __name__ == "__main__":
-    ChatServer()
+    parser = argparse.ArgumentParser(description="PyChat server")
+    parser.add_argument(
+        "--engine",
+        choices=["threaded", "selector"],
+        default="threaded",
+        help="threaded: one thread per client, selector: single event loop",
+    )
+    parser.add_argument("--port", type=int, default=protocol.PORT)
+    parser.add_argument(
+        "--max-media-queue",
+        type=int,
+        default=protocol.MAX_MEDIA_QUEUE,
+        help="media frames queued per client before the oldest is dropped",
+    )
+    parser.add_argument(
+        "--backlog-timeout",
+        type=float,
+        default=protocol.BACKLOG_TIMEOUT,
+        help="seconds a client's oldest queued frame may wait before disconnect",
+    )
+    parser.add_argument(
+        "--fifo-queues",
+        action="store_true",
+        help="write queued frames in arrival order instead of by priority lane",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve counters and histograms as JSON on this local HTTP port",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        help="print counters and histograms every this many seconds",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="worker processes sharing the port (SO_REUSEPORT) over a local bus",
+    )
+    parser.add_argument(
+        "--backplane",
+        help="join a cluster through the bus.py hub at host:port (or Unix path)",
+    )
+    parser.add_argument(
+        "--node-id",
+        type=int,
+        default=0,
+        help="this node's id (0-254), unique in the cluster",
+    )
+    parser.add_argument(
+        "--history-dir",
+        default="history",
+        help="directory of the message history log",
+    )
+    parser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="keep no message history",
+    )
+    parser.add_argument(
+        "--files-dir",
+        default="files",
+        help="directory of the content-addressed file store",
+    )
+    parser.add_argument(
+        "--files-capacity",
+        type=int,
+        default=DEFAULT_CAPACITY // (1024 * 1024),
+        help="MiB of files kept before the least recently used are evicted",
+    )
+    parser.add_argument(
+        "--no-file-store",
+        action="store_true",
+        help="relay files to recipients instead of storing them",
+    )
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        run_worker(args, args.backplane)